@@ -26,6 +26,7 @@ async def main():
 
     inst = Instance(config_path="default.yaml")
     await inst.initialize()
+    inst.add_signal_handlers()
 
     logger.debug(f"done loading instance {inst}\n\n")
 
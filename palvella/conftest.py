@@ -0,0 +1,39 @@
+"""Shared fixtures for the tests."""
+
+import types
+
+import pytest
+
+from palvella.lib.instance.hook import Hooks
+from palvella.lib.instance.mq import MessageQueueRoutes
+from palvella.lib.plugin import PluginRegistry
+
+
+class StubInstance:
+    """
+    A stand-in for an Instance(), with only the parts components use once they're running.
+
+    Components are created with 'parent=' the stub, and add()ed to its hook index and message
+    queue routes, as ComponentObjects would. *classes* are the plugin classes hooks are
+    registered against (and ComponentObjects creates components of, in that order). There
+    are no other components for get_component() to find.
+    """
+
+    def __init__(self, classes=()):
+        self.hooks = Hooks(parent=self)
+        self.mq_routes = MessageQueueRoutes(parent=self)
+        self.plugins = types.SimpleNamespace(registry=PluginRegistry(classes), class_graph={},
+                                             topo_sort=lambda: tuple(classes))
+        self.components = types.SimpleNamespace(registry=PluginRegistry())
+
+    def add(self, instance):
+        """Add a component *instance* to the hook index and the message queue routes. Returns it."""
+        self.hooks.add_instance(instance)
+        self.mq_routes.add_instance(instance)
+        return instance
+
+
+@pytest.fixture
+def stub_instance():
+    """Return the StubInstance class, to create stub Instances with."""
+    return StubInstance
@@ -1,13 +1,41 @@
 
+import asyncio
 import importlib_resources
+import json
+from collections import UserDict, defaultdict
+from copy import deepcopy
+from functools import lru_cache
 from pathlib import Path
 from dataclasses import dataclass
+from types import MappingProxyType
 
-from jsonschema import validate as jsonschema_validate
+import graphlib  # our poetry requirements include the 'graphlib_backport' module
+
+from jsonschema.validators import validator_for
 
 from palvella.lib.instance.config import ConfigData, loadYamlFile
-from palvella.lib.plugin import match_class_dependencies, PluginDependency, Plugin
+from palvella.lib.plugin import PluginDependency, PluginRegistry, Plugin
 from ..logging import makeLogger, logging
+from ..timing import timings
+
+
+@lru_cache(maxsize=None)
+def load_module_defaults(module, component_namespace):
+    """
+    Return the default configuration data of a plugin module.
+
+    Looks for a '<component_namespace>.yaml' and a 'config.yaml' file in the files of
+    *module* (the last one found wins). Each module's files are only parsed once (until
+    Instance.reload() clears the cache); the result is a read-only mapping shared by every
+    instance of the plugin.
+    """
+    defaults = None
+    for fname in [f"{component_namespace}.yaml", 'config.yaml']:
+        config_yaml_file = importlib_resources.files(module).joinpath(fname)
+        with importlib_resources.as_file(config_yaml_file) as filename:
+            if Path(filename).exists():
+                defaults = loadYamlFile(filename)
+    return MappingProxyType(dict(defaults) if isinstance(defaults, dict) else {})
 
 
 class Component(Plugin, class_type="base"):
@@ -15,6 +43,8 @@ class Component(Plugin, class_type="base"):
 
     If an object inheriting this class has a function '__pre_plugins__',
     that function will be run at the end of '__init__' in this object.
+    If it has a function '__stop_plugins__' (which may be a coroutine function),
+    that function will be run by 'stop()' when the component is removed.
 
     Attributes:
         name:                   The name of the particular instance of this component.
@@ -22,6 +52,9 @@ class Component(Plugin, class_type="base"):
         component_namespace:    The namespace for configuration files relevant to this plugin.
         config_data:            A dict of configuration data for this instance of this component.
         schema:                 A pointer to a schema to validate the configuration with.
+        hook_namespaces:        The component namespaces of the sections of this component's
+                                configuration that name the plugins its hooks match (see
+                                register_hook()), rather than components to create.
     """
 
     # The name of 'Component's plugin namespace. Each component needs to overload this.
@@ -31,9 +64,16 @@ class Component(Plugin, class_type="base"):
     #component_namespace = "instance"
     config_data = ConfigData()  # Each component gets an empty config_data by default
     schema = True
+    hook_namespaces = ()
     _pre_plugins_ref_name = "__pre_plugins__"
+    _stop_plugins_ref_name = "__stop_plugins__"
     name = None
 
+    # Set this to True in a plugin whose initialization blocks (on disk or network I/O),
+    # so ComponentObjects.initialize() creates its instances in a thread pool. The
+    # '__pre_plugins__' of such a plugin must not need the running event loop.
+    init_in_executor = False
+
     def __init__(self, **kwargs):
         """
         Initialize the new Component object.
@@ -50,22 +90,41 @@ class Component(Plugin, class_type="base"):
         # For each module, load a 'config.yaml' file if one exists, to fill in
         # default configuration data. Configuration data passed to the object in
         # the 'config_data' attribute will overload this.
+        # The files are parsed once per module (see load_module_defaults()), and
+        # only mutable values are copied into each instance's 'config_data'.
 
-        for fname in [self.component_namespace + ".yaml", 'config.yaml']:
-            config_yaml_file = importlib_resources.files(self.__module__).joinpath(fname)
-            with importlib_resources.as_file(config_yaml_file) as filename:
-                if Path(filename).exists():
-                    self._config_data_defaults = loadYamlFile(filename)
+        with timings.phase("component.defaults", self.__class__.__name__):
+            self._config_data_defaults = load_module_defaults(self.__module__, self.component_namespace)
 
-        if hasattr(self, '_config_data_defaults') and self._config_data_defaults != None:
-            for k, v in self._config_data_defaults.items():
-                if not k in self.config_data:
-                    self.config_data[k] = v
+        if self.config_data is None or 'config_data' not in self.__dict__:
+            self.config_data = ConfigData()
+        for k, v in self._config_data_defaults.items():
+            if not k in self.config_data:
+                self.config_data[k] = deepcopy(v) if isinstance(v, (dict, list)) else v
 
         # Run the '_pre_plugins_ref_name' function if it was defined by a subclass
         if self._pre_plugins_ref_name != None and hasattr(self, self._pre_plugins_ref_name):
             if callable(getattr(self, self._pre_plugins_ref_name)):
-                getattr(self, self._pre_plugins_ref_name)()
+                with timings.phase("component.pre_plugins", self.__class__.__name__):
+                    getattr(self, self._pre_plugins_ref_name)()
+
+    async def stop(self):
+        """
+        Stop this component, when it is removed from a running Instance (ex. by a reload).
+
+        Unregisters any hooks this component registered, then runs the
+        '_stop_plugins_ref_name' function if it was defined by a subclass.
+        """
+        hooks = getattr(self.parent, 'hooks', None)
+        if hooks is not None:
+            hooks.unregister_hooks(self)
+
+        if self._stop_plugins_ref_name != None and hasattr(self, self._stop_plugins_ref_name):
+            func = getattr(self, self._stop_plugins_ref_name)
+            if callable(func):
+                res = func()
+                if asyncio.iscoroutine(res):
+                    await res
 
     @classmethod
     def validate_config_schema(cls, data):
@@ -79,7 +138,23 @@ class Component(Plugin, class_type="base"):
 
         TODO: Document where/how to encode the schema.
         """
-        jsonschema_validate(data, cls.schema)
+        cls.schema_validator().validate(data)
+
+    @classmethod
+    def schema_validator(cls):
+        """
+        Return a jsonschema validator for 'cls.schema'.
+
+        The schema is checked and the validator created once per class, then cached on
+        the class until 'cls.schema' is replaced.
+        """
+        cached = cls.__dict__.get('_schema_validator')
+        if cached is None or cached[0] is not cls.schema:
+            validator_class = validator_for(cls.schema)
+            validator_class.check_schema(cls.schema)
+            cached = (cls.schema, validator_class(cls.schema))
+            cls._schema_validator = cached
+        return cached[1]
 
     def get_component(self, dep):
         """
@@ -99,7 +174,7 @@ class Component(Plugin, class_type="base"):
         list
             A list of matching instances of components
         """
-        results = match_class_dependencies(self, self.parent.components.instances, [dep])
+        results = self.parent.components.registry.match([dep])
         return results
 
     def register_hook(self, component_namespace, callback, hook_type=None):
@@ -107,7 +182,9 @@ class Component(Plugin, class_type="base"):
         Register a callback function for each plugin section configured in self.config_data.
 
         For every 'plugin_type', 'data' section in self.config_data[component_namespace],
-        registers a 'callback' function, optionally passing 'hook_type'.
+        registers a 'callback' function, optionally passing 'hook_type'. If self.config_data
+        has a 'fields' list (ex. ["repository.url", "ref"]), the hooks declare that only those
+        fields of a message's data are read.
 
         The end result is that the function will be called if any of the configured plugins
         run a trigger() function.
@@ -137,10 +214,19 @@ class Component(Plugin, class_type="base"):
                     plugin_dep=plugin_dep,
                     hook_type=hook_type,
                     callback=self.receive_alert,
-                    data=item
+                    data=item,
+                    owner=self,
+                    fields=self.config_data.get('fields')
                 )
 
 
+def config_key(config_data):
+    """Return a string that is equal for equal configuration data."""
+    if isinstance(config_data, UserDict):
+        config_data = config_data.data
+    return json.dumps(config_data, sort_keys=True, default=str)
+
+
 @dataclass(unsafe_hash=True)
 class ComponentObject:
     classref = None
@@ -156,6 +242,9 @@ class ComponentObject:
         self.config_data = config_data
         self.parent = parent
         self.error = error
+        # Taken before the instance merges its defaults into 'config_data', so a
+        # reload can tell if the configuration of this object changed.
+        self.key = (classref, config_key(config_data))
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
     def instance(self):
@@ -175,7 +264,7 @@ class ComponentObjects:
     """
 
     instances = []  # The list of instantiated objects
-    objects = []  # The list of ComponentObject()s
+    registry = PluginRegistry()  # An index of 'instances'; see add_instance()
 
     logger = makeLogger(__module__ + "/ComponentObjects")
 
@@ -187,13 +276,120 @@ class ComponentObjects:
         self.root = root
         self.parent = parent
         self.config = config
+        self.objects = []  # The list of ComponentObject()s
 
         # Take config.objects, make self.objects
         self.add_all_component_topo_objects(self.config.objects, self.objects)
 
-    async def initialize(self):
+    async def initialize(self, component_objects=None):
+        """
+        Create an instance of each ComponentObject in *component_objects* (default: 'self.objects').
+
+        The objects are initialized following the plugin class graph
+        (*self.root.plugins.class_graph*): as soon as every class a plugin class depends
+        on has been initialized, the objects of that class are initialized, concurrently
+        with those of any other class that is ready. Objects whose class sets
+        'init_in_executor' are created in the event loop's default executor.
+        """
+        objects = defaultdict(list)
+        for x in list(self.objects if component_objects is None else component_objects):
+            objects[x.classref].append(x)
+
+        sorter = graphlib.TopologicalSorter(self.root.plugins.class_graph)
+        for classref in objects:
+            sorter.add(classref)
+        sorter.prepare()
+
+        pending = {}
+        try:
+            while sorter.is_active():
+                for classref in sorter.get_ready():
+                    task = asyncio.ensure_future(self.initialize_objects(objects.get(classref, [])))
+                    pending[task] = classref
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    classref = pending.pop(task)
+                    task.result()
+                    sorter.done(classref)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def initialize_objects(self, objects):
+        """Concurrently create the instances of a list of ComponentObject()s, and add them."""
+        loop = asyncio.get_running_loop()
+
+        async def instance(obj):
+            if obj.classref.init_in_executor:
+                return await loop.run_in_executor(None, obj.instance)
+            return obj.instance()
+
+        for result in await asyncio.gather(*[instance(x) for x in objects]):
+            self.add_instance(result)
+
+    async def reload(self, config):
+        """
+        Apply a new Config() *config* to the running components.
+
+        Builds the component objects for *config* and compares them to 'self.objects'.
+        Objects with the same plugin class and configuration are kept, along with their
+        instances (so their sockets, connections, servers, etc stay up). Instances of
+        objects no longer in the configuration are stopped and removed, dependents first,
+        and then the new objects are initialized.
+
+        Returns a tuple of the lists of added and removed ComponentObject()s.
+        """
+        new_objects = []
+        self.add_all_component_topo_objects(config.objects, new_objects)
+
+        unmatched = defaultdict(list)
         for x in self.objects:
-            self.instances.append(x.instance())
+            unmatched[x.key].append(x)
+
+        objects, added = [], []
+        for x in new_objects:
+            if len(unmatched[x.key]) > 0:
+                objects.append(unmatched[x.key].pop(0))
+            else:
+                objects.append(x)
+                added.append(x)
+        removed = [x for v in unmatched.values() for x in v]
+
+        self.logger.info(f"reload: {len(objects) - len(added)} unchanged, {len(added)} added, {len(removed)} removed")
+
+        order = {classref: i for i, classref in enumerate(self.root.plugins.topo_sort())}
+        for x in sorted(removed, key=lambda x: order.get(x.classref, -1), reverse=True):
+            if x._instance is not None:
+                self.logger.debug(f"reload: stopping {x._instance}")
+                await x._instance.stop()
+                self.remove_instance(x._instance)
+
+        self.config = config
+        self.objects = objects
+        await self.initialize(added)
+        return added, removed
+
+    def add_instance(self, instance):
+        """Add an instantiated component to 'self.instances' and the registry."""
+        self.instances.append(instance)
+        self.registry.add(instance)
+        self.root.hooks.add_instance(instance)
+        self.root.mq_routes.add_instance(instance)
+
+    def remove_instance(self, instance):
+        """Remove an instantiated component from 'self.instances' and the registry."""
+        if instance in self.instances:
+            self.instances.remove(instance)
+        self.registry.remove(instance)
+        self.root.hooks.remove_instance(instance)
+        self.root.mq_routes.remove_instance(instance)
+
+    def invalidate(self):
+        """Rebuild the registry, hook index and message queue routes from 'self.instances' (if that list was changed directly)."""
+        self.registry.invalidate(self.instances)
+        self.root.mq_routes.invalidate(self.instances)
+        for instance in self.instances:
+            self.root.hooks.add_instance(instance)
 
     def add_all_component_topo_objects(self, objects, array):
         """Retrieve a set of ComponentObject()s based on topological sort of plugin graph.
@@ -1,12 +1,28 @@
 
 
+import hashlib
+import json
+import os
 from collections import UserDict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 
 from ruamel.yaml import YAML
 
-from palvella.lib.plugin import PluginDependency, match_class_dependencies
+from palvella.lib.plugin import PluginDependency, WalkPlugins
 from ..logging import makeLogger, logging
+from ..timing import timings
+
+# Where to cache parsed and validated files from a 'jobs_dir' directory.
+CONFIG_CACHE_DIR = os.environ.get('CONFIG_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'palvella', 'config'))
+
+# The most parsed files kept in CONFIG_CACHE_DIR; the least recently used are removed.
+CONFIG_CACHE_MAX_ENTRIES = int(os.environ.get('CONFIG_CACHE_MAX_ENTRIES', '10000'))
+
+# Parse files in a 'jobs_dir' in a pool of processes if at least this many need parsing.
+PARALLEL_PARSE_MIN_FILES = int(os.environ.get('PARALLEL_PARSE_MIN_FILES', '8'))
 
 
 @dataclass
@@ -38,7 +54,14 @@ class ConfigObject:
 
 
 class Config:
-    """A class to parse a configuration file and load it into a data structure."""
+    """
+    A class to parse a configuration file and load it into a data structure.
+
+    If the configuration has a top-level 'jobs_dir' key (or a *jobs_dir* is passed),
+    every '*.yaml'/'*.yml' file in that directory is loaded as well; each file has the
+    same format as the 'jobs' section, and its jobs are added to that section. See
+    load_jobs_dir().
+    """
     
     logger = makeLogger(__module__ + "/Config")
     objects = []  # ComponentObject()s derived from config files
@@ -46,7 +69,7 @@ class Config:
     config_path = None
     config_data = None
 
-    def __init__(self, parent=None, config_path=None, config_data=None):
+    def __init__(self, parent=None, config_path=None, config_data=None, jobs_dir=None):
         """Initialize new configuration.
 
         Parameters
@@ -57,14 +80,35 @@ class Config:
             A file path to a YAML file to load configuration data from. (Optional)
         config_data
             A dict with configuration data. (Optional)
+        jobs_dir
+            A directory of job definition files. Overrides a 'jobs_dir' key in the
+            configuration. (Optional)
         """
         self.logger.debug(f"Config(self={self}, parent={parent}, config_path={config_path}, config_data={config_data})")
         self.parent = parent
         self.config_path = config_path
         self.config_data = config_data
 
-        self.load_config()
-        self.objects = [ x for x in self.parse_conf_component_ns(self.data) ]
+        with timings.phase("config.load", self.config_path):
+            self.load_config()
+
+        with timings.phase("config.validate", self.config_path):
+            self.validate_config(self.data)
+
+        # The files in 'jobs_dir' are validated (and cached) one by one as they are loaded
+        if isinstance(self.data, dict):
+            jobs_dir = jobs_dir or self.data.get('jobs_dir')
+        if jobs_dir:
+            with timings.phase("config.jobs_dir", jobs_dir):
+                self.load_jobs_dir(jobs_dir)
+
+        # If the parent only loaded plugins lazily, load the ones this configuration needs
+        plugins = getattr(self.parent, 'plugins', None)
+        if isinstance(plugins, WalkPlugins):
+            plugins.load_config_plugins(self.data)
+
+        with timings.phase("config.parse", self.config_path):
+            self.objects = [ x for x in self.parse_conf_component_ns(self.data) ]
         self.logger.debug(f"Created objects: {self.objects}")
 
     def load_config(self):
@@ -78,14 +122,95 @@ class Config:
         if c != 1:
             raise Exception("You need to pass either config_path or config_data")
 
+    def load_jobs_dir(self, jobs_dir):
+        """
+        Add the jobs defined in the files of directory *jobs_dir* to the 'jobs' section of 'self.data'.
+
+        A relative *jobs_dir* is relative to the directory of 'self.config_path'.
+        Each file is validated against the schema of the 'jobs' plugin base. Parsed and
+        validated files are cached in CONFIG_CACHE_DIR, keyed by a hash of their content
+        (and of the schema), so unchanged files are not parsed again; the files that do
+        need parsing are parsed in parallel.
+        """
+        if self.config_path is not None and not os.path.isabs(jobs_dir):
+            jobs_dir = os.path.join(os.path.dirname(self.config_path), jobs_dir)
+
+        bases = self.plugin_bases().get('jobs', [])
+        if len(bases) != 1:
+            raise ValueError(f"Cannot load jobs_dir '{jobs_dir}': no single plugin base for 'jobs'")
+        job_base = bases[0]
+
+        files = loadYamlDir(jobs_dir, validate=job_base.validate_config_schema,
+                            cache=ParseCache(CONFIG_CACHE_DIR),
+                            salt=json.dumps(job_base.schema, sort_keys=True, default=str))
+
+        self.data = dict(self.data)
+        jobs = self.data['jobs'] = dict(self.data.get('jobs') or {})
+        for filename, data in files:
+            if data is None:
+                continue
+            if not isinstance(data, dict):
+                raise ValueError(f"Job file '{filename}' must contain a dict of plugin_type: [jobs]")
+            for plugin_type, items in data.items():
+                jobs[plugin_type] = list(jobs.get(plugin_type) or []) + list(items or [])
+
+    def plugin_bases(self):
+        """Return a dict of component_namespace -> list of plugin base classes with that namespace."""
+        bases = {}
+        for x in self.parent.subclasses:
+            if x.class_type == "plugin_base":
+                bases.setdefault(x.component_namespace, []).append(x)
+        return bases
+
+    def conf_component_sections(self, data):
+        """
+        Yield a (component_namespace, plugin_base, datarootv) tuple for each section of *data*.
+
+        Sections whose *component_namespace* has no plugin base (or more than one) are skipped.
+        A scalar *datarootv* is taken as an alias to a plugin_type with no configuration.
+        """
+        if not isinstance(data, UserDict) and not isinstance(data, dict):
+            raise ValueError(f"config data needs to be a dict (was: type {type(data)}, dict {data})")
+
+        bases = self.plugin_bases()
+
+        for component_namespace, datarootv in data.items():
+            self.logger.debug(f"component_namespace {component_namespace}")
+
+            plugin_base = bases.get(component_namespace, [])
+            if len(plugin_base) < 1:
+                self.logger.debug(f"could not find plugin base for '{component_namespace}'")
+                continue
+            elif len(plugin_base) > 1:
+                self.logger.debug(f"too many plugin bases for '{component_namespace}'")
+                continue
+
+            self.logger.debug(f"datarootv {datarootv} type {type(datarootv)}")
+            if type(datarootv) == type(""):
+                self.logger.debug(f"Found datarootv as scalar; assuming alias to plugin_type")
+                datarootv = {datarootv: []}
+
+            yield component_namespace, plugin_base, datarootv
+
+    def validate_config(self, data):
+        """
+        Validate the schema of every section of configuration *data*, in a single pass.
+
+        Each section is validated by its plugin base's validate_config_schema(), which
+        uses a validator compiled once per class. Raises the first validation error found.
+        """
+        for component_namespace, plugin_base, datarootv in self.conf_component_sections(data):
+            with timings.phase("config.validate.section", component_namespace):
+                plugin_base[0].validate_config_schema(datarootv)
+
     def parse_conf_component_ns(self, data):
         """
         Parse configuration data, return plugin_type and ConfigData().
 
         See data parameter below. Finds a components that has registered
         *component_namespace*, finds a plugin *plugin_type* of that component,
-        and yields a tuple of that plugin_type and a ConfigData(). Also
-        attempts to validate the schema.
+        and yields a tuple of that plugin_type and a ConfigData(). The schema
+        should already have been checked with validate_config().
 
         Parameters
         ----------
@@ -106,36 +231,11 @@ class Config:
         list
             For each `item` (see above), yield the plugin_type class and ConfigData(item).
         """
-        subclasses = self.parent.subclasses
-
         self.logger.debug(f"data {data}")
 
-        if not isinstance(data, UserDict) and not isinstance(data, dict):
-            raise ValueError(f"config data needs to be a dict (was: type {type(data)}, dict {data})")
-
-        for component_namespace, datarootv in data.items():
-            self.logger.debug(f"component_namespace {component_namespace}")
-
-            plugin_base = [x for x in subclasses
-                             if x.class_type == "plugin_base" \
-                             and x.component_namespace == component_namespace]
-            if len(plugin_base) < 1:
-                self.logger.debug(f"could not find plugin base for '{component_namespace}'")
-                continue
-            elif len(plugin_base) > 1:
-                self.logger.debug(f"too many plugin bases for '{component_namespace}'")
-                continue
-
-            self.logger.debug(f"datarootv {datarootv} type {type(datarootv)}")
-            if type(datarootv) == type(""):
-                self.logger.debug(f"Found datarootv as scalar; assuming alias to plugin_type")
-                datarootv = {datarootv: []}
-
-            # Validate schema
-            plugin_base[0].validate_config_schema(datarootv)
-
+        for component_namespace, plugin_base, datarootv in self.conf_component_sections(data):
             if type(datarootv) != type({}):
-                self.logger.debug(f"Configuration entry for {plugin_type} must be a scalar or dict; skipping")
+                self.logger.debug(f"Configuration entry for {component_namespace} must be a scalar or dict; skipping")
                 continue
 
             for plugin_type, config_data in datarootv.items():
@@ -147,7 +247,7 @@ class Config:
                 dep = PluginDependency(parentclassname=plugin_base[0].__name__, plugin_type=plugin_type)
                 self.logger.debug(f"dep {dep}")
 
-                for classref in match_class_dependencies(self, plugin_base[0].__subclasses__(), [dep]):
+                for classref in WalkPlugins.registry.match([dep]):
                     self.logger.debug(f"class {classref}")
 
                     if len(config_data) < 1:
@@ -165,3 +265,122 @@ def loadYamlFile(file):
         yaml = YAML(typ='safe')
         return yaml.load(f)
     raise ValueError("No configuration provided")
+
+
+def loadYamlString(content):
+    """Parse a YAML document from a string and return the result."""
+    yaml = YAML(typ='safe')
+    return yaml.load(content)
+
+
+def loadYamlDir(path, validate=None, cache=None, salt=""):
+    """
+    Load every '*.yaml' and '*.yml' file in directory *path*.
+
+    Returns a list of (filename, data) tuples, sorted by filename.
+
+    If a ParseCache *cache* is passed, files whose content (plus *salt*) was seen before
+    are taken from the cache and not parsed. The rest are parsed, in a pool of processes
+    if there are at least PARALLEL_PARSE_MIN_FILES of them, then passed to *validate*
+    (if passed) and added to the cache, which is then pruned (see ParseCache.prune()).
+    """
+    filenames = sorted(os.path.join(path, x) for x in os.listdir(path)
+                       if x.endswith((".yaml", ".yml")) and not x.startswith("."))
+    results, misses = {}, []
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            content = f.read()
+        key = ParseCache.key(content, salt)
+        found, data = cache.get(key) if cache is not None else (False, None)
+        if found:
+            results[filename] = data
+        else:
+            misses.append((filename, key, content.decode("utf-8")))
+
+    if len(misses) >= PARALLEL_PARSE_MIN_FILES:
+        with ProcessPoolExecutor() as pool:
+            parsed = list(pool.map(loadYamlString, [x[2] for x in misses], chunksize=8))
+    else:
+        parsed = [loadYamlString(x[2]) for x in misses]
+
+    for (filename, key, _content), data in zip(misses, parsed):
+        if validate is not None:
+            validate(data)
+        if cache is not None:
+            cache.put(key, data)
+        results[filename] = data
+
+    if cache is not None and len(misses) > 0:
+        cache.prune()
+
+    return [(x, results[x]) for x in filenames]
+
+
+class ParseCache:
+    """
+    A directory of parsed configuration files, keyed by a hash of their content.
+
+    Entries are stored as JSON. Data that JSON doesn't give back as it was (ex. YAML
+    with integer keys or dates) is just not cached, and failing to read or write the
+    cache only costs a parse. Reading an entry marks it used (by its mtime), and
+    prune() keeps only the *max_entries* most recently used.
+    """
+
+    logger = makeLogger(__module__ + "/ParseCache")
+
+    def __init__(self, path, max_entries=CONFIG_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.path)
+
+    @staticmethod
+    def key(content, salt=""):
+        """Return the cache key for file *content* (bytes)."""
+        return hashlib.sha256(salt.encode() + b"\0" + content).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """Return a tuple of (True, data) if *key* is in the cache, or else (False, None)."""
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(self._file(key))
+        except (OSError, ValueError):
+            return False, None
+        return True, data
+
+    def put(self, key, data):
+        """Cache *data* under *key*, if it's the same after a round trip through JSON."""
+        tmp = f"{self._file(key)}.{os.getpid()}.tmp"
+        try:
+            content = json.dumps(data)
+            if json.loads(content) != data:
+                raise ValueError("the data changes when stored as JSON")
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp, self._file(key))
+        except (OSError, TypeError, ValueError) as e:
+            self.logger.debug(f"Not caching {key}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def prune(self):
+        """Remove the least recently used entries, leaving 'self.max_entries'."""
+        try:
+            entries = sorted((x.stat().st_mtime_ns, x.path) for x in os.scandir(self.path)
+                             if x.name.endswith(".json"))
+        except OSError:
+            return
+        excess = entries[:max(0, len(entries) - self.max_entries)]
+        for _mtime, path in excess:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if excess:
+            self.logger.debug(f"Pruned {len(excess)} entries from {self}")
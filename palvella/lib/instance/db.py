@@ -5,7 +5,15 @@ from palvella.lib.instance import Component
 
 
 class DB(Component, class_type="plugin_base"):
-    """The 'DB' plugin class."""
+    """
+    The 'DB' plugin class.
+
+    Database plugins that can share state between processes (ex. the keys claimed by a
+    DedupCache) implement the coroutines claim_key(namespace, key, ttl), which returns True
+    if it claimed *key* for *ttl* seconds or False if it's already claimed, and
+    release_key(namespace, key).
+    """
 
     plugin_namespace = "palvella.plugins.lib.db"
     component_namespace = "db"
+
@@ -1,13 +1,26 @@
 
-"""The base class for Hooks. This is currently only used by Instance class."""
+"""
+The base class for Hooks. This is currently only used by Instance class.
 
+Hook callbacks are run as tasks by a HookDispatcher. At most 'HOOK_CONCURRENCY' (environment
+variable, default: 64) callbacks run at once per Instance; a Trigger can set a lower limit
+for its own callbacks with its 'hook_concurrency' configuration key.
+"""
+
+import asyncio
+import functools
+import os
+from collections import defaultdict
+from collections.abc import Mapping
 from dataclasses import dataclass
 
-from palvella.lib.plugin import match_class_dependencies
 from palvella.lib.instance.message import Message
+from palvella.lib.plugin import PluginDependency
 
 from ..logging import makeLogger, logging
 
+HOOK_CONCURRENCY = int(os.environ.get('HOOK_CONCURRENCY', '64'))
+
 logger = makeLogger(__name__)
 
 
@@ -17,103 +30,444 @@ class Hook:
     hook_type = None
     callback = None
     data = None
+    predicates = None  # 'data' compiled by compile_hook_data()
+    fields = None  # The paths of the message data the callback reads, or None for all of it
+    owner = None  # The component instance that registered the hook
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
 
 
+_MISSING = object()
+_ANY_DICT = object()
+
+
+def compile_hook_data(data, path=()):
+    """
+    Compile hook *data* into a list of (path, value) predicates.
+
+    Each predicate is the tuple of keys leading to a leaf of *data*, and the value the
+    message data must have there. An empty dict leaf only requires a dict at that path.
+    Returns None if *data* is not a dict, in which case the hook matches any message data.
+    """
+    if not isinstance(data, dict):
+        return None
+    predicates = []
+    for k, v in data.items():
+        if isinstance(v, dict) and v:
+            predicates.extend(compile_hook_data(v, path + (k,)))
+        else:
+            predicates.append((path + (k,), _ANY_DICT if isinstance(v, dict) else v))
+    return predicates
+
+
+def lookup_path(data, path):
+    """Return the value at *path* (a tuple of keys) in nested mappings *data*, or _MISSING."""
+    for k in path:
+        if not isinstance(data, Mapping) or k not in data:
+            return _MISSING
+        data = data[k]
+    return data
+
+
+def match_predicates(predicates, data):
+    """Return True if message data item *data* satisfies every (path, value) in *predicates*."""
+    for path, value in predicates:
+        found = lookup_path(data, path)
+        if found is _MISSING:
+            return False
+        if value is _ANY_DICT:
+            if not isinstance(found, Mapping):
+                return False
+        elif found != value:
+            return False
+    return True
+
+
+def indexable(value):
+    """Return True if *value* can be used as a key of the discrimination index."""
+    if value is _ANY_DICT:
+        return False
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class HookDispatch:
+    """
+    The hooks and component instances for one sender identity (plugin_namespace, plugin_type).
+
+    The hooks are also kept in a discrimination index on their data, built by build_index()
+    the first time a message is matched after the hooks change. Each hook is filed under one
+    of its equality predicates: the one whose path has the most distinct values across all
+    the hooks (ex. 'repository.url'). A message item then only looks up its own value at each
+    indexed path, and the remaining predicates of the few hooks found there are checked.
+
+    Attributes:
+        hooks:          The Hook()s whose component has this identity.
+        instances:      The component instances with this identity.
+    """
+
+    def __init__(self):
+        self.hooks = []
+        self.instances = []
+        self._index = None
+        self._fields = False
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        self._index, self._fields = None, False
+
+    def remove_hooks(self, owner):
+        self.hooks[:] = [x for x in self.hooks if x.owner is not owner]
+        self._index, self._fields = None, False
+
+    def fields(self):
+        """
+        Return the set of message data paths needed by all of 'self.hooks'.
+
+        That is, the fields each hook declared and the paths its data filter compares.
+        Returns None (everything is needed) if there are no hooks, or if any hook did
+        not declare its fields.
+        """
+        if self._fields is False:
+            fields = None
+            if self.hooks and all(x.fields is not None for x in self.hooks):
+                fields = set()
+                for hook in self.hooks:
+                    fields.update(hook.fields)
+                    fields.update(path for path, value in hook.predicates or ())
+            self._fields = fields
+        return self._fields
+
+    def build_index(self):
+        """
+        Build the discrimination index of 'self.hooks'.
+
+        Returns a tuple (paths, unindexed). 'paths' is a dict of {path: {value: [entry]}}.
+        'unindexed' is a list of entries for hooks with no indexable predicate, which are
+        checked against every message. Each entry is a tuple (position, hook, predicates),
+        where predicates are the ones left to check once the hook is found in the index.
+        """
+        distinct = defaultdict(set)
+        for hook in self.hooks:
+            for path, value in hook.predicates or ():
+                if indexable(value):
+                    distinct[path].add(value)
+
+        paths = {}
+        unindexed = []
+        for pos, hook in enumerate(self.hooks):
+            keys = [x for x in hook.predicates or () if indexable(x[1])]
+            if not keys:
+                unindexed.append((pos, hook, hook.predicates))
+                continue
+            key = max(keys, key=lambda x: len(distinct[x[0]]))
+            rest = [x for x in hook.predicates if x is not key]
+            paths.setdefault(key[0], {}).setdefault(key[1], []).append((pos, hook, rest))
+
+        self._index = (paths, unindexed)
+        return self._index
+
+    def match(self, data):
+        """Return a dict of {position: hook} for the hooks matching message data item *data*."""
+        paths, unindexed = self._index or self.build_index()
+        matched = {}
+        for path, values in paths.items():
+            found = lookup_path(data, path)
+            if found is _MISSING or not indexable(found):
+                continue
+            for pos, hook, rest in values.get(found, ()):
+                if match_predicates(rest, data):
+                    matched[pos] = hook
+        for pos, hook, predicates in unindexed:
+            if predicates is None or match_predicates(predicates, data):
+                matched[pos] = hook
+        return matched
+
+
+class Dispatch:
+    """
+    The hook callbacks started for one Message().
+
+    Attributes:
+        matches:        A list of (hook, component_instance) tuples, one per callback.
+        futures:        A list of asyncio Tasks, one per callback (in the same order as
+                        'matches'). Each one completes with the callback's return value
+                        or exception.
+    """
+
+    def __init__(self, matches, futures):
+        self.matches = matches
+        self.futures = futures
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    def done(self):
+        """Return True if every callback has completed."""
+        return all(x.done() for x in self.futures)
+
+    async def wait(self):
+        """Wait for every callback to complete. Returns a list of results or exceptions."""
+        if not self.futures:
+            return []
+        return await asyncio.gather(*self.futures, return_exceptions=True)
+
+    def results(self):
+        """Return a list of (hook, component_instance, result or exception) of the completed callbacks."""
+        results = []
+        for (hook, instance), future in zip(self.matches, self.futures):
+            if future.done() and not future.cancelled():
+                results.append((hook, instance, future.exception() or future.result()))
+        return results
+
+
+class HookDispatcher:
+    """
+    Runs hook callbacks as tasks, with a bounded number running at once.
+
+    A callback's task is only created once it has a slot, so past the limit, dispatch()
+    waits, rather than piling up tasks waiting for one. That holds up whatever is
+    dispatching (ex. a Trigger's consumers, and so its message queue) instead.
+
+    Attributes:
+        limit:          The most callbacks running at once, across all triggers.
+        pending:        The set of callback tasks not yet completed.
+    """
+
+    def __init__(self, limit=HOOK_CONCURRENCY):
+        self.limit = limit
+        self.pending = set()
+        self._semaphore = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def semaphore(self):
+        # Created on first use, so it belongs to the running event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def dispatch(self, matches, message, semaphore=None):
+        """
+        Start a task for the callback of each (hook, component_instance) in *matches*.
+
+        Each callback is passed the hook, the component instance, and *message*. Before
+        each task is started, a slot of the global semaphore is acquired (and of *semaphore*,
+        if passed; ex. a Trigger's own limit), waiting for one if needed. The slots are
+        released when the callback completes. Returns a Dispatch().
+        """
+        matches = list(matches)
+        futures = []
+        for hook, instance in matches:
+            await self.acquire(semaphore)
+            future = asyncio.ensure_future(self._run(hook, instance, message))
+            self.pending.add(future)
+            future.add_done_callback(functools.partial(self._done, semaphore))
+            futures.append(future)
+        return Dispatch(matches, futures)
+
+    async def acquire(self, semaphore=None):
+        """Acquire a slot of *semaphore* (if not None), and then of the global semaphore."""
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            await self.semaphore().acquire()
+        except BaseException:
+            if semaphore is not None:
+                semaphore.release()
+            raise
+
+    async def _run(self, hook, instance, message):
+        return await hook.callback(hook, instance, message)
+
+    def _done(self, semaphore, future):
+        self.semaphore().release()
+        if semaphore is not None:
+            semaphore.release()
+        self.pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Hook callback failed", exc_info=future.exception())
+
+    async def join(self):
+        """Wait for every pending callback to complete."""
+        while self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+
 class Hooks:
     """
     Manages hooks for components.
 
+    Hooks and component instances are indexed by their (plugin_namespace, plugin_type)
+    in a dict of HookDispatch()s, so a Message() is only compared against the hooks for
+    its sender. The index is kept up to date by register_hook()/unregister_hooks() and
+    add_instance()/remove_instance() (called by ComponentObjects).
+
     Attributes:
         parent:         A reference to the parent Instance() object.
+        dispatcher:     The HookDispatcher() that runs hook callbacks.
     """
 
     _hooks = []
 
     def __init__(self, parent):
         self.parent = parent
+        self.dispatcher = HookDispatcher()
+        self._hooks = []
+        self._dispatch = {}
+
+    @staticmethod
+    def dispatch_key(obj):
+        """Return the key of the dispatch index for a component class or instance, or a Message identity."""
+        return (getattr(obj, 'plugin_namespace', None), getattr(obj, 'plugin_type', None))
+
+    def _dispatch_entry(self, obj):
+        key = self.dispatch_key(obj)
+        if key not in self._dispatch:
+            self._dispatch[key] = HookDispatch()
+        return self._dispatch[key]
+
+    def add_instance(self, instance):
+        """Add a component instance to the dispatch index."""
+        entry = self._dispatch_entry(instance)
+        if instance not in entry.instances:
+            entry.instances.append(instance)
+
+    def remove_instance(self, instance):
+        """Remove a component instance from the dispatch index."""
+        entry = self._dispatch.get(self.dispatch_key(instance))
+        if entry is not None and instance in entry.instances:
+            entry.instances.remove(instance)
 
     def list(self):
         return self._hooks
 
-    def register_hook(self, plugin_dep, hook_type, callback, data):
+    def register_hook(self, plugin_dep, hook_type, callback, data, owner=None, fields=None):
         """
         Register a callback function to match against a plugin dependency if matching *data* is found.
 
         For each class matching *plugin_dep* PluginDependency, register a callback function, hook type,
         and data. The match_hook() function can be used to compare this hook against objects.
+        *owner* is the component registering the hook, so its hooks can be unregistered later.
+        *fields* is a list of the dotted paths (ex. "repository.url") of the message data the
+        callback reads; if every hook of a trigger declares them, the trigger only passes on
+        those fields (see Trigger.project()).
 
+        If no class matches (ex. with lazy plugin loading, a trigger only named in a job's
+        'triggers' isn't loaded), the hook is registered for the sender identity named by the
+        'component_namespace' and 'plugin_type' of *plugin_dep*, so it still matches messages
+        from that plugin (ex. consumed from a message queue another process publishes to).
         """
         logger.debug(f"register_hook({self}, {plugin_dep}, {hook_type}, {callback}, {data})")
 
-        components = match_class_dependencies(self, self.parent.plugins.classes, [plugin_dep])
+        if fields is not None:
+            fields = tuple(tuple(x.split(".")) for x in fields)
+
+        components = self.parent.plugins.registry.match([plugin_dep])
+        if len(components) < 1:
+            components = self.dependency_identities(plugin_dep)
         for component in components:
-            self._hooks.append(
-                Hook(component=component, hook_type=hook_type, callback=callback, data=data)
-            )
+            hook = Hook(component=component, hook_type=hook_type, callback=callback, data=data,
+                        predicates=compile_hook_data(data), fields=fields, owner=owner)
+            self._hooks.append(hook)
+            self._dispatch_entry(component).add_hook(hook)
+
+    def dependency_identities(self, plugin_dep):
+        """Return a Message.Identity() for the plugin named by PluginDependency *plugin_dep*, for each of its plugin base classes."""
+        if plugin_dep.component_namespace is None or plugin_dep.plugin_type is None:
+            return []
+        bases = self.parent.plugins.registry.match(
+            [PluginDependency(component_namespace=plugin_dep.component_namespace)])
+        return [Message.Identity(plugin_namespace=x.plugin_namespace, plugin_type=plugin_dep.plugin_type)
+                for x in bases if x.class_type == "plugin_base"]
+
+    def unregister_hooks(self, owner):
+        """Remove every hook registered by component *owner*."""
+        self._hooks[:] = [x for x in self._hooks if x.owner is not owner]
+        for entry in self._dispatch.values():
+            entry.remove_hooks(owner)
+
+    def fields_for(self, msg):
+        """Return the set of data paths the hooks for the sender of *msg* need, or None for all of them."""
+        entry = self._dispatch.get(self.dispatch_key(msg.identity))
+        return entry.fields() if entry is not None else None
+
+    async def dispatch(self, msg, semaphore=None):
+        """Run the callback of each hook matching Message() *msg* as a task. Returns a Dispatch() (see HookDispatcher.dispatch())."""
+        return await self.dispatcher.dispatch(self.match_hook_from_msg(msg), msg, semaphore=semaphore)
 
     def match_hook_from_msg(self, msg):
         """
         Look for a hookBased on an Message() *msg*, return hook and component instances that match.
 
         Looks for component instances that match registered hooks.
-        Compares the hook data section against a *msg* (Message) data section.
-        If the data matches, the hook and component instance are yielded.
+        Compares the hook data section against each *msg* (Message) data item, using the
+        discrimination index of the HookDispatch() for the sender of *msg*.
+        If the data matches every item, the hook and component instances are yielded.
+        If no instance of the sender is running in this process (ex. the message came from
+        another process through a message queue), the hook is yielded with None instead.
 
         Arguments:
             msg:            An object
-              msg.data:     A dict to compare against each hook's *data* attribute
+              msg.data:     A list of dicts to compare against each hook's *data* attribute
         """
         assert ( isinstance(msg, Message) ), "Requires Message object argument"
 
-        for hook in self.parent.hooks.list():
-            for instance in self.parent.components.instances:
+        entry = self._dispatch.get(self.dispatch_key(msg.identity))
+        if entry is None:
+            return
+        logger.debug("match_hook: %d hooks, %d instances for %s",
+                     len(entry.hooks), len(entry.instances), self.dispatch_key(msg.identity))
 
-                if hook.component.plugin_namespace != instance.plugin_namespace \
-                   or hook.component.plugin_type != instance.plugin_type:
-                    continue
-                logger.debug(f"match_hook: Found component instance {instance} matching hook component {hook.component}")
-
-                if hook.component.plugin_namespace != msg.identity.plugin_namespace \
-                   or hook.component.plugin_type != msg.identity.plugin_type:
-                    continue
-                logger.debug(f"match_hook: Found hook {hook} matches msg {msg.identity}")
-
-                if not self.match_hook_data(hook=hook, component_instance=instance, msg=msg):
-                    continue
-                logger.debug(f"match_hook: hook data matches msg data")
+        matched = None
+        for data in msg.data:
+            found = entry.match(data)
+            matched = found if matched is None else {k: v for k, v in matched.items() if k in found}
+        if matched is None:
+            matched = dict(enumerate(entry.hooks))
 
-                yield hook, instance
+        for pos in sorted(matched):
+            for instance in entry.instances or [None]:
+                yield matched[pos], instance
 
     def match_hook_data(self, hook, component_instance, msg):
         """
         Compare a Hook() data section against an Message() data array.
 
-        Uses compareDict() to recursively verify that *hook.data* entries exist in
-        *msg[].data*.
-
-        If both the hook and message data are not dicts, returns True.
-        If both hook and message data are dicts, and the hook data does not exist
-        in the message data, returns False.
+        Verifies that the compiled *hook.predicates* are found in each item of *msg.data*.
+        If the hook data is not a dict, returns True.
+        If the hook data does not exist in any message data item, returns False.
         Otherwise returns True.
         """
+        predicates = hook.predicates if hook.predicates is not None else compile_hook_data(hook.data)
+        if predicates is None:
+            return True
         for data in msg.data:
-            if not isinstance(hook.data, dict) and not isinstance(data, dict):
-                return True
-            if not compareDict(hook.data, data):
+            if not match_predicates(predicates, data):
                 return False
         return True
 
 
 def compareDict(d1, d2):
+    """Return True if every key of dict *d1* is in dict *d2* with the same value, recursively."""
     for k in d1:
         if not k in d2:
             return False
         if isinstance(d1[k], dict) and isinstance(d2[k], dict):
-            return compareDict(d1[k],d2[k])
-        if d1[k] != d2[k]:
+            if not compareDict(d1[k],d2[k]):
+                return False
+        elif d1[k] != d2[k]:
             return False
     return True
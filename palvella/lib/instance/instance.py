@@ -1,11 +1,17 @@
 
 """The base class for the Instance. Defines plugin class and some base functions."""
 
+import asyncio
+import functools
+import signal
+
 from palvella.lib.instance.config import loadYamlFile, Config
-from palvella.lib.instance.component import Component, ComponentObjects
-from palvella.lib.plugin import Plugin, WalkPlugins
+from palvella.lib.instance.component import Component, ComponentObjects, load_module_defaults
+from palvella.lib.plugin import PLUGIN_LOADING, Plugin, WalkPlugins
 from palvella.lib.instance.hook import Hooks
+from palvella.lib.instance.mq import MessageQueueRoutes
 from ..logging import makeLogger, logging
+from ..timing import timings
 
 
 logger = makeLogger(__name__)
@@ -17,27 +23,70 @@ class Instance(Plugin, class_type="base"):
     plugin_namespace = "palvella.lib.instance"
 
     hooks = None
+    mq_routes = None
     plugins = None
     components = None
     config = None
     config_path = None
     config_data = None
 
-    def __init__(self, config_path=None, config_data=None):
+    def __init__(self, config_path=None, config_data=None, plugin_loading=PLUGIN_LOADING):
         super().__init__()
 
         self.config_path = config_path
         self.config_data = config_data
         self.hooks = Hooks(parent=self)
+        self.mq_routes = MessageQueueRoutes(parent=self)
+        self._reload_lock = asyncio.Lock()
 
-        # Load plugin subclasses from the 'Component' class
-        self.plugins = WalkPlugins(Component)
+        # Load plugin subclasses from the 'Component' class. With lazy plugin loading,
+        # only the plugins named in the configuration get imported (by Config()).
+        with timings.phase("instance.walk_plugins"):
+            self.plugins = WalkPlugins(Component, lazy=(plugin_loading == "lazy"))
 
         self.config = Config(parent=self, config_path=self.config_path, 
                              config_data=self.config_data)
 
+    async def reload(self, config_path=None, config_data=None):
+        """
+        Reload the configuration, and only change the components whose configuration changed.
+
+        Parses the configuration again (from *config_path* or *config_data*, or else from
+        where it was originally loaded) and passes it to ComponentObjects.reload(). If the
+        new configuration fails to parse or validate, the running components are left alone.
+        The configuration is parsed in a thread, so the event loop keeps running meanwhile.
+        The plugins' default configuration files are read again too (see load_module_defaults()).
+        """
+        async with self._reload_lock:
+            if config_path is None and config_data is None:
+                config_path, config_data = self.config_path, self.config_data
+            logger.info(f"Reloading configuration (config_path={config_path})")
+            load_module_defaults.cache_clear()
+
+            config = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                Config, parent=self, config_path=config_path, config_data=config_data))
+            await self.components.reload(config)
+            self.config = config
+            self.config_path, self.config_data = config_path, config_data
+
+    def add_signal_handlers(self):
+        """Reload the configuration when the process receives SIGHUP (where supported)."""
+        if not hasattr(signal, 'SIGHUP'):
+            return
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_on_signal)
+
+    def _reload_on_signal(self):
+        async def reload():
+            try:
+                await self.reload()
+            except Exception:  # noqa: BLE001
+                logger.exception("Reloading configuration failed")
+        asyncio.ensure_future(reload())
+
     async def initialize(self):
         """Initialize the new instance."""
         if self.config:
             self.components = ComponentObjects(root=self, parent=self, config=self.config)
-            await self.components.initialize()
+            with timings.phase("instance.initialize"):
+                await self.components.initialize()
+        timings.report()
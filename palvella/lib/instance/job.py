@@ -12,10 +12,12 @@ class Job(Component, class_type="plugin_base"):
     Attributes:
         plugin_namespace: The namespace of this plugin module.
         actions:          A list of Action objects (mandatory).
+        hook_namespaces:  A job's 'triggers' name the triggers whose messages run it.
     """
 
     plugin_namespace = "palvella.plugins.lib.job"
     component_namespace = "jobs"
+    hook_namespaces = ("triggers",)
     actions = []
 
     #def run(self, **kwargs):
@@ -1,12 +1,148 @@
 """Defines messages for IPC."""
 
+import hashlib
 import json
+import os
 from dataclasses import dataclass
 from collections import UserList
+from collections.abc import Mapping
 
 from ..logging import makeLogger
 
 
+class JSONPayload(Mapping):
+    """
+    A read-only mapping over a raw JSON document, which is only parsed when it is read.
+
+    The raw bytes are kept as the canonical payload: encode() returns them unchanged,
+    so a payload received from a web request can be passed through a message queue
+    without being parsed or serialized again. Looking up a key (ex. when a hook filter
+    is compared against it) parses the document once.
+
+    Arguments:
+        raw:        The JSON document (bytes, bytearray, memoryview or str).
+    """
+
+    __slots__ = ('raw', '_data')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._data = None
+
+    def __repr__(self):
+        return f"{self.__class__}(CONCEALED)"
+
+    @property
+    def parsed(self):
+        """Return True if the document has been parsed."""
+        return self._data is not None
+
+    @property
+    def data(self):
+        """The parsed document."""
+        if self._data is None:
+            raw = self.raw
+            if isinstance(raw, memoryview):
+                raw = raw.tobytes()
+            self._data = json.loads(raw)
+        return self._data
+
+    def __getitem__(self, key):
+        if not isinstance(self.data, dict):
+            raise KeyError(key)
+        return self.data[key]
+
+    def __contains__(self, key):
+        return isinstance(self.data, dict) and key in self.data
+
+    def __iter__(self):
+        return iter(self.data) if isinstance(self.data, dict) else iter(())
+
+    def __len__(self):
+        return len(self.data) if isinstance(self.data, dict) else 0
+
+    def encode(self):
+        """Return the raw JSON document."""
+        if isinstance(self.raw, str):
+            return self.raw.encode()
+        return self.raw
+
+
+def project_payload(data, paths):
+    """
+    Return a copy of mapping *data* with only the values at *paths*.
+
+    Each path is a tuple of keys (ex. ('repository', 'url')). The value at the end of
+    a path is kept whole; paths not found in *data* are skipped. If *data* is not a
+    mapping, it is returned unchanged.
+    """
+    if not isinstance(data, Mapping):
+        return data
+    projected = {}
+    kept = set()
+    for path in sorted(set(paths), key=len):
+        if any(path[:i] in kept for i in range(1, len(path))):
+            continue  # A parent of this path is kept whole already
+        value = data
+        for k in path:
+            if not isinstance(value, Mapping) or k not in value:
+                break
+            value = value[k]
+        else:
+            dst = projected
+            for k in path[:-1]:
+                dst = dst.setdefault(k, {})
+            dst[path[-1]] = value
+            kept.add(path)
+    return projected
+
+
+def encode_payload(data):
+    """Return the bytes of a data item: the raw JSON of a JSONPayload(), or the JSON encoding of anything else."""
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    if isinstance(data, JSONPayload):
+        raw = data.encode()
+        return raw.tobytes() if isinstance(raw, memoryview) else raw
+    return json.dumps(data).encode()
+
+
+class PayloadStore:
+    """
+    Stores full message payloads in a directory, once per distinct content.
+
+    Each payload is written to a file named after the SHA-256 hash of its bytes, so a
+    message that only carries part of a payload can refer back to the whole of it.
+
+    Attributes:
+        path:       The directory to store payloads in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def put(self, data):
+        """Store data item *data* (if not stored already). Returns its SHA-256 hex digest."""
+        raw = encode_payload(data)
+        digest = hashlib.sha256(raw).hexdigest()
+        filename = os.path.join(self.path, digest)
+        if not os.path.exists(filename):
+            tmp = f"{filename}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(raw)
+            os.replace(tmp, filename)
+        return digest
+
+    def get(self, digest):
+        """Return the payload stored with *digest* as a JSONPayload()."""
+        with open(os.path.join(self.path, digest), "rb") as f:
+            return JSONPayload(f.read())
+
+
 @dataclass
 class Message:
     """
@@ -21,8 +157,14 @@ class Message:
         meta:                   A multi-dimensional dict of metadata about the
                                 event received.  Each key's value should be a dict.
         data:                   Payload data.
+
+    Attributes:
+        receipt:                Set by the message queue a message was consumed from, to
+                                acknowledge it with (see MessageQueue.ack()).
     """
 
+    receipt = None
+
     logger = makeLogger(__module__ + "/Message")
 
     @dataclass
@@ -80,8 +222,6 @@ class Message:
     class Data(UserList):
         """Keeps a list of data. Iterable."""
 
-        _ctr = 0
-
         def __init__(self, args=[]):
             assert ( isinstance(args, list) ), "Error: Data class argument must be a list"
             return super().__init__(args)
@@ -90,15 +230,7 @@ class Message:
             return f"{self.__class__}(CONCEALED)"
 
         def __iter__(self):
-            return self
-
-        def __next__(self):
-            self._ctr += 1
-            try:
-                return self.data[self._ctr-1]
-            except IndexError:
-                self._ctr = 0
-                raise StopIteration
+            return iter(self.data)
 
         def encode(self):
             """Return a binary encoding of the data array as a JSON blob.
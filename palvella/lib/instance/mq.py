@@ -1,11 +1,12 @@
 
 """The library for message queues. Defines plugin class and some base functions."""
 
+import asyncio
+import functools
 from dataclasses import dataclass
 
-from palvella.lib.instance import Component
+from palvella.lib.instance.component import Component
 from palvella.lib.instance.message import Message
-from palvella.lib.plugin import PluginDependency
 
 from ..logging import makeLogger, logging
 
@@ -43,6 +44,77 @@ class MessageQueue(Component, class_type="plugin_base"):
         cls.logger.info(f"consume(obj={obj}, args={args}, kwargs={kwargs})")
         return await MessageQueue.run_func(obj, *args, func="consume", **kwargs)
 
+    @classmethod
+    async def publish_many(cls, obj, messages):
+        """
+        Publish a list of Messages *messages* in a message queue.
+
+        Uses the 'run_func' function (of this class) to call the "publish_many" function of
+        MessageQueue components. Components that don't implement it have "publish" called
+        for each message.
+        """
+
+        cls.logger.info(f"publish_many(obj={obj}, messages=({len(messages)}))")
+        return await MessageQueue.run_func(obj, messages, func="publish_many")
+
+    @classmethod
+    async def consume_batch(cls, obj, max_n=100, max_wait=None):
+        """
+        Consume up to *max_n* messages from a queue. Returns MessageQueue.consume_batch()
+
+        Messages already waiting in the queue are returned without waiting. If there are none,
+        waits up to *max_wait* seconds (forever if None; not at all if 0) for one to arrive.
+        Components that don't implement it have "consume" called once.
+        """
+
+        cls.logger.info(f"consume_batch(obj={obj}, max_n={max_n}, max_wait={max_wait})")
+        return await MessageQueue.run_func(obj, func="consume_batch", max_n=max_n, max_wait=max_wait)
+
+    @classmethod
+    async def ack(cls, obj, messages):
+        """
+        Acknowledge a list of Messages *messages* consumed from a queue, so they aren't delivered again.
+
+        Uses the 'run_func' function (of this class) to call the "ack" function of MessageQueue
+        components. Components that don't deliver messages again (ex. 'zeromq') don't implement
+        it, and acknowledging does nothing.
+        """
+        return await MessageQueue.run_func(obj, messages, func="ack")
+
+    @classmethod
+    async def nack(cls, obj, messages, delay=0):
+        """
+        Return a list of Messages *messages* consumed from a queue, to be delivered again after *delay* seconds.
+
+        Like ack(), this does nothing for components that don't implement it.
+        """
+        return await MessageQueue.run_func(obj, messages, func="nack", delay=delay)
+
+    @staticmethod
+    async def _publish_many(component, messages):
+        """The "publish_many" of a component that only implements "publish"."""
+        return [await component.publish(x) for x in messages]
+
+    @staticmethod
+    async def _consume_batch(component, max_n=100, max_wait=None):
+        """The "consume_batch" of a component that only implements "consume"."""
+        if max_wait is None:
+            return [await component.consume()]
+        try:
+            return [await asyncio.wait_for(component.consume(), max_wait)]
+        except asyncio.TimeoutError:
+            return []
+
+    @staticmethod
+    async def _ack(component, messages):
+        """The "ack" of a component that doesn't implement it: there is nothing to acknowledge."""
+        return None
+
+    @staticmethod
+    async def _nack(component, messages, delay=0):
+        """The "nack" of a component that doesn't implement it: the messages can't be delivered again."""
+        return None
+
     @staticmethod
     async def run_func(obj, *args, func=None, **kwargs):
         """
@@ -54,24 +126,134 @@ class MessageQueue(Component, class_type="plugin_base"):
             args:               Positional arguments.
             kwargs:             key=value arguments.
 
-        All loaded components are scanned for a parent class MessageQueue. Of those,
-        if any of them have a *name* attribute, and it matches *obj.config_data['mq']*,
-        assume that component is the MessageQueue the object wants to run *func* on.
+        *obj.config_data['mq']* names the MessageQueue component(s) the object wants to run
+        *func* on: a name, or a list of names to run it on each of them concurrently (fan-out).
+        The names are looked up in the routing table of the Instance (see MessageQueueRoutes),
+        so this is a dict lookup and an await of each component's function. Consuming can't
+        be fanned out (see MessageQueueRoutes.resolve()).
         """
         results = []
 
         assert (func != None), f"Error: 'func' must not be None."
 
-        # Find all instances of components that match MessageQueue
-        plugin_dep = PluginDependency(parentclass="MessageQueue")
-        plugin_components = obj.get_component(plugin_dep)
+        # Nothing to do if the object isn't configured with a message queue
+        names = obj.config_data.get('mq')
+        if names is None:
+            return results
 
-        mq_objs = [x for x in plugin_components if x.name == obj.config_data['mq'] ]
-        for component in mq_objs:
-            if not hasattr(component, func):
-                raise Exception("object {component} does not have function {func}")
-            funcref = getattr(component, func)
-            obj.logger.debug(f"run_func: running {funcref}")
-            results.append( await funcref(*args, **kwargs) )
+        routes = obj.parent.mq_routes.route(names, func)
+        if len(routes) == 1:
+            results.append( await routes[0](*args, **kwargs) )
+        elif len(routes) > 1:
+            results += await asyncio.gather(*[x(*args, **kwargs) for x in routes])
 
         return results
+
+
+class MessageQueueRoutes:
+    """
+    A routing table from the names of MessageQueue components to their functions.
+
+    The first time a name (or list of names) is routed for a function, each MessageQueue
+    component with that name is resolved to its bound function, and the list is kept in
+    a dict. It is kept up to date by ComponentObjects, which calls add_instance() and
+    remove_instance() as components are initialized, reloaded, or stopped; any change to
+    the message queues throws away the resolved routes. A component can wait() for a queue
+    that hasn't been added yet.
+
+    Attributes:
+        parent:     The parent Instance() object.
+        queues:     A dict of {name: [MessageQueue()]} of the named MessageQueue components.
+    """
+
+    logger = makeLogger(__module__ + "/MessageQueueRoutes")
+
+    consume_funcs = ("consume", "consume_batch")
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.queues = {}
+        self._routes = {}  # (name or tuple of names, func): [bound function]
+        self._added = {}  # name: asyncio.Event() set when a queue with that name is added
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.queues)
+
+    def add_instance(self, instance):
+        """Add a component instance to the routing table, if it is a named MessageQueue."""
+        if not isinstance(instance, MessageQueue) or instance.name is None:
+            return
+        queues = self.queues.setdefault(instance.name, [])
+        if instance not in queues:
+            queues.append(instance)
+            self._routes.clear()
+        added = self._added.pop(instance.name, None)
+        if added is not None:
+            added.set()
+
+    def remove_instance(self, instance):
+        """Remove a component instance from the routing table."""
+        queues = self.queues.get(getattr(instance, 'name', None))
+        if queues is None or instance not in queues:
+            return
+        queues.remove(instance)
+        if len(queues) < 1:
+            del self.queues[instance.name]
+        self._routes.clear()
+
+    def invalidate(self, instances):
+        """Rebuild the routing table from a list of component *instances*."""
+        self.queues.clear()
+        self._routes.clear()
+        for instance in instances:
+            self.add_instance(instance)
+
+    async def wait(self, names):
+        """
+        Wait until there is a MessageQueue component with each of *names* (a name, or a list of names).
+
+        So a component can use a queue that is initialized after it, or that is being replaced
+        by a reload.
+        """
+        for name in ((names,) if isinstance(names, str) else names):
+            while name not in self.queues:
+                await self._added.setdefault(name, asyncio.Event()).wait()
+
+    def route(self, names, func):
+        """Return the list of bound functions *func* of the MessageQueue components named *names*."""
+        key = (names if isinstance(names, str) else tuple(names), func)
+        routes = self._routes.get(key)
+        if routes is None:
+            routes = self._routes[key] = self.resolve(key[0], func)
+        return routes
+
+    def resolve(self, names, func):
+        """
+        Resolve *names* (a name, or a tuple of names) to a list of the bound functions *func*
+        of the MessageQueue components with those names.
+
+        A component that doesn't implement "publish_many" or "consume_batch" gets the fallback
+        of its single-message function (see MessageQueue.publish_many()), and one that doesn't
+        implement "ack" or "nack" gets a function that does nothing.
+
+        Raises a ValueError if *names* resolve to more than one component for a function that
+        consumes: waiting on several queues at once would hold up the messages of the others
+        until every one of them had one.
+        """
+        routes = []
+        for name in ((names,) if isinstance(names, str) else names):
+            if name not in self.queues:
+                self.logger.warning(f"route: no message queue named '{name}'")
+            for component in self.queues.get(name, []):
+                if not hasattr(component, func):
+                    raise Exception(f"object {component} does not have function {func}")
+                funcref = getattr(component, func)
+                if getattr(funcref, '__self__', None) is not component:
+                    # Not implemented by the component (this is the MessageQueue classmethod);
+                    # use the fallback.
+                    funcref = functools.partial(getattr(MessageQueue, "_" + func), component)
+                routes.append(funcref)
+        if len(routes) > 1 and func in self.consume_funcs:
+            raise ValueError(f"route: can't {func} from more than one message queue (mq: {names!r})")
+        self.logger.debug(f"route: resolved {names} {func} to {routes}")
+        return routes
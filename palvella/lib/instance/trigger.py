@@ -1,9 +1,76 @@
 
 """The library for triggers. Defines plugin class and some base functions."""
 
+import asyncio
+import time
+from collections import OrderedDict
+
 from palvella.lib.instance import Component
+from palvella.lib.instance.hook import Dispatch
 from palvella.lib.instance.mq import MessageQueue, OperationError
-from palvella.lib.instance.message import Message
+from palvella.lib.instance.message import Message, PayloadStore, project_payload
+from palvella.lib.plugin import PluginDependency
+
+class DedupCache:
+    """
+    A bounded cache of the keys (ex. webhook delivery IDs) seen in the last 'ttl' seconds.
+
+    Keys are kept in least-recently-seen order, so expired keys and (when there are more
+    than 'maxsize') the oldest keys are dropped from the front. If 'db' is set to a DB
+    component, a key is also claimed in the database, so a key seen by another process
+    sharing the database is a duplicate too.
+
+    Attributes:
+        maxsize:        The most keys kept in memory.
+        ttl:            The number of seconds a key is remembered.
+        db:             A DB component implementing claim_key(), or None.
+        namespace:      The namespace of the keys claimed in 'db'.
+    """
+
+    def __init__(self, maxsize=10000, ttl=86400, db=None, namespace="dedup"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db = db
+        self.namespace = namespace
+        self._seen = OrderedDict()  # key: expiry time
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, {k: v for k, v in self.__dict__.items() if k != '_seen'})
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def _remember(self, key, now):
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        self._expire(now)
+
+    async def claim(self, key):
+        """Record *key*. Return True if it's new, or False if it was already seen within 'ttl' seconds."""
+        now = time.monotonic()
+        expires = self._seen.get(key)
+        if expires is not None and expires > now:
+            self._remember(key, now)
+            return False
+        if self.db is not None and not await self.db.claim_key(self.namespace, key, self.ttl):
+            self._remember(key, now)
+            return False
+        self._remember(key, now)
+        return True
+
+    async def release(self, key):
+        """Forget *key* (ex. if it could not be processed, so a retry is not a duplicate)."""
+        self._seen.pop(key, None)
+        if self.db is not None:
+            await self.db.release_key(self.namespace, key)
+
 
 class Trigger(Component, class_type="plugin_base"):
     """
@@ -12,13 +79,46 @@ class Trigger(Component, class_type="plugin_base"):
     Attributes:
         plugin_namespace:       The Python namespace of this plugin module.
         component_namespace:    The namespace in config files for plugins of this class.
+
+    Configuration:
+        hook_concurrency:       The most hook callbacks of this trigger that can run at
+                                once (default: no limit but the Instance's).
+        ingest:                 'inline' (default) to process each delivery before returning
+                                to its sender, or 'queue' to queue it for the ingest workers
+                                (see start_delivery()).
+        ingest_queue_size:      The most items the ingest queue can hold (default: 1000).
+        ingest_workers:         The number of tasks processing the ingest queue (default: 4).
+        dedup:                  false to not deduplicate deliveries (see start_delivery()).
+        dedup_size:             The most delivery IDs kept in memory (default: 10000).
+        dedup_ttl:              The seconds a delivery ID is remembered (default: 86400).
+        dedup_db:               The name of a DB component to share the delivery IDs in
+                                between processes (ex. sqlite3).
+        payload_store:          A directory to store the full payload of projected messages
+                                in (see project()).
+        consumers:              The number of tasks consuming the Message Queue, for a
+                                trigger that receives its messages from one (default: 1).
+        consumer_batch:         The most messages a consumer task takes at once (default: 100).
+        max_in_flight:          The most consumed messages whose hooks can be running at
+                                once (default: 1000).
+        nack_delay:             The seconds before a consumed message whose hooks failed is
+                                delivered again (default: 10).
     """
 
     name = None  # A default for child plugins
+    ingest_mode = "inline"
+    ingest_queue = None
+    dedup = None
+    payload_store = None
+    _hook_semaphore = None
+    _ingest_workers = ()
+    _consumers = ()
+    _in_flight = ()
 
     plugin_namespace = "palvella.plugins.lib.trigger"
     component_namespace = "triggers"
 
+    db_dependency = PluginDependency(parentclassname="DB")
+
     async def publish(self, *args, **kwargs):
         """Publish a trigger event to any Message Queues attached to 'self'."""
         ret = await MessageQueue.publish(self, *args, **kwargs)
@@ -29,7 +129,285 @@ class Trigger(Component, class_type="plugin_base"):
         ret = await MessageQueue.consume(self)
         return ret
 
-    async def trigger(self, *args, **kwargs):
+    async def publish_many(self, messages):
+        """Publish a list of trigger events to any Message Queues attached to 'self'."""
+        ret = await MessageQueue.publish_many(self, messages)
+        return ret
+
+    async def consume_batch(self, max_n=100, max_wait=None):
+        """
+        Consume up to *max_n* triggers from the Message Queue, waiting up to *max_wait* seconds
+        for the first if none are waiting. Returns a list of the Messages.
+
+        Raises an OperationError if no Message Queue has the name in the 'mq' configuration key.
+        """
+        ret = await MessageQueue.consume_batch(self, max_n=max_n, max_wait=max_wait)
+        if not ret and self.config_data.get('mq') is not None:
+            # Otherwise a caller would take "no queue" for "no messages"
+            raise OperationError(f"no message queue named {self.config_data['mq']!r} to consume from")
+        return [x for batch in ret for x in batch]
+
+    async def ack(self, messages):
+        """Acknowledge a list of triggers consumed from the Message Queue (see MessageQueue.ack())."""
+        ret = await MessageQueue.ack(self, messages)
+        return ret
+
+    async def nack(self, messages, delay=0):
+        """Return a list of triggers consumed from the Message Queue to it (see MessageQueue.nack())."""
+        ret = await MessageQueue.nack(self, messages, delay=delay)
+        return ret
+
+    def hook_semaphore(self):
+        """Return the semaphore limiting this trigger's running callbacks, or None if not configured."""
+        limit = self.config_data.get('hook_concurrency')
+        if limit is None:
+            return None
+        if self._hook_semaphore is None:
+            self._hook_semaphore = asyncio.Semaphore(int(limit))
+        return self._hook_semaphore
+
+    def start_ingest(self, maxsize=None, workers=None):
+        """
+        Create a bounded ingest queue and the worker tasks that process it.
+
+        A trigger that receives events (ex. a webhook) can ingest() them and return
+        to its caller right away; the workers then call trigger() for each item.
+        *maxsize* and *workers* default to the 'ingest_queue_size' and 'ingest_workers'
+        configuration keys.
+        """
+        if maxsize is None:
+            maxsize = self.config_data.get('ingest_queue_size', 1000)
+        if workers is None:
+            workers = self.config_data.get('ingest_workers', 4)
+        self.logger.debug(f"start_ingest(maxsize={maxsize}, workers={workers})")
+        self.ingest_queue = asyncio.Queue(int(maxsize))
+        self._ingest_workers = [asyncio.ensure_future(self._ingest_worker())
+                                for _ in range(int(workers))]
+
+    def ingest(self, func, *args, **kwargs):
+        """
+        Queue a call of coroutine function *func* with *args* and *kwargs* for an ingest worker.
+
+        Raises asyncio.QueueFull if the ingest queue is full.
+        """
+        self.ingest_queue.put_nowait((func, args, kwargs))
+
+    def start_delivery(self, namespace, dedup=True):
+        """
+        Set up receiving deliveries (ex. webhook requests) with deliver().
+
+        Starts the ingest queue if the 'ingest' configuration key is 'queue'. If *dedup* is
+        True (and the 'dedup' configuration key isn't false), deliveries are deduplicated on
+        their delivery IDs in a DedupCache, claiming them in *namespace* of the 'dedup_db'.
+        """
+        self.ingest_mode = self.config_data.get('ingest', self.ingest_mode)
+        if self.ingest_mode == "queue":
+            self.start_ingest()
+        elif self.ingest_mode != "inline":
+            raise ValueError(f"Invalid 'ingest' value '{self.ingest_mode}' (must be 'inline' or 'queue')")
+
+        if dedup and self.config_data.get('dedup', True):
+            self.dedup = DedupCache(maxsize=int(self.config_data.get('dedup_size', 10000)),
+                                    ttl=float(self.config_data.get('dedup_ttl', 86400)),
+                                    namespace=namespace)
+
+    def dedup_db(self):
+        """Return the DB component named by the 'dedup_db' configuration key, or None."""
+        name = self.config_data.get('dedup_db')
+        if name is None:
+            return None
+        for db in self.get_component(self.db_dependency):
+            if db.name == name or db.config_data.get('name') == name:
+                if not hasattr(db, 'claim_key'):
+                    raise ValueError(f"'dedup_db': DB component '{name}' can't claim keys (see DB)")
+                return db
+        raise ValueError(f"'dedup_db': could not find DB component '{name}'")
+
+    async def is_duplicate(self, delivery):
+        """Return True if *delivery* (a delivery ID) was already received."""
+        if self.dedup is None or not delivery:
+            return False
+        if self.dedup.db is None:
+            self.dedup.db = self.dedup_db()
+        return not await self.dedup.claim(delivery)
+
+    async def deliver(self, payload, meta, delivery=None):
+        """
+        Trigger the hooks of a delivery's *payload* with *meta*, or queue it for the ingest workers.
+
+        Returns True if it was queued, or False if it was triggered. If it couldn't be (ex.
+        asyncio.QueueFull is raised), delivery ID *delivery* is forgotten (see is_duplicate()),
+        so a retry of the delivery isn't a duplicate.
+        """
+        try:
+            if self.ingest_mode == "queue":
+                self.ingest(self.process_delivery, payload, meta)
+                return True
+            await self.trigger(meta=meta, data=[payload])
+            return False
+        except Exception:
+            if self.dedup is not None and delivery:
+                await self.dedup.release(delivery)
+            raise
+
+    async def process_delivery(self, payload, meta):
+        """Trigger the hooks of a queued delivery *payload*, waiting for them to complete."""
+        await self.trigger(meta=meta, data=[payload], wait=True)
+
+    async def _ingest_worker(self):
+        while True:
+            func, args, kwargs = await self.ingest_queue.get()
+            try:
+                await func(*args, **kwargs)
+            except Exception:  # noqa: BLE001
+                self.logger.exception("ingest: processing a queued item failed")
+            finally:
+                self.ingest_queue.task_done()
+
+    async def stop_ingest(self, timeout=10):
+        """Wait up to *timeout* seconds for the ingest queue to drain, then stop its workers."""
+        if self.ingest_queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.ingest_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"stop_ingest: dropping {self.ingest_queue.qsize()} queued items")
+        for task in self._ingest_workers:
+            task.cancel()
+        await asyncio.gather(*self._ingest_workers, return_exceptions=True)
+        self.ingest_queue, self._ingest_workers = None, ()
+
+    def start_consumers(self, consumers=None, batch=None, max_in_flight=None):
+        """
+        Start the tasks that consume triggers from the Message Queue and dispatch them to the hooks.
+
+        Each of *consumers* tasks waits on the message queue for up to *batch* messages at
+        a time (see consume_batch()), and starts a task dispatching each one (see receive()).
+        No more than *max_in_flight* messages are dispatched, or being waited for, at once;
+        when that many are, the consumers stop taking messages until some complete.
+        The defaults are the 'consumers', 'consumer_batch' and 'max_in_flight' configuration keys.
+
+        The consumers wait for the message queue named in the 'mq' configuration key if there
+        isn't one (see MessageQueueRoutes.wait()), so it can be initialized after this trigger,
+        or replaced by a reload while the trigger keeps running.
+        """
+        if self.config_data.get('mq') is None:
+            self.logger.warning(f"start_consumers: {self} has no 'mq' configured; not consuming")
+            return
+        if consumers is None:
+            consumers = self.config_data.get('consumers', 1)
+        if batch is None:
+            batch = self.config_data.get('consumer_batch', 100)
+        if max_in_flight is None:
+            max_in_flight = self.config_data.get('max_in_flight', 1000)
+        self.logger.debug(f"start_consumers(consumers={consumers}, batch={batch}, max_in_flight={max_in_flight})")
+        self._max_in_flight = int(max_in_flight)
+        self._in_flight = set()
+        self._reserved = 0  # Messages the consumers are waiting for
+        self._room = asyncio.Event()
+        self._room.set()
+        self._consumers = [asyncio.ensure_future(self._consumer(int(batch)))
+                           for _ in range(int(consumers))]
+
+    async def _consumer(self, batch):
+        while True:
+            await self.parent.mq_routes.wait(self.config_data['mq'])
+            await self._room.wait()
+            n = min(batch, self._max_in_flight - len(self._in_flight) - self._reserved)
+            if n < 1:
+                self._room.clear()
+                continue
+            self._reserved += n
+            try:
+                messages = await self.consume_batch(max_n=n)
+            except Exception:  # noqa: BLE001
+                self.logger.exception("consumer: consuming from the message queue failed")
+                messages = []
+            finally:
+                self._reserved -= n
+            if not messages:
+                # Only after an error; don't retry a failing message queue in a busy loop
+                await asyncio.sleep(1)
+            for message in messages:
+                task = asyncio.ensure_future(self.receive(message))
+                self._in_flight.add(task)
+                task.add_done_callback(self._received)
+
+    def _received(self, task):
+        self._in_flight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(f"consumer: dispatching a message failed: {task.exception()!r}")
+        if len(self._in_flight) + self._reserved < self._max_in_flight:
+            self._room.set()
+
+    async def receive(self, message):
+        """
+        Dispatch a Message *message* consumed from the Message Queue to the hooks, and wait for them.
+
+        The message is then acknowledged if every hook callback succeeded. If it couldn't be
+        dispatched, or a callback raised an exception, it is returned to the Message Queue to
+        be delivered again after 'nack_delay' seconds (for message queues that deliver messages
+        again; see MessageQueue.ack()). All of its hooks are run again then, so delivery to the
+        hooks is at-least-once.
+        """
+        nack_delay = float(self.config_data.get('nack_delay', 10))
+        try:
+            dispatch = await self.dispatch(message)
+            results = await dispatch.wait()
+        except Exception:
+            await self.nack([message], delay=nack_delay)
+            raise
+        failed = [x for x in results if isinstance(x, BaseException)]
+        if failed:
+            self.logger.error(f"consumer: {len(failed)} of {len(results)} hook callbacks failed "
+                              f"(first: {failed[0]!r}); returning the message to the queue")
+            await self.nack([message], delay=nack_delay)
+            return
+        await self.ack([message])
+
+    async def stop_consumers(self, timeout=10):
+        """Stop the consumer tasks, then wait up to *timeout* seconds for the messages they took to be dispatched."""
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = ()
+        if self._in_flight:
+            _, pending = await asyncio.wait(list(self._in_flight), timeout=timeout)
+            if pending:
+                self.logger.warning(f"stop_consumers: cancelling {len(pending)} messages in flight")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        self._in_flight = ()
+
+    async def project(self, message):
+        """
+        Return *message* with its data reduced to the fields its hooks read.
+
+        If every hook for this trigger declared its fields (see Hooks.register_hook()), each
+        data item is replaced by a copy with only those fields (and the ones the hooks' data
+        filters compare), and meta key 'payload' lists the fields kept. If the 'payload_store'
+        configuration key is set, each full data item is first stored there once by content
+        hash, and 'payload' lists the hashes. Otherwise (or if *message* was projected already)
+        *message* is returned unchanged.
+        """
+        fields = self.parent.hooks.fields_for(message)
+        if fields is None or "payload" in message.meta.__dict__:
+            return message  # Nothing to project, or projected already
+
+        payload = {"fields": sorted(".".join(x) for x in fields)}
+        if self.config_data.get('payload_store'):
+            if self.payload_store is None:
+                self.payload_store = PayloadStore(self.config_data['payload_store'])
+            loop = asyncio.get_running_loop()
+            payload["sha256"] = [await loop.run_in_executor(None, self.payload_store.put, x)
+                                 for x in message.data]
+
+        return Message(identity=dict(message.identity.__dict__),
+                       meta={**message.meta.__dict__, "payload": payload},
+                       data=[project_payload(x, fields) for x in message.data])
+
+    async def trigger(self, *args, wait=False, **kwargs):
         """
         Send a trigger to any registered callback functions.
 
@@ -37,6 +415,14 @@ class Trigger(Component, class_type="plugin_base"):
 
         *self*'s 'name', 'plugin_namespace', and 'plugin_type' attributes will be taken and used
         to prepend the message with an Identity Frame, identifying where the trigger originated.
+
+        The matching callbacks are started as tasks (see HookDispatcher), so one slow callback
+        doesn't hold up the others or the caller. Returns a Dispatch() of the callbacks; if
+        *wait* is True, waits for all of them to complete first. If the message was published
+        to a Message Queue instead, the Dispatch() is empty.
+
+        The message is reduced to the fields its hooks need (see project()) before it is
+        published or passed to the callbacks.
         """
 
         self.logger.info(f"trigger(self={self}, args=(CONCEALED), kwargs=(CONCEALED))")
@@ -50,18 +436,31 @@ class Trigger(Component, class_type="plugin_base"):
         else:
             raise Exception("Error: trigger() requires either a message argument or a key=value pair set")
 
-        # TODO: Only send a 'publish' if we are configured to send messages to a
-        #       Trigger message queue. Otherwise just do the below, running callback
-        #       functions within the current process.
-        try:
-            await self.publish(message)
-        except OperationError as e:
-            self.logger.exception(f"Tried to publish() but failed: {e}")
-            pass
+        message = await self.project(message)
 
-        # TODO: Finish implementing the logic here so that when 'github_webhook' sends
-        #       a trigger, it only calls the hooks which have a plugin_dep set for 'github_webhook'.
+        # If a Message Queue is configured, the trigger is published to it, and whatever
+        # consumes it dispatches it to the hooks (see start_consumers()). Otherwise (or if
+        # publishing fails) the hooks are run within the current process.
+        if self.config_data.get('mq') is not None:
+            try:
+                if await self.publish(message):
+                    return Dispatch([], [])
+            except OperationError as e:
+                self.logger.exception(f"Tried to publish() but failed: {e}")
 
-        for hook, component_instance in self.parent.hooks.match_hook_from_msg(message):
-            self.logger.debug(f"matching hook {hook} component_instance {component_instance}")
-            await hook.callback(hook, component_instance, message)
+        return await self.dispatch(message, wait=wait)
+
+    async def dispatch(self, message, wait=False):
+        """
+        Start the callbacks of the hooks matching Message *message*, in this process.
+
+        If as many callbacks as the limits allow are running (see HookDispatcher and the
+        'hook_concurrency' configuration key), waits until there is room to start them.
+        Returns a Dispatch() of the callbacks; if *wait* is True, waits for all of them to
+        complete first.
+        """
+        dispatch = await self.parent.hooks.dispatch(message, semaphore=self.hook_semaphore())
+        self.logger.debug(f"dispatched {len(dispatch.futures)} hook callbacks")
+        if wait:
+            await dispatch.wait()
+        return dispatch
@@ -2,18 +2,32 @@
 """A module that defines a base class for plugins."""
 
 import importlib
+import importlib.util
+import json
+import os
 import pkgutil
-from functools import lru_cache
+import sys
 from collections import defaultdict
 from dataclasses import dataclass
 
 import graphlib  # our poetry requirements include the 'graphlib_backport' module
 
 from .logging import makeLogger
+from .timing import timings
 
 
 logger = makeLogger(__name__)
 
+# Where to keep the plugin discovery manifest between runs. Set to an empty
+# string to disable the manifest and always scan the plugin namespaces.
+PLUGIN_MANIFEST = os.environ.get('PLUGIN_MANIFEST', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'palvella', 'plugin-manifest.json'))
+
+# How to load plugin modules. "all" imports every module in every plugin namespace;
+# "lazy" only imports the plugins named in the configuration (and what they depend on).
+PLUGIN_LOADING = os.environ.get('PLUGIN_LOADING', 'all')
+
 
 class Plugin:
     """The base class for plugins. Inherit this to make a new plugin class."""
@@ -54,10 +68,11 @@ class PluginDependency:
     plugin_type = None
     component_namespace = None
     def __init__(self, **kwargs):
-        for k in ("classname", "parentclassname", "plugin_type","component_namespace"):
-            if k in kwargs:
-                if type(kwargs[k]) != type(""):
-                    raise Exception("Error: type(%s) must be type %s" % (k, type("")) )
+        for k in kwargs:
+            if k not in ("classname", "parentclassname", "plugin_type", "component_namespace"):
+                raise Exception("Error: unknown PluginDependency attribute '%s'" % k)
+            if type(kwargs[k]) != type(""):
+                raise Exception("Error: type(%s) must be type %s" % (k, type("")) )
         self.__dict__.update(kwargs)
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
@@ -77,40 +92,221 @@ def match_class_dependencies(self, objects, deps):
        'deps' is a list of PluginDepency() instances.
 
        Returns the matching classes/instances.
+
+       This indexes *objects* on every call; to match against the same objects
+       repeatedly, keep a PluginRegistry() of them instead.
+    """
+    return PluginRegistry(objects).match(deps)
+
+
+class PluginRegistry:
+    """
+    An index of classes (or instances of classes) to match PluginDependency()s against.
+
+    Keeps a dict index of the objects by class name, parent class name, 'plugin_type'
+    and 'component_namespace', so match() only looks at the objects in the smallest
+    index entry for a dependency rather than at every object. Results are returned in
+    the order the objects were added.
+
+    The registry does not watch anything; call add()/remove() as objects come and go,
+    or invalidate() to rebuild it from a list of objects.
+    """
+
+    def __init__(self, objects=None):
+        self.clear()
+        for obj in objects or []:
+            self.add(obj)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, list(self._objects))
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, obj):
+        return obj in self._objects
+
+    def clear(self):
+        """Remove all objects from the registry."""
+        self._objects = {}
+        self._index = {k: defaultdict(dict) for k in
+                       ("classname", "parentclassname", "plugin_type", "component_namespace")}
+
+    def invalidate(self, objects):
+        """Throw away the indexes and rebuild them from *objects*."""
+        self.clear()
+        for obj in objects:
+            self.add(obj)
+
+    @staticmethod
+    def _keys(obj):
+        """Yield an (index name, key) tuple for each index *obj* should be in."""
+        cls = get_class(obj)
+        yield "classname", cls.__name__
+        for parent in cls.__bases__:
+            yield "parentclassname", parent.__name__
+        yield "plugin_type", getattr(obj, 'plugin_type', None)
+        yield "component_namespace", getattr(obj, 'component_namespace', None)
+
+    def add(self, obj):
+        """Add a class or instance to the registry."""
+        if obj in self._objects:
+            return
+        self._objects[obj] = None
+        for name, key in self._keys(obj):
+            self._index[name][key][obj] = None
+
+    def remove(self, obj):
+        """Remove a class or instance from the registry."""
+        if obj not in self._objects:
+            return
+        del self._objects[obj]
+        for name, key in self._keys(obj):
+            entry = self._index[name].get(key)
+            if entry is not None:
+                entry.pop(obj, None)
+                if len(entry) < 1:
+                    del self._index[name][key]
+
+    def match(self, deps):
+        """Return the objects matching any of the PluginDependency()s in *deps*."""
+        results = []
+        for dep in deps:
+            entries = [self._index[name].get(getattr(dep, name), {}) for name in self._index
+                       if getattr(dep, name) is not None]
+            if len(entries) < 1:
+                results += self._objects
+                continue
+            entries.sort(key=len)
+            results += [obj for obj in entries[0] if all(obj in x for x in entries[1:])]
+        return results
+
+
+def class_id(cls):
+    """Return a string that identifies a class across processes ('module:qualname')."""
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+class PluginManifest:
     """
-    # Wrap the list arguments with tuples so that it's hashable for @lru_cache
-    return match_class_dependencies_wrapper(self, tuple(objects), tuple(deps))
-
-@lru_cache
-def match_class_dependencies_wrapper(self, objects, deps):
-    """Implementation of match_class_dependencies()"""
-    def matchParentClass(self, objects, dep):
-        for match in objects:
-            for parent in get_class(match).__bases__:
-                if dep.parentclassname == parent.__name__:
-                    yield match
-    def matchClass(self, objects, dep):
-        for obj in [x for x in objects if x.__name__ == dep.classname]:
-            yield obj
-    def matchPluginType(self, objects, dep):
-        for obj in [x for x in objects if x.plugin_type == dep.plugin_type]:
-            yield obj
-    def matchComponentNs(self, objects, dep):
-        for obj in [x for x in objects if x.component_namespace == dep.component_namespace]:
-            yield obj
-    results = []
-    for dep in deps:
-        matches = objects[:]
-        if dep.classname != None:
-            matches = matchClass(self, matches, dep)
-        if dep.parentclassname != None:
-            matches = matchParentClass(self, matches, dep)
-        if dep.plugin_type != None:
-            matches = matchPluginType(self, matches, dep)
-        if dep.component_namespace != None:
-            matches = matchComponentNs(self, matches, dep)
-        results += matches
-    return results
+    An on-disk record of the result of a WalkPlugins() run.
+
+    Stores the plugin modules found in each plugin namespace, the classes they define
+    (with their 'class_type', 'plugin_type', 'component_namespace', 'plugin_namespace'
+    and 'depends_on'), the class graph and its topological order. Along with that it
+    keeps the mtime and size of every module file and namespace directory that went
+    into the result (including the modules of the classes' base classes, ex. the ones
+    in palvella.lib.instance), so a later run can tell if the manifest is still current
+    without importing or scanning anything.
+
+    Attributes:
+        path:           The file the manifest is loaded from and saved to.
+        namespaces:     A dict of plugin namespace -> list of module names.
+        files:          A dict of file path -> [mtime_ns, size].
+        classes:        A list of dicts describing each class, in discovery order.
+        class_graph:    A list of [class id, [class ids it depends on]].
+        topo_order:     A list of class ids, topologically sorted.
+    """
+
+    version = 2
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.namespaces = {}
+        self.files = {}
+        self.classes = []
+        self.class_graph = []
+        self.topo_order = []
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.path)
+
+    @staticmethod
+    def stat_file(path):
+        """Return [mtime_ns, size] of a file, or None if it can't be read."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    def add_namespace(self, module, names):
+        """Record a namespace *module* and the plugin module *names* found in it."""
+        self.namespaces[module.__name__] = list(names)
+        for path in list(module.__path__) + [getattr(module, '__file__', None)]:
+            if path is not None:
+                self.files[path] = self.stat_file(path)
+        for name in names:
+            spec = importlib.util.find_spec(name)
+            if spec is not None and spec.origin is not None:
+                self.files[spec.origin] = self.stat_file(spec.origin)
+
+    def is_current(self):
+        """Return True if every file recorded in the manifest is unchanged."""
+        if len(self.files) < 1:
+            return False
+        for path, stat in self.files.items():
+            if stat is None or self.stat_file(path) != stat:
+                return False
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """Load a manifest from *path*. Returns None if there is no usable manifest there."""
+        if not path:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Could not load plugin manifest '{path}': {e}")
+            return None
+        if not isinstance(data, dict) or data.pop("version", None) != cls.version:
+            return None
+        return cls(path, **data)
+
+    def save(self):
+        """Write the manifest to 'self.path' (atomically). Failures are logged and ignored."""
+        if not self.path:
+            return
+        data = {"version": self.version, "namespaces": self.namespaces, "files": self.files,
+                "classes": self.classes, "class_graph": self.class_graph,
+                "topo_order": self.topo_order}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write plugin manifest '{self.path}': {e}")
+
+    def record_classes(self, classes, class_graph, topo_order):
+        """Record the classes, class graph and topological order of a WalkPlugins() run."""
+        for cls in classes:
+            for base in cls.__mro__:
+                path = getattr(sys.modules.get(base.__module__), '__file__', None)
+                if path is not None and path not in self.files:
+                    self.files[path] = self.stat_file(path)
+        self.classes = [
+            {"id": class_id(cls), "class_type": cls.class_type,
+             "plugin_type": getattr(cls, 'plugin_type', None),
+             "plugin_namespace": cls.plugin_namespace,
+             "component_namespace": cls.component_namespace,
+             "depends_on": [dict(vars(dep)) for dep in cls.depends_on]}
+            for cls in classes]
+        self.class_graph = [[class_id(k), [class_id(x) for x in v]] for k, v in class_graph.items()]
+        self.topo_order = [class_id(x) for x in topo_order]
+
+    @staticmethod
+    def resolve_class(cid):
+        """Return the class for a class id, importing its module if needed."""
+        module_name, _, qualname = cid.partition(":")
+        obj = importlib.import_module(module_name)
+        for attr in qualname.split("."):
+            obj = getattr(obj, attr)
+        return obj
 
 
 @dataclass(unsafe_hash=True)
@@ -120,6 +316,9 @@ class WalkPlugins:
 
     Arguments:
         baseclass:      A class to walk subclasses of and build a plugin graph of.
+        lazy:           If True, only import the modules in the plugin namespace of
+                        *baseclass*. Plugin modules are then imported on demand by
+                        load_config_plugins().
 
     Attributes:
         classes:        A list of classes discovered
@@ -139,17 +338,91 @@ class WalkPlugins:
     # import, so we don't go over them again and again unnecessarily.
     searched_module_ns = []
 
+    # An index of 'classes', kept up to date as classes are discovered
+    registry = PluginRegistry()
+
+    # The PluginManifest this walk was loaded from or is being recorded into
+    manifest = None
+
+    # The topological order of 'class_graph', if it was loaded from the manifest
+    _topo_order = None
+
+    # The first WalkPlugins() of each (baseclass, lazy), so each walk is only done once
+    _walks = {}
+
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
 
-    @lru_cache
-    def __init__(self, baseclass):
+    def __init__(self, baseclass, lazy=False):
+        self.baseclass = baseclass
+        self.lazy = lazy
+        walk = self._walks.get((baseclass, lazy))
+        if walk is not None:
+            self.manifest = walk.manifest
+            return
+        self._walks[(baseclass, lazy)] = self
+        self.walk_plugins()
+
+    def walk_plugins(self):
+        """Find the plugin classes of 'self.baseclass', from the manifest if it's current."""
+        baseclass = self.baseclass
+        manifest = PluginManifest.load(PLUGIN_MANIFEST)
+
+        if self.lazy:
+            # A lazy walk is only a partial view of the plugins, so it must not overwrite
+            # the manifest; a current manifest is still used to find plugin modules.
+            if manifest is not None and manifest.is_current():
+                self.manifest = manifest
+            self.walk_subclass(baseclass)
+            self.registry.invalidate(self.classes)
+            self.add_graph_dependencies()
+            return
+
+        if manifest is not None and manifest.is_current() and self.load_manifest(manifest):
+            self.logger.debug(f"Loaded plugins from manifest {manifest}")
+            self.manifest = manifest
+            return
+
+        self.manifest = PluginManifest(PLUGIN_MANIFEST)
         self.walk_subclass(baseclass)
+        self.registry.invalidate(self.classes)
         self.add_graph_dependencies()
+        self.manifest.record_classes(self.classes, self.class_graph, self.topo_sort())
+        self.manifest.save()
+
+    def load_manifest(self, manifest):
+        """
+        Load 'classes' and 'class_graph' from a PluginManifest() instead of walking the plugins.
+
+        Only the modules recorded in the manifest are imported; the plugin namespaces are
+        not scanned and the class graph is not rebuilt. Returns False if the manifest
+        refers to a module or class that can no longer be found.
+        """
+        try:
+            for namespace, names in manifest.namespaces.items():
+                importlib.import_module(namespace)
+                for name in names:
+                    with timings.phase("import", name):
+                        importlib.import_module(name)
+            classes = {x["id"]: PluginManifest.resolve_class(x["id"]) for x in manifest.classes}
+            class_graph = {classes[k]: [classes[x] for x in v] for k, v in manifest.class_graph}
+            topo_order = tuple(classes[x] for x in manifest.topo_order)
+        except (ImportError, AttributeError, KeyError) as e:
+            self.logger.debug(f"Plugin manifest {manifest} is stale: {e}")
+            return False
+
+        self.classes += classes.values()
+        self.registry.invalidate(self.classes)
+        self.class_graph.update(class_graph)
+        self.searched_module_ns += list(manifest.namespaces)
+        self._topo_order = topo_order
+        return True
 
     def topo_sort(self, graph=None):
         """Return a topologically sorted tuple of the graph of classes."""
         if graph == None:
+            if self._topo_order is not None:
+                return self._topo_order
             graph = self.class_graph
         ts = graphlib.TopologicalSorter(graph)
         return tuple(ts.static_order())
@@ -159,7 +432,7 @@ class WalkPlugins:
         for cls in self.classes:
             if len(cls.depends_on) < 1:
                 continue
-            for _class in match_class_dependencies(self, self.classes, cls.depends_on):
+            for _class in self.registry.match(cls.depends_on):
                 if not _class in self.class_graph[cls]:
                     self.class_graph[cls].append(_class)
 
@@ -171,7 +444,8 @@ class WalkPlugins:
         Stores a graph of class dependencies in 'self.class_graph'.
         """
         #self.logger.debug(f"  walk_subclass(self, {cls})")
-        self.load_plugin_modules(cls)
+        if not self.lazy or cls is self.baseclass:
+            self.load_plugin_modules(cls)
         self.classes += [cls]
         #self.logger.debug(f"  appended to self.classes {self.classes}")
         subclasses = cls.__subclasses__()
@@ -203,6 +477,110 @@ class WalkPlugins:
                 yield
             else:
                 module = importlib.import_module(cls.plugin_namespace)
+                names = []
                 for _finder, name, _ispkg in pkgutil.iter_modules(module.__path__, module.__name__ + "."):
-                    yield name, importlib.import_module(name)
+                    names.append(name)
+                    with timings.phase("import", name):
+                        plugin_module = importlib.import_module(name)
+                    yield name, plugin_module
                 self.searched_module_ns.append(cls.plugin_namespace)
+                if self.manifest is not None and not self.lazy:
+                    self.manifest.add_namespace(module, names)
+
+    def load_config_plugins(self, data):
+        """
+        Import the plugin modules needed by configuration *data*, if this is a lazy walk.
+
+        Finds every 'component_namespace: plugin_type' pair in *data* (at any depth, so
+        the actions of a job count too, but not the plugins its hooks match; see
+        find_config_plugins()), imports the modules that provide those plugins, and then
+        keeps importing modules until every 'depends_on' of the loaded plugins is satisfied.
+        The classes and class graph are rebuilt afterwards.
+        """
+        if not self.lazy:
+            return
+
+        wanted = [PluginDependency(component_namespace=ns, plugin_type=t)
+                  for ns, t in self.find_config_plugins(data)]
+        while True:
+            missing = [dep for dep in wanted if len(self.registry.match([dep])) < 1]
+            if len(missing) < 1:
+                break
+            imported = False
+            for dep in missing:
+                for name in self.find_plugin_modules(dep):
+                    if name not in sys.modules:
+                        self.logger.debug(f"Importing plugin module {name} for {dep}")
+                        with timings.phase("import", name):
+                            importlib.import_module(name)
+                        imported = True
+            if not imported:
+                self.logger.debug(f"No plugin modules found for {missing}")
+                break
+            self.rewalk()
+            wanted += [dep for cls in self.classes for dep in cls.depends_on if dep not in wanted]
+
+    def rewalk(self):
+        """Rebuild 'classes' and 'class_graph' from the classes imported so far."""
+        self.classes.clear()
+        self.class_graph.clear()
+        self._topo_order = None
+        self.walk_subclass(self.baseclass)
+        self.registry.invalidate(self.classes)
+        self.add_graph_dependencies()
+
+    def find_config_plugins(self, data, skip=()):
+        """
+        Yield a (component_namespace, plugin_type) tuple for each plugin named in config *data*.
+
+        The sections of a plugin's configuration named in the 'hook_namespaces' of its plugin
+        base class (ex. the 'triggers' of a job) only name the plugins whose messages its hooks
+        match, so the plugins in them are not yielded. *skip* is the list of those sections
+        for the plugin whose configuration *data* is. Nor is a string value (ex. 'mq: "queue"'
+        in a trigger), which is the name of a component, not a plugin type.
+        """
+        bases = {x.component_namespace: x for x in self.classes if x.class_type == "plugin_base"}
+        if isinstance(data, dict):
+            for k, v in data.items():
+                if k in skip:
+                    continue
+                if k not in bases:
+                    yield from self.find_config_plugins(v, skip)
+                    continue
+                if isinstance(v, dict):
+                    for plugin_type in v:
+                        yield k, plugin_type
+                yield from self.find_config_plugins(v, getattr(bases[k], 'hook_namespaces', ()))
+        elif isinstance(data, list):
+            for item in data:
+                yield from self.find_config_plugins(item, skip)
+
+    def find_plugin_modules(self, dep):
+        """
+        Return the names of the modules that may provide a plugin matching PluginDependency *dep*.
+
+        Looks the plugin up in the manifest if there is a current one. Otherwise assumes
+        the module is named after the 'plugin_type' in the plugin namespace of its plugin
+        base class, and if there is no such module, falls back to every module in that
+        plugin namespace.
+        """
+        bases = [x for x in self.classes if x.class_type == "plugin_base"
+                 and dep.component_namespace in (None, x.component_namespace)
+                 and dep.parentclassname in (None, x.__name__)]
+        names = []
+        for base in bases:
+            if self.manifest is not None:
+                names += [x["id"].partition(":")[0] for x in self.manifest.classes
+                          if x["class_type"] == "plugin"
+                          and x["plugin_namespace"] == base.plugin_namespace
+                          and dep.plugin_type in (None, x["plugin_type"])]
+            elif dep.plugin_type is not None:
+                name = f"{base.plugin_namespace}.{dep.plugin_type}"
+                if importlib.util.find_spec(name) is not None:
+                    names.append(name)
+        if len(names) < 1:
+            for base in bases:
+                module = importlib.import_module(base.plugin_namespace)
+                names += [name for _finder, name, _ispkg
+                          in pkgutil.iter_modules(module.__path__, module.__name__ + ".")]
+        return names
@@ -0,0 +1,100 @@
+"""
+The startup timing library. Records how long each phase of starting an Instance takes.
+
+If environment variable 'STARTUP_TIMING' is '1' (as with 'DEBUG'; see palvella.lib.logging),
+the wall time and memory allocated (as seen by 'tracemalloc') by each phase are recorded:
+importing each plugin module, loading and parsing the configuration, validating its schema
+(as a whole, and each section), loading each component's default configuration, and running
+each component's '__pre_plugins__'.
+
+When the Instance is initialized, a report sorted by wall time is logged, and the
+phases are written as JSON to the file in environment variable 'STARTUP_TIMING_FILE'
+(default: 'startup-timing.json').
+"""
+
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+from .logging import makeLogger
+
+STARTUP_TIMING = os.environ.get('STARTUP_TIMING', '0')
+STARTUP_TIMING_FILE = os.environ.get('STARTUP_TIMING_FILE', 'startup-timing.json')
+
+logger = makeLogger(__name__)
+
+
+class StartupTimings:
+    """
+    Collects the timing of startup phases.
+
+    Attributes:
+        enabled:    If False, phase() does nothing.
+        path:       The file to write the JSON report to.
+        phases:     A list of dicts, one per recorded phase.
+    """
+
+    def __init__(self, enabled=False, path=None):
+        self.enabled = enabled
+        self.path = path
+        self.phases = []
+        self.reported = False
+        self._start = time.perf_counter()
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def phase(self, phase, name=None):
+        """
+        Return a context manager that records the time and memory taken by its body.
+
+        Arguments:
+            phase:      The kind of phase (ex. "import", "config.validate").
+            name:       What the phase was run for (ex. a module or class name).
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(phase, name)
+
+    @contextmanager
+    def _phase(self, phase, name):
+        memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({
+                "phase": phase,
+                "name": name,
+                "start": start - self._start,
+                "seconds": time.perf_counter() - start,
+                "memory": tracemalloc.get_traced_memory()[0] - memory,
+            })
+
+    def report(self):
+        """Log the phases sorted by wall time, and write them to 'self.path' as JSON."""
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+
+        phases = sorted(self.phases, key=lambda x: x["seconds"], reverse=True)
+        total = time.perf_counter() - self._start
+        lines = [f"Startup timing ({total:.3f}s total, {len(phases)} phases):"]
+        for x in phases:
+            lines.append(f"  {x['seconds'] * 1000:10.2f} ms {x['memory'] / 1024:10.1f} KiB"
+                         f"  {x['phase']:<24} {x['name'] or ''}")
+        logger.info("\n".join(lines))
+
+        if self.path:
+            try:
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump({"total_seconds": total, "phases": phases}, f, indent=2, default=str)
+            except OSError as e:
+                logger.warning(f"Could not write startup timing file '{self.path}': {e}")
+
+
+timings = StartupTimings(enabled=(STARTUP_TIMING == "1"), path=STARTUP_TIMING_FILE)
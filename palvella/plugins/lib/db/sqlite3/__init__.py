@@ -1,7 +1,10 @@
 
 """The plugin for the Database 'sqlite3'. Defines plugin class and some base functions."""
 
+import asyncio
 import sqlite3  # noqa
+import threading
+import time
 
 from palvella.lib.instance.db import DB
 
@@ -16,14 +19,29 @@ class SQLite3DB(DB, class_type="plugin", plugin_type=PLUGIN_TYPE):
         type            - The name of the type of this database.
         conn            - The handle of a live connection to the database.
         cursor          - The SQLite3 cursor (from 'conn')
+
+    Configuration:
+        db_path:            The path of the database file.
+        prune_interval:     The least seconds between deleting the expired keys of
+                            claim_key() (default: 60).
     """
 
     conn = None
     cursor = None
+    init_in_executor = True  # connect() blocks on disk I/O
 
     def __pre_plugins__(self):
+        self._lock = threading.Lock()
+        self.prune_interval = float(self.config_data.get('prune_interval', 60))
+        self._next_prune = 0
         self.connect()
 
+    def __stop_plugins__(self):
+        """Close the connection to the database."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = self.cursor = None
+
     def connect(self):
         """Establish a connection to the SQLite3 database."""
         self.conn = sqlite3.connect(self.config_data['db_path'], check_same_thread=False)
@@ -55,3 +73,38 @@ class SQLite3DB(DB, class_type="plugin", plugin_type=PLUGIN_TYPE):
                         name TEXT
                     ) """
             self.cursor.execute(sql)
+        if not self.table_exists("claimed_keys"):
+            sql = """ CREATE TABLE IF NOT EXISTS claimed_keys(
+                        namespace TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        expires REAL NOT NULL,
+                        PRIMARY KEY (namespace, key)
+                    ) """
+            self.cursor.execute(sql)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS claimed_keys_expires ON claimed_keys(expires)")
+
+    def _claim_key(self, namespace, key, ttl):
+        now = time.time()
+        with self._lock, self.conn:
+            if now >= self._next_prune:
+                # Keys that are never claimed again would otherwise be kept forever
+                self.conn.execute("DELETE FROM claimed_keys WHERE expires <= ?", (now,))
+                self._next_prune = now + self.prune_interval
+            else:
+                self.conn.execute("DELETE FROM claimed_keys WHERE namespace = ? AND key = ? AND expires <= ?",
+                                  (namespace, key, now))
+            res = self.conn.execute("INSERT OR IGNORE INTO claimed_keys(namespace, key, expires) VALUES (?, ?, ?)",
+                                    (namespace, key, now + ttl))
+            return res.rowcount == 1
+
+    def _release_key(self, namespace, key):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM claimed_keys WHERE namespace = ? AND key = ?", (namespace, key))
+
+    async def claim_key(self, namespace, key, ttl):
+        """Claim *key* with 'INSERT OR IGNORE', so only one process (sharing the database file) gets it."""
+        return await asyncio.get_running_loop().run_in_executor(None, self._claim_key, namespace, key, ttl)
+
+    async def release_key(self, namespace, key):
+        """Release a claim on *key* in *namespace* made by claim_key()."""
+        await asyncio.get_running_loop().run_in_executor(None, self._release_key, namespace, key)
@@ -7,27 +7,263 @@ FastAPI() object instance.
 
 After all plugins are loaded, Palvella will run the 'plugin_init' function in
 this plugin, which will start the Uvicorn server.
+
+The server listens on the 'host' and 'port' configuration keys. Requests pass
+through AdmissionControl first, which limits how many are handled at once (overall
+and per path) and sheds the excess with fast 429/503 responses, configured by the
+'admission' configuration key (see config.yaml).
+
+If the 'workers' configuration key is more than 0, this process doesn't serve HTTP
+itself. It starts that many worker processes instead, which each run an Instance
+from the configuration file in 'worker_config' and share the listening socket
+(with SO_REUSEPORT). The worker configuration would have the webhook triggers,
+configured with an 'mq' to forward their events to; this process, with the jobs,
+consumes them (ex. with the 'receive_all' trigger). That 'mq' can't be a 'memory'
+queue, which only passes messages within a process (see samples/fastapi-workers).
+Workers that exit are logged and started again. HTTP parsing and signature
+checks then run on as many cores as there are workers, and running jobs doesn't
+slow down accepting webhooks. Set 'reuse_port' to share the socket with other
+processes started some other way.
 """
 
 import asyncio
+import atexit
+import math
+import multiprocessing
 import os
+import signal
+import socket
+import time
 from dataclasses import dataclass
+from http import HTTPStatus
 
 # These are later imported by other plugins
 from fastapi import (APIRouter, FastAPI, Request,  # noqa: F401,PLW406,PLW611
                      Response)
+from starlette.responses import JSONResponse
 
+from palvella.lib.instance.config import loadYamlFile
 from palvella.lib.instance.frontend import Frontend
+from palvella.lib.logging import makeLogger
+from palvella.lib.instance.message import JSONPayload
 
 
 ASGI_SERVER_TYPE = os.environ.get("ASGI_SERVER_TYPE", "uvicorn")
 PLUGIN_TYPE = "fastapi"
 
+logger = makeLogger(__name__)
+
+
+class Rejected(Exception):
+    """Raise when a request is not admitted. Has the HTTP *status* and *retry_after* seconds to respond with."""
+    def __init__(self, status, retry_after, reason):
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+        super().__init__(reason)
+
+
+class Limiter:
+    """
+    Limits the requests admitted for one scope (all requests, or the requests for one path).
+
+    Requests first take a token from a token bucket refilled at 'rate' per second (if
+    'rate' is set), which holds 'burst' tokens (default: 'rate'; at least 1, or a 'rate'
+    below 1 would never admit a request); when it's empty they are rejected with 429. Then, if 'max_concurrency'
+    requests are already in flight, they wait in a backlog of at most 'max_backlog'
+    requests for up to 'backlog_timeout' seconds; past either, they are rejected with 503.
+
+    Attributes:
+        in_flight:      The number of requests admitted and not yet released.
+        waiting:        The number of requests waiting in the backlog.
+        admitted:       The number of requests admitted.
+        rejected:       A dict of the number of requests rejected, by reason.
+    """
+
+    def __init__(self, max_concurrency=0, max_backlog=0, backlog_timeout=10, rate=0, burst=0):
+        self.max_concurrency = int(max_concurrency or 0)
+        self.max_backlog = int(max_backlog or 0)
+        self.backlog_timeout = float(backlog_timeout)
+        self.rate = float(rate or 0)
+        self.burst = max(1.0, float(burst or 0) or self.rate)
+        self.tokens = self.burst
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {"rate": 0, "backlog": 0, "timeout": 0}
+        self._last = time.monotonic()
+        self._semaphore = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def semaphore(self):
+        # Created on first use, so it belongs to the running event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def take_token(self):
+        """Take a token from the bucket, or raise Rejected (429) if it's empty."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self.tokens < 1:
+            self.rejected["rate"] += 1
+            raise Rejected(429, math.ceil((1 - self.tokens) / self.rate), "rate limit exceeded")
+        self.tokens -= 1
+
+    async def acquire(self):
+        """Admit a request, waiting in the backlog if needed. Raises Rejected if it's not admitted."""
+        if self.rate:
+            self.take_token()
+        if self.max_concurrency:
+            sem = self.semaphore()
+            if sem.locked():
+                if self.waiting >= self.max_backlog:
+                    self.rejected["backlog"] += 1
+                    raise Rejected(503, 1, "backlog is full")
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(sem.acquire(), self.backlog_timeout)
+                except asyncio.TimeoutError:
+                    self.rejected["timeout"] += 1
+                    raise Rejected(503, 1, "timed out in backlog")
+                finally:
+                    self.waiting -= 1
+            else:
+                await sem.acquire()
+        self.in_flight += 1
+        self.admitted += 1
+
+    def release(self):
+        """Release a request admitted by acquire()."""
+        self.in_flight -= 1
+        if self.max_concurrency:
+            self.semaphore().release()
+
+    def stats(self):
+        """Return a dict of the counters of this limiter."""
+        return {"in_flight": self.in_flight, "waiting": self.waiting, "admitted": self.admitted,
+                "rejected": dict(self.rejected), "max_concurrency": self.max_concurrency,
+                "max_backlog": self.max_backlog, "rate": self.rate}
+
+
+class AdmissionControl:
+    """
+    ASGI middleware that admits HTTP requests through a global Limiter, and a Limiter per path.
+
+    A request for a path configured in 'paths' (or a path under it) has to be admitted by
+    that path's Limiter first, and then by the global one, so a burst on one path waits in
+    its own backlog without taking up slots of the others. Rejected requests get a JSON
+    response with a 'Retry-After' header. A GET of 'stats_path' returns the counters of
+    every Limiter, and is never limited.
+
+    Arguments:
+        app:            The ASGI app to pass admitted requests to.
+        config:         A dict of the 'admission' configuration (see config.yaml).
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        config = dict(config or {})
+        self.stats_path = config.pop('stats_path', None)
+        paths = config.pop('paths', None) or {}
+        self.limiter = Limiter(**config)
+        # Longest paths first, so the most specific one is found first.
+        self.paths = {k.rstrip("/") or "/": Limiter(**(v or {}))
+                      for k, v in sorted(paths.items(), key=lambda x: len(x[0]), reverse=True)}
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def path_limiter(self, path):
+        """Return the Limiter for request path *path*, or None."""
+        for k, limiter in self.paths.items():
+            if path == k or path.startswith(k + "/") or k == "/":
+                return limiter
+        return None
+
+    def stats(self):
+        """Return a dict of the counters of every Limiter."""
+        return {"global": self.limiter.stats(),
+                "paths": {k: v.stats() for k, v in self.paths.items()}}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        path = scope["path"]
+        if self.stats_path and path == self.stats_path and scope["method"] == "GET":
+            return await JSONResponse(self.stats())(scope, receive, send)
+
+        acquired = []
+        try:
+            for limiter in (self.path_limiter(path), self.limiter):
+                if limiter is not None:
+                    await limiter.acquire()
+                    acquired.append(limiter)
+        except Rejected as e:
+            for limiter in acquired:
+                limiter.release()
+            response = JSONResponse({"error": e.reason}, status_code=e.status,
+                                    headers={"Retry-After": str(e.retry_after)})
+            return await response(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for limiter in acquired:
+                limiter.release()
+
+
+def run_worker(config_path, index):
+    """Run an Instance from configuration file *config_path* in worker process number *index*."""
+    from palvella.lib.instance.instance import Instance  # noqa: PLC415
+
+    FastAPIPlugin.worker = True
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        inst = Instance(config_path=config_path)
+        await inst.initialize()
+        logger.info(f"worker {index} (pid {os.getpid()}): started")
+        await stop.wait()
+        for component in reversed(list(inst.components.instances)):
+            await component.stop()
+
+    asyncio.run(main())
+
 
 class FastAPIPlugin(Frontend, class_type="plugin", plugin_type=PLUGIN_TYPE):
-    """The 'FastAPI' plugin class."""
+    """
+    The 'FastAPI' plugin class.
+
+    Attributes:
+        worker:         True in a worker process started by another FastAPIPlugin. A worker
+                        always serves HTTP itself, on a socket shared with SO_REUSEPORT.
+        workers:        The worker processes started by this object.
+
+    Configuration (see config.yaml):
+        host, port:             The address to serve HTTP on.
+        admission:              The limits of AdmissionControl.
+        reuse_port:             Listen with SO_REUSEPORT (default: false).
+        workers:                The number of worker processes to serve HTTP from (default: 0,
+                                to serve it from this process).
+        worker_config:          The configuration file of the workers' Instances.
+        worker_check_interval:  The seconds between checks that the workers are running (default: 1).
+    """
 
     app = FastAPI()
+    admission = None  # The AdmissionControl() wrapping 'app'
+    server = None  # The Uvicorn server, or the event that shuts down the Hypercorn server
+    worker = False
+    workers = ()
+    _supervisor = None  # The task of supervise_workers()
 
     def __pre_plugins__(self):
         """Initialize the FastAPI app and web server before loading the plugins that use it."""
@@ -36,7 +272,16 @@ class FastAPIPlugin(Frontend, class_type="plugin", plugin_type=PLUGIN_TYPE):
         # plugin is done initializing before continuing with the dependent plugins?
         #self.app = FastAPI()
         #self.APP_ENTRY = "palvella.plugins.lib.frontend.fastapi:app"
-        self.APP_ENTRY = self.app
+        self.admission = AdmissionControl(self.app, self.config_data.get('admission'))
+        self.APP_ENTRY = self.admission
+        self.host = self.config_data.get('host', "127.0.0.1")
+        self.port = int(self.config_data.get('port', 8000))
+        self.reuse_port = bool(self.config_data.get('reuse_port', False)) or self.worker
+
+        nworkers = int(self.config_data.get('workers', 0))
+        if nworkers > 0 and not self.worker:
+            self.start_workers(nworkers)
+            return
 
         self.logger.info(f"{self}: starting fastapi web server")
         if ASGI_SERVER_TYPE == "hypercorn":
@@ -46,12 +291,73 @@ class FastAPIPlugin(Frontend, class_type="plugin", plugin_type=PLUGIN_TYPE):
         else:
             raise OSError("Invalid value for 'ASGI_SERVER_TYPE'")
 
+    def start_workers(self, nworkers):
+        """
+        Start *nworkers* worker processes, each running run_worker() with the 'worker_config' file.
+
+        Raises a ValueError if the worker configuration has a 'memory' message queue, as its
+        messages would never leave the worker. Starts supervise_workers() to keep them running.
+        """
+        worker_config = self.config_data.get('worker_config')
+        if not worker_config:
+            raise ValueError("fastapi: 'worker_config' is required when 'workers' is set")
+        if "memory" in ((loadYamlFile(worker_config) or {}).get('mq') or {}):
+            raise ValueError(f"fastapi: the 'worker_config' file '{worker_config}' has a 'memory' message "
+                             "queue, which can't pass triggers between processes (use 'zeromq' or 'sqlite3')")
+        self.logger.info(f"{self}: starting {nworkers} web server worker processes")
+        self.workers = [self.start_worker(worker_config, index) for index in range(nworkers)]
+        # The workers aren't daemonic, so the interpreter would wait for them at exit
+        atexit.register(self.terminate_workers)
+        interval = float(self.config_data.get('worker_check_interval', 1))
+        self._supervisor = asyncio.ensure_future(self.supervise_workers(worker_config, interval))
+
+    def start_worker(self, worker_config, index):
+        """Start worker process number *index*. Returns the multiprocessing.Process()."""
+        context = multiprocessing.get_context("spawn")
+        # Not daemonic, as daemonic processes can't start processes of their own (ex. the
+        # ProcessPoolExecutor that parses a 'jobs_dir')
+        process = context.Process(target=run_worker, args=(worker_config, index),
+                                  name=f"palvella-fastapi-worker-{index}")
+        process.start()
+        return process
+
+    async def supervise_workers(self, worker_config, interval):
+        """Every *interval* seconds, start the worker processes that exited again."""
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.workers):
+                if process.is_alive():
+                    continue
+                self.logger.error(f"fastapi: worker {index} (pid {process.pid}) exited with code "
+                                  f"{process.exitcode}; starting it again")
+                self.workers[index] = self.start_worker(worker_config, index)
+
+    def terminate_workers(self):
+        """Ask the worker processes that are running to exit (see run_worker())."""
+        for process in self.workers:
+            if process.is_alive():
+                process.terminate()
+
+    def reuse_port_socket(self):
+        """Return a socket bound to 'self.host' and 'self.port' with SO_REUSEPORT set."""
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("fastapi: 'reuse_port' needs SO_REUSEPORT, which this platform doesn't have")
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.setblocking(False)
+        return sock
+
     def start_uvicorn(self):
         """Start the Uvicorn server pointing at this plugin's FastAPI app() instance."""
         import uvicorn  # noqa: PLC415
-        config = uvicorn.Config(self.APP_ENTRY, port=8000, log_level="info")
-        server = uvicorn.Server(config)
-        asyncio.create_task(server.serve())
+        config = uvicorn.Config(self.APP_ENTRY, host=self.host, port=self.port, log_level="info")
+        self.server = uvicorn.Server(config)
+        sockets = [self.reuse_port_socket()] if self.reuse_port else None
+        asyncio.create_task(self.server.serve(sockets=sockets))
 
     def start_hypercorn(self):
         """Start the Hypercorn server pointing at this plugin's FastAPI app() instance."""
@@ -59,9 +365,33 @@ class FastAPIPlugin(Frontend, class_type="plugin", plugin_type=PLUGIN_TYPE):
         from hypercorn.asyncio import serve as hyperserve  # noqa: PLC415
         config = hypercorn.config.Config()
         config.application_path = self.APP_ENTRY
-        config.bind = "127.0.0.1:8000"
+        config.bind = f"{self.host}:{self.port}"
+        if self.reuse_port:
+            self._sock = self.reuse_port_socket()
+            config.bind = [f"fd://{self._sock.fileno()}"]
         config.loglevel = "INFO"
-        asyncio.create_task(hyperserve(self.app, config))
+        self.server = asyncio.Event()
+        asyncio.create_task(hyperserve(self.APP_ENTRY, config, shutdown_trigger=self.server.wait))
+
+    async def __stop_plugins__(self):
+        """Shut down the web server, or the worker processes, started by this plugin."""
+        if isinstance(self.server, asyncio.Event):
+            self.server.set()
+        elif self.server is not None:
+            self.server.should_exit = True
+
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+            atexit.unregister(self.terminate_workers)
+        self.terminate_workers()
+        loop = asyncio.get_running_loop()
+        for process in self.workers:
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.kill()
+        self.workers = ()
 
     @staticmethod
     def get_header(request, key):
@@ -71,6 +401,47 @@ class FastAPIPlugin(Frontend, class_type="plugin", plugin_type=PLUGIN_TYPE):
         except KeyError:
             return JSONResponse('{"error": "Missing header: ' + key + '"}', status_code=400)
 
+    @staticmethod
+    def media_type(content_type):
+        """Return the media type of a Content-Type header value *content_type*, without its parameters."""
+        if content_type is None:
+            return None
+        return content_type.split(";", 1)[0].strip().lower()
+
+    @staticmethod
+    async def receive_delivery(trigger, body, content_type, delivery, meta):
+        """
+        Return the response to a webhook request, once Trigger *trigger* has deliver()ed it.
+
+        The request's *body* (bytes) must be JSON, going by *content_type*. A duplicate *delivery* (see Trigger.is_duplicate()) is acknowledged
+        with 200, a queued one with 202, and a triggered one with 204; if the ingest queue is full,
+        the response is 503.
+        """
+        if FastAPIPlugin.media_type(content_type) != "application/json":
+            return JSONResponse({"error": f"content_type '{content_type}' not implemented"},
+                                status_code=400)
+        payload = JSONPayload(body)
+
+        if await trigger.is_duplicate(delivery):
+            trigger.logger.info(f"ignoring duplicate delivery {delivery}")
+            return JSONResponse({"status": "duplicate delivery"}, status_code=HTTPStatus.OK.value)
+
+        try:
+            queued = await trigger.deliver(payload, meta, delivery)
+        except asyncio.QueueFull:
+            trigger.logger.error("ingest queue is full")
+            return JSONResponse({"error": "Ingest queue is full"},
+                                status_code=HTTPStatus.SERVICE_UNAVAILABLE.value,
+                                headers={"Retry-After": "1"})
+        if queued:
+            return Response(status_code=HTTPStatus.ACCEPTED.value)
+
+        # For 204 status code, you *MUST NOT* use a JSONResponse or HTTPResponse,
+        # but only Response, with no body. Otherwise FastAPI will inject some junk
+        # in the body that causes the h11 library to throw exceptions, because for
+        # 204 there should be no body at all.
+        return Response(status_code=HTTPStatus.NO_CONTENT.value)
+
     @staticmethod
     async def fastapi_data(request):
         @dataclass
@@ -83,10 +454,14 @@ class FastAPIPlugin(Frontend, class_type="plugin", plugin_type=PLUGIN_TYPE):
             async def body(self):
                 return await self._request.body()
             @property
+            async def payload(self):
+                # The raw body as a JSONPayload(), parsed only when it is read
+                return JSONPayload(await self._request.body())
+            @property
             async def json(self):
                 if self._json: return self._json
-                if self._content_type == "application/json":
-                    self._json = await request.json()
+                if FastAPIPlugin.media_type(self._content_type) == "application/json":
+                    self._json = (await self.payload).data
                     if self._json is None:
                         return JSONResponse({"error": "Request body must contain json"}, status_code=400)
                 else:
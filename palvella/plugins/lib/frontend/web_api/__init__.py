@@ -14,7 +14,7 @@ PLUGIN_TYPE = "web_api"
 class WebAPI(FastAPIPlugin, class_type="plugin", plugin_type=PLUGIN_TYPE):
     """Class of the Web API endpoints plugin."""
 
-    fastapi_dependency = PluginDependency(parentclass="Frontend", plugin_type="fastapi")
+    fastapi_dependency = PluginDependency(parentclassname="Frontend", plugin_type="fastapi")
     depends_on = [ fastapi_dependency ]
 
     def __pre_plugins__(self):
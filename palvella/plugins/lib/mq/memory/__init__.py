@@ -0,0 +1,147 @@
+"""
+The plugin for the Message Queue 'memory'. Defines plugin class and some base functions.
+
+An in-process message queue, for an Instance that publishes and consumes its own messages
+(ex. a single node, or tests). Messages are put on a bounded asyncio.Queue as they are, so
+nothing is serialized or copied; the consumer gets the same Message() object that was
+published.
+
+When the last instance using a queue stops, the queue is dropped if it's empty and nothing is
+waiting on it. Otherwise the same queue object is kept, with its messages and waiters, for the
+next instance using it (ex. the replacement of an instance whose configuration changed on a
+reload; see Instance.reload()), which resizes it in place if its 'maxsize' changed. So a
+consumer still waiting on the old instance gets the messages published to the new one.
+"""
+
+import asyncio
+
+from palvella.lib.instance.mq import MessageQueue, OperationError
+
+PLUGIN_TYPE = "memory"
+
+
+class SharedQueue(asyncio.Queue):
+    """An asyncio.Queue that can be resized, and tells if anything is using it."""
+
+    def resize(self, maxsize):
+        """Change the most items the queue holds to *maxsize*, waking any waiting put()s to check again."""
+        self._maxsize = maxsize
+        while self._putters:
+            self._wakeup_next(self._putters)
+
+    def idle(self):
+        """Return True if the queue is empty and no get() or put() is waiting on it."""
+        return self.empty() and not self._getters and not self._putters
+
+
+class MemoryQueue(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
+    """Class of the in-process message queue plugin. Inherits the MessageQueue class.
+
+       Attributes of the object:
+         name:              The name of this MemoryQueue instance.
+         queue:             The name of the in-process queue (default: 'name'). Instances with the
+                            same 'queue' share it, so one can publish to it and another consume it.
+         maxsize:           The most messages the queue holds (default: 10000; 0 is unbounded).
+         put_timeout:       The seconds publish() waits for room in a full queue before it raises
+                            an OperationError (default: None, to wait forever; 0 to not wait).
+         config_data:       A dict of configuration data.
+
+       The following attributes come from the 'config_data' attribute dict:
+            - name, queue, maxsize, put_timeout
+    """
+
+    name = None
+    queue = None
+    maxsize = 10000
+    put_timeout = None
+
+    queues = {}  # The shared queues of this process: {queue name: SharedQueue()}
+    _users = {}  # {queue name: number of instances using it}
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def __pre_plugins__(self):
+        for x in ['name', 'queue', 'maxsize', 'put_timeout']:
+            if x in self.config_data:
+                setattr(self, x, self.config_data[x])
+        if self.queue is None:
+            self.queue = self.name
+        if self.queue is None:
+            self.logger.debug(f"{self}: no 'name' or 'queue' configured; not using a queue")
+            return
+
+        q = self.queues.get(self.queue)
+        if q is None:
+            q = self.queues[self.queue] = SharedQueue(int(self.maxsize))
+        elif self.queue not in self._users and q.maxsize != int(self.maxsize):
+            # Left by the last user; resized rather than replaced, as consumers may be waiting on it
+            q.resize(int(self.maxsize))
+        self._users[self.queue] = self._users.get(self.queue, 0) + 1
+        self.q = q
+
+    def __stop_plugins__(self):
+        """Stop using the queue, and drop it if no other instance is and it's idle."""
+        if self.queue is None:
+            return
+        self._users[self.queue] -= 1
+        if self._users[self.queue] > 0:
+            return
+        del self._users[self.queue]
+        if not self.q.idle():
+            self.logger.info(f"memory: keeping queue '{self.queue}' ({self.q.qsize()} messages) for its next user")
+            return
+        del self.queues[self.queue]
+
+    async def publish(self, message):
+        """
+        Put a Message *message* on the queue.
+
+        If the queue is full, waits up to 'put_timeout' seconds for room, and then raises
+        an OperationError. Returns True.
+        """
+        try:
+            if self.put_timeout is None:
+                await self.q.put(message)
+            elif self.put_timeout == 0:
+                self.q.put_nowait(message)
+            else:
+                await asyncio.wait_for(self.q.put(message), self.put_timeout)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            raise OperationError(f"memory: queue '{self.queue}' is full")
+        return True
+
+    async def publish_many(self, messages):
+        """Put a list of Messages *messages* on the queue, as publish() does. Returns a list of the results."""
+        results = []
+        for message in messages:
+            try:
+                self.q.put_nowait(message)
+                results.append(True)
+            except asyncio.QueueFull:
+                results.append(await self.publish(message))
+        return results
+
+    async def consume(self, *args):
+        """Take a Message() from the queue, waiting for one if it is empty."""
+        return await self.q.get()
+
+    async def consume_batch(self, max_n=100, max_wait=None):
+        """
+        Take up to *max_n* messages from the queue. Returns a list of Message() objects.
+
+        The messages already in the queue are taken without waiting. If there are none, waits
+        up to *max_wait* seconds (forever if None; not at all if 0) for one, and takes any
+        that arrived with it.
+        """
+        messages = []
+        while len(messages) < max_n and not self.q.empty():
+            messages.append(self.q.get_nowait())
+        if not messages and max_wait != 0:
+            try:
+                messages.append(await asyncio.wait_for(self.q.get(), max_wait))
+            except asyncio.TimeoutError:
+                return messages
+            while len(messages) < max_n and not self.q.empty():
+                messages.append(self.q.get_nowait())
+        return messages
@@ -0,0 +1,333 @@
+"""
+The plugin for the Message Queue 'sqlite3'. Defines plugin class and some base functions.
+
+A durable message queue, kept as a log of messages in a SQLite database in WAL mode, so
+messages published but not yet consumed survive a restart of the process.
+
+Delivery is at-least-once: consuming a message leases it for 'lease' seconds, and it is
+only done with once it is acknowledged (see MessageQueue.ack()). A message that is not
+acknowledged before its lease expires (ex. the consumer crashed) is delivered again.
+Each lease is known by the message's count of deliveries, which is kept in its receipt,
+so a consumer whose lease expired can no longer acknowledge (or return) the message once
+it was leased again.
+
+All the reads and writes of an instance run in one thread, with its own connection.
+Operations that arrive while a transaction is being committed are queued, and then
+committed together in the next transaction (a "group commit"), so under load there is
+one fsync per batch of messages rather than one per message.
+"""
+
+import asyncio
+import json
+import sqlite3  # noqa
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from palvella.lib.instance.mq import MessageQueue, OperationError
+from palvella.lib.instance.message import Message, encode_payload
+
+PLUGIN_TYPE = "sqlite3"
+
+# The states of a message
+READY, LEASED, ACKED = 0, 1, 2
+
+
+class SQLite3Queue(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
+    """Class of the SQLite3 message queue plugin. Inherits the MessageQueue class.
+
+       Attributes of the object:
+         name:                  The name of this SQLite3Queue instance.
+         queue:                 The name of the queue in the database (default: 'name'). Instances
+                                with the same 'db_path' and 'queue' share it, within a process or not.
+         db_path:               The path of the database file (default: 'mq.sqlite3').
+         synchronous:           The SQLite 'synchronous' setting: "FULL" (default) to fsync every
+                                commit, or "NORMAL" to only fsync at WAL checkpoints.
+         lease:                 The seconds a consumed message is leased for before it is delivered
+                                again, if it isn't acknowledged (default: 300). Should be longer than
+                                its hooks take to run.
+         commit_batch:          The most operations committed in one transaction (default: 1000).
+         poll_interval:         The seconds between checks for messages published by another
+                                process, while waiting for one (default: 0.5).
+         maintenance_interval:  The seconds between requeueing messages with expired leases,
+                                and deleting acknowledged messages (default: 5).
+         conn:                  The handle of a live connection to the database.
+         config_data:           A dict of configuration data.
+
+       The following attributes come from the 'config_data' attribute dict:
+            - name, queue, db_path, synchronous, lease, commit_batch, poll_interval,
+              maintenance_interval
+    """
+
+    name = None
+    queue = None
+    conn = None
+    init_in_executor = True  # connect() blocks on disk I/O
+
+    _wakeups = {}  # {(db_path, queue): asyncio.Event()}, set when a message is published in this process
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.__dict__)
+
+    def __pre_plugins__(self):
+        for x in ['name', 'queue']:
+            if x in self.config_data:
+                setattr(self, x, self.config_data[x])
+        if self.queue is None:
+            self.queue = self.name
+        if self.queue is None:
+            self.logger.debug(f"{self}: no 'name' or 'queue' configured; not opening a queue")
+            return
+
+        self.db_path = self.config_data['db_path']
+        self.synchronous = str(self.config_data['synchronous']).upper()
+        if self.synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Invalid 'synchronous' value '{self.synchronous}'")
+        self.lease = float(self.config_data['lease'])
+        self.commit_batch = int(self.config_data['commit_batch'])
+        self.poll_interval = float(self.config_data['poll_interval'])
+        self.maintenance_interval = float(self.config_data['maintenance_interval'])
+
+        self._key = (self.db_path, self.queue)
+        self._pending = []  # (function, args, future) of the operations waiting to be committed
+        self._flusher = None
+        self._maintenance = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"mq-sqlite3-{self.queue}")
+        self.connect()
+
+    async def __stop_plugins__(self):
+        """Stop the maintenance task, commit any pending operations, and close the connection."""
+        if self.conn is None:
+            return
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            await asyncio.gather(self._maintenance, return_exceptions=True)
+        if self._flusher is not None:
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.conn.close)
+        self._executor.shutdown(wait=False)
+        self.conn = None
+
+    def connect(self):
+        """Open the database in WAL mode, and create the 'messages' table if it doesn't exist."""
+        # Transactions are begun and committed explicitly (see _commit())
+        self.conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute(""" CREATE TABLE IF NOT EXISTS messages (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                queue TEXT NOT NULL,
+                                identity BLOB NOT NULL,
+                                meta BLOB NOT NULL,
+                                data BLOB NOT NULL,
+                                state INTEGER NOT NULL DEFAULT 0,
+                                lease_until REAL,
+                                deliveries INTEGER NOT NULL DEFAULT 0
+                            ) """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_queue_state ON messages (queue, state, id)")
+        self.logger.debug(f"DB Connection established to {self.db_path}")
+
+    @staticmethod
+    def encode_message(message):
+        """Return a row of (identity, meta, data) JSON blobs of Message *message*."""
+        data = b"[" + b",".join(encode_payload(x) for x in message.data) + b"]"
+        return (message.identity.encode(), message.meta.encode(), data)
+
+    def decode_message(self, row):
+        """Return a Message() of a row of (id, identity, meta, data, deliveries), with its 'receipt' set to its lease."""
+        msg_id, identity, meta, data, deliveries = row
+        if deliveries > 1:
+            self.logger.debug(f"sqlite3: delivering message {msg_id} of queue '{self.queue}' again (delivery {deliveries})")
+        message = Message(identity=json.loads(identity), meta=json.loads(meta), data=json.loads(data))
+        message.receipt = (self._key, msg_id, deliveries)
+        return message
+
+    # The functions below run in the thread of the executor, within a transaction (see _commit()).
+
+    def _sql_put(self, rows):
+        self.conn.executemany("INSERT INTO messages (queue, identity, meta, data) VALUES (?, ?, ?, ?)",
+                              [(self.queue, *x) for x in rows])
+
+    def _sql_claim(self, max_n):
+        rows = self.conn.execute("""SELECT id, identity, meta, data, deliveries + 1 FROM messages
+                                    WHERE queue = ? AND state = ? ORDER BY id LIMIT ?""",
+                                 (self.queue, READY, max_n)).fetchall()
+        if rows:
+            lease_until = time.time() + self.lease
+            self.conn.executemany("""UPDATE messages SET state = ?, lease_until = ?, deliveries = deliveries + 1
+                                     WHERE id = ?""", [(LEASED, lease_until, x[0]) for x in rows])
+        return rows
+
+    # The leases given to _sql_ack() and _sql_nack() are (id, deliveries) of the claim they were given by,
+    # and only match while it is the message's current lease; they return the number that matched.
+
+    def _sql_ack(self, leases):
+        res = self.conn.executemany("""UPDATE messages SET state = ?, lease_until = NULL
+                                       WHERE id = ? AND deliveries = ? AND state = ?""",
+                                    [(ACKED, *x, LEASED) for x in leases])
+        return res.rowcount
+
+    def _sql_nack(self, leases, delay):
+        if delay > 0:
+            # Keep the lease, but have it expire after *delay* seconds
+            res = self.conn.executemany("UPDATE messages SET lease_until = ? WHERE id = ? AND deliveries = ? AND state = ?",
+                                        [(time.time() + delay, *x, LEASED) for x in leases])
+        else:
+            res = self.conn.executemany("""UPDATE messages SET state = ?, lease_until = NULL
+                                           WHERE id = ? AND deliveries = ? AND state = ?""",
+                                        [(READY, *x, LEASED) for x in leases])
+        return res.rowcount
+
+    def _sql_requeue(self):
+        res = self.conn.execute("""UPDATE messages SET state = ?, lease_until = NULL
+                                   WHERE queue = ? AND state = ? AND lease_until < ?""",
+                                (READY, self.queue, LEASED, time.time()))
+        return res.rowcount
+
+    def _sql_compact(self, limit):
+        res = self.conn.execute("""DELETE FROM messages WHERE id IN
+                                   (SELECT id FROM messages WHERE queue = ? AND state = ? LIMIT ?)""",
+                                (self.queue, ACKED, limit))
+        return res.rowcount
+
+    def _commit(self, ops):
+        """Run the functions of a list of operations in one transaction. Returns a list of their results."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            results = [func(*args) for func, args, _ in ops]
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return results
+
+    async def _submit(self, func, *args):
+        """Queue a call of *func* with *args* for the next transaction, and return its result once committed."""
+        if self.conn is None:
+            raise OperationError(f"sqlite3: queue '{self.queue}' is not open")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((func, args, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            ops = self._pending[:self.commit_batch]
+            del self._pending[:self.commit_batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self._commit, ops)
+            except Exception as e:  # noqa: BLE001
+                for _, _, future in ops:
+                    if not future.done():
+                        future.set_exception(OperationError(e))
+                continue
+            for (_, _, future), result in zip(ops, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _wakeup(self):
+        """Return the Event set when a message is published to this queue in this process."""
+        if self._key not in self._wakeups:
+            self._wakeups[self._key] = asyncio.Event()
+        return self._wakeups[self._key]
+
+    def _start(self):
+        if self._maintenance is None:
+            self._maintenance = asyncio.ensure_future(self._maintain())
+
+    async def _maintain(self):
+        """Periodically requeue the messages whose leases expired, and delete acknowledged messages."""
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                requeued = await self._submit(self._sql_requeue)
+                if requeued > 0:
+                    self.logger.info(f"sqlite3: requeued {requeued} messages with expired leases in queue '{self.queue}'")
+                    self._wakeup().set()
+                while await self._submit(self._sql_compact, 10000) >= 10000:
+                    pass
+            except OperationError:
+                self.logger.exception(f"sqlite3: maintenance of queue '{self.queue}' failed")
+
+    async def publish(self, message):
+        """Append a Message *message* to the queue. Returns True once it is committed."""
+        self._start()
+        await self._submit(self._sql_put, [self.encode_message(message)])
+        self._wakeup().set()
+        return True
+
+    async def publish_many(self, messages):
+        """Append a list of Messages *messages* to the queue, in one transaction. Returns a list of the results."""
+        self._start()
+        await self._submit(self._sql_put, [self.encode_message(x) for x in messages])
+        self._wakeup().set()
+        return [True] * len(messages)
+
+    async def consume(self, *args):
+        """Lease a Message() from the queue, waiting for one if it is empty. (See consume_batch())"""
+        while True:
+            messages = await self.consume_batch(max_n=1)
+            if messages:
+                return messages[0]
+
+    async def consume_batch(self, max_n=100, max_wait=None):
+        """
+        Lease up to *max_n* messages from the queue. Returns a list of Message() objects.
+
+        If there are none, waits up to *max_wait* seconds (forever if None; not at all if 0)
+        for one: a publish in this process wakes the wait right away, and otherwise the queue
+        is checked every 'poll_interval' seconds. Each message must be acknowledged (see ack())
+        within 'lease' seconds, or it is delivered again.
+        """
+        self._start()
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        wakeup = self._wakeup()
+        while True:
+            wakeup.clear()
+            rows = await self._submit(self._sql_claim, max_n)
+            if rows or max_wait == 0:
+                break
+            timeout = self.poll_interval
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [self.decode_message(x) for x in rows]
+
+    def _leases(self, messages):
+        return [x.receipt[1:] for x in messages if x.receipt is not None and x.receipt[0] == self._key]
+
+    async def ack(self, messages):
+        """
+        Acknowledge a list of Messages *messages* consumed from this queue, so they aren't delivered again.
+
+        Returns the number acknowledged; a message whose lease expired and that was leased again
+        since it was consumed is not.
+        """
+        leases = self._leases(messages)
+        if not leases:
+            return 0
+        acked = await self._submit(self._sql_ack, leases)
+        if acked < len(leases):
+            self.logger.warning(f"sqlite3: {len(leases) - acked} messages of queue '{self.queue}' were not acknowledged, as their leases expired")
+        return acked
+
+    async def nack(self, messages, delay=0):
+        """
+        Return a list of Messages *messages* consumed from this queue, to be delivered again after *delay* seconds.
+
+        Returns the number returned; like ack(), a message whose lease expired is not.
+        """
+        leases = self._leases(messages)
+        if not leases:
+            return 0
+        returned = await self._submit(self._sql_nack, leases, delay)
+        if returned and delay <= 0:
+            self._wakeup().set()
+        return returned
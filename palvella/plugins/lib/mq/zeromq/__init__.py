@@ -1,13 +1,23 @@
+"""
+The plugin for the Message Queue 'zeromq'. Defines plugin class and some base functions.
 
-"""The plugin for the Message Queue 'zeromq'. Defines plugin class and some base functions."""
+All the ZeroMQ instances of a process share one ZeroMQ context (so one set of I/O threads),
+and instances configured with the same socket share the socket, which is closed when the
+last of them is stopped.
+
+A socket queues messages in memory up to its high-water mark ('sndhwm'/'rcvhwm'). Once a
+sending socket is at its high-water mark, publishing waits for room, for up to 'send_timeout'
+seconds, and then raises an OperationError; see stats() for how often that happens.
+"""
 
 import json
+import time
 import zmq
 import zmq.asyncio
 import asyncio
 
 from palvella.lib.instance.mq import MessageQueue, OperationError
-from palvella.lib.instance.message import Message
+from palvella.lib.instance.message import JSONPayload, Message
 
 PLUGIN_TYPE = "zeromq"
 
@@ -23,10 +33,23 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
          sock:              The opened socket
          queue:             Boolean (default: False). Subscribe to a ZeroMQ topic the same as 'name' attribute.
          identity:          A string to use as the 'identity' of a connecting socket.
+         io_threads:        The number of I/O threads of the shared context (default: 1). Only the
+                            first instance creates the context, so only its setting takes effect.
+         sndhwm:            The most messages queued in memory to send (default: 1000; 0 is unbounded).
+         rcvhwm:            The most messages queued in memory that were received (default: 1000).
+         linger:            The milliseconds unsent messages are kept after closing the socket
+                            (default: 1000; -1 is forever).
+         sndbuf:            The size of the kernel send buffer in bytes (default: the OS default).
+         rcvbuf:            The size of the kernel receive buffer in bytes (default: the OS default).
+         send_timeout:      The seconds to wait for room to send a message, once the socket is at its
+                            high-water mark (default: None, to wait forever).
+         metrics:           A dict of counts of the messages sent and received, and of the sends that
+                            waited for room ('blocked', 'blocked_seconds') or timed out ('send_timeouts').
          config_data:       A dict of configuration data.
 
        The following attributes come from the 'config_data' attribute dict:
-            - name, socket_type, socket_operation, url, queue, identity
+            - name, socket_type, socket_operation, url, queue, identity, io_threads,
+              sndhwm, rcvhwm, linger, sndbuf, rcvbuf, send_timeout
     """
 
     name = None
@@ -36,6 +59,14 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
     sock = None
     queue = False
     identity = None
+    io_threads = None
+    sndhwm = 1000
+    rcvhwm = 1000
+    linger = 1000
+    sndbuf = None
+    rcvbuf = None
+    send_timeout = None
+    metrics = None
 
     _socket_type_map = { "push": zmq.PUSH,
                          "pull": zmq.PULL,
@@ -44,37 +75,104 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
                          "xsub": zmq.XSUB,
                          "xpub": zmq.XPUB
                        }
+    # The socket options set from the attributes of the same name (if not None)
+    _socket_options = { "sndhwm": zmq.SNDHWM,
+                        "rcvhwm": zmq.RCVHWM,
+                        "linger": zmq.LINGER,
+                        "sndbuf": zmq.SNDBUF,
+                        "rcvbuf": zmq.RCVBUF
+                      }
+
+    context = None      # The shared context of the process
+    _context_users = 0  # The number of instances using 'context'
+    _sockets = {}       # The socket pool: {socket key: [socket, number of instances using it]}
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.__dict__)
 
     def __pre_plugins__(self):
-        self.context = zmq.asyncio.Context()
+        if not self.config_data.get('socket_type') and not self.config_data.get('url'):
+            self.logger.debug(f"{self}: no 'socket_type' or 'url' configured; not opening a socket")
+            return
 
         assert ('socket_type' in self.config_data), "'socket_type' property required in config_data"
 
-        for x in ['name', 'socket_type', 'socket_operation', 'queue', 'identity']:
+        for x in ['name', 'socket_type', 'socket_operation', 'queue', 'identity', 'io_threads',
+                  'sndhwm', 'rcvhwm', 'linger', 'sndbuf', 'rcvbuf', 'send_timeout']:
             if x in self.config_data:
                 setattr(self, x, self.config_data[x])
 
         assert ('url' in self.config_data), "'url' property required in config_data"
         self.url = self.config_data['url']
 
+        if self.socket_operation == None:
+            if self.socket_type == "push":
+                self.socket_operation = "connect"
+            elif self.socket_type == "pull":
+                self.socket_operation = "bind"
+
+        self.metrics = {"sent": 0, "received": 0, "blocked": 0, "blocked_seconds": 0.0, "send_timeouts": 0}
+        self.acquire_context(self.io_threads)
+
+    async def __stop_plugins__(self):
+        """Release the socket and the shared context (terminating it in a thread, as it waits for linger)."""
+        if self.sock is not None:
+            self.release_socket()
+        if self.metrics is not None:
+            self.metrics = None
+            await self.release_context()
+
+    @classmethod
+    def acquire_context(cls, io_threads=None):
+        """Return the shared context of the process, creating it with *io_threads* (default: 1) I/O threads if needed."""
+        if ZeroMQ.context is None:
+            cls.logger.debug(f"zmq: creating the shared context (io_threads={io_threads})")
+            ZeroMQ.context = zmq.asyncio.Context(io_threads=int(io_threads or 1))
+        elif io_threads is not None and ZeroMQ.context.get(zmq.IO_THREADS) != int(io_threads):
+            cls.logger.warning(f"zmq: the shared context already has {ZeroMQ.context.get(zmq.IO_THREADS)} I/O threads; ignoring io_threads={io_threads}")
+        ZeroMQ._context_users += 1
+        return ZeroMQ.context
+
+    @classmethod
+    async def release_context(cls):
+        """Stop using the shared context, and terminate it if no other instance is."""
+        ZeroMQ._context_users -= 1
+        if ZeroMQ._context_users > 0 or ZeroMQ.context is None:
+            return
+        context, ZeroMQ.context = ZeroMQ.context, None
+        await asyncio.get_running_loop().run_in_executor(None, context.term)
+
+    def socket_key(self):
+        """Return the key of this instance's socket in the socket pool; instances with equal keys share a socket."""
+        return (self.socket_type, self.socket_operation, self.url, self.identity,
+                self.name if self.queue == True else None,
+                tuple(getattr(self, x) for x in self._socket_options))
+
     def _setup_socket(self):
         """
-        Use self.url and self.socket_type to configure a socket.
+        Use self.url and self.socket_type to configure a socket, or take it from the socket pool.
 
         If socket_type == "push", socket_operation is set to "connect".
         If socket_type == "pull", socket_operation is set to "bind".
         """
+        key = self.socket_key()
+        if key in self._sockets:
+            self._sockets[key][1] += 1
+            self.sock = self._sockets[key][0]
+            self.logger.debug(f"{self}: sharing socket {self.sock} ({self._sockets[key][1]} users)")
+            return
 
         self.sock = self.context.socket( self._socket_type_map[self.socket_type] )
 
-        if self.socket_operation == None:
-            if self.socket_type == "push":
-                self.socket_operation = "connect"
-            elif self.socket_type == "pull":
-                self.socket_operation = "bind"
+        # The options have to be set before connecting or binding to take effect
+        for attr, option in self._socket_options.items():
+            if getattr(self, attr) is not None:
+                self.logger.debug(f"setting sockopt({option!r}, {getattr(self, attr)})")
+                self.sock.setsockopt(option, int(getattr(self, attr)))
+
+        if self.identity != None:
+            self.logger.debug(f"setting sockopt(zmq.IDENTITY, {self.identity})")
+            self.sock.setsockopt_string(zmq.IDENTITY, self.identity)
 
         self.logger.debug(f"{self}: Running socket operation {self.socket_operation}")
         if self.socket_operation == "connect":
@@ -82,26 +180,70 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
         elif self.socket_operation == "bind":
             self.sock.bind(self.url)
 
-        if self.identity != None:
-            self.logger.debug(f"setting sockopt(zmq.IDENTITY, {self.identity})")
-            self.sock.setsockopt_string(zmq.IDENTITY, self.identity)
-
         if self.queue == True:
             self.logger.debug(f"setting sockopt(zmq.SUBSCRIBE, {self.name})")
             self.sock.setsockopt_string(zmq.SUBSCRIBE, self.name)
 
-    async def publish(self, message):
+        self._sockets[key] = [self.sock, 1]
+
+    def release_socket(self):
+        """Stop using the socket, and close it (after 'linger') if no other instance is."""
+        key = self.socket_key()
+        entry = self._sockets.get(key)
+        if entry is not None and entry[0] is self.sock:
+            entry[1] -= 1
+            if entry[1] < 1:
+                del self._sockets[key]
+                self.sock.close()
+        self.sock = None
+
+    def stats(self):
+        """Return a dict of this instance's socket settings and its 'metrics'."""
+        return {"name": self.name, "url": self.url, "socket_type": self.socket_type,
+                "sndhwm": self.sndhwm, "rcvhwm": self.rcvhwm, "send_timeout": self.send_timeout,
+                **(self.metrics or {})}
+
+    @staticmethod
+    def encode_message(message):
+        """
+        Return the list of ZeroMQ frames of Message *message*.
+
+        The first two frames are the *identity* and *meta* of the message as JSON blobs,
+        followed by one frame for each entry of its *data*. If an entry is of type 'dict',
+        it is sent as a JSON blob. Raw bytes, and JSONPayload()s (as their raw JSON), are
+        sent unchanged. Otherwise it is sent as a binary string.
+        """
 
         def encode_part(arg):
+            if isinstance(arg, (bytes, bytearray, memoryview)):
+                return arg
             if isinstance(arg, dict):
                 return json.dumps(arg).encode()
             return arg.encode()
 
+        msg_parts = [encode_part(message.identity), encode_part(message.meta)]
+        # message.data is an array of data payloads
+        for arg in message.data:
+            msg_parts.append( encode_part(arg) )
+        return msg_parts
+
+    @staticmethod
+    def decode_message(frames):
         """
-        Publish a Message *message* to the message queue.
+        Return a Message() of the ZeroMQ frames *frames* (received with 'copy=False').
 
-        If an entry from *message* is of type 'dict', it is sent as a JSON blob.
-        Otherwise it is sent as a binary string.
+        *identity* and *event* are decoded as JSON blobs. Each *data* frame is kept as a
+        JSONPayload() over the frame's buffer, and only parsed if it is read.
+        """
+        if len(frames) < 2:
+            raise Exception("message consumed had less than 2 frames")
+        identity, event = frames[0], frames[1]
+        data = [JSONPayload(x.buffer) for x in frames[2:]]
+        return Message(identity=json.loads(identity.bytes), meta=json.loads(event.bytes), data=data)
+
+    async def publish(self, message):
+        """
+        Publish a Message *message* to the message queue. (See encode_message())
 
         The result of zeromq's sock.end_multipart() is returned, which should
         be an object which can be checked to determine if the message was
@@ -112,21 +254,60 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
         if self.socket_type != 'push':
             raise OperationError(f"cannot push on socket {self.sock}")
 
-        msg_parts = []
-        for arg in [message.identity, message.meta]:
-            msg_parts.append( encode_part(arg) )
-        # message.data is an array of data payloads
-        for arg in message.data:
-            msg_parts.append( encode_part(arg) )
+        msg_parts = self.encode_message(message)
 
         self.logger.debug(f"zmq: sending messages ({len(msg_parts)}) on {self.sock}")
+        res = await self._send(msg_parts)
+        self.logger.debug(f"zmq: sent message, got {res}")
+        return res
+
+    async def publish_many(self, messages):
+        """
+        Publish a list of Messages *messages* to the message queue.
+
+        Each message is sent with zmq.NOBLOCK, which completes without a trip through the
+        event loop while the socket has room. When the socket reaches its high-water mark,
+        each waits for room as in publish() (see _send()). Returns a list of the results.
+        """
+        if not self.sock:           self._setup_socket()
+
+        if self.socket_type != 'push':
+            raise OperationError(f"cannot push on socket {self.sock}")
+
+        self.logger.debug(f"zmq: sending {len(messages)} messages on {self.sock}")
+
+        results = []
+        for message in messages:
+            results.append(await self._send(self.encode_message(message)))
 
+        self.logger.debug(f"zmq: sent {len(results)} messages")
+        return results
+
+    async def _send(self, msg_parts):
+        """
+        Send the frames *msg_parts*, and return the result of zeromq's sock.send_multipart().
+
+        The frames are sent with zmq.NOBLOCK, which completes without a trip through the event
+        loop while the socket has room. If the socket is at its high-water mark, waits up to
+        'send_timeout' seconds for room, and then raises an OperationError.
+        """
         try:
-            res = await self.sock.send_multipart(msg_parts=msg_parts, copy=False)
+            try:
+                res = await self.sock.send_multipart(msg_parts, flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                self.metrics["blocked"] += 1
+                start = time.monotonic()
+                try:
+                    res = await asyncio.wait_for(self.sock.send_multipart(msg_parts, copy=False),
+                                                 self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.metrics["send_timeouts"] += 1
+                    raise OperationError(f"zmq: timed out after {self.send_timeout}s waiting to send on {self.url} (at its high-water mark)")
+                finally:
+                    self.metrics["blocked_seconds"] += time.monotonic() - start
         except zmq.error.ZMQError as e:
             raise OperationError(e)
-
-        self.logger.debug(f"zmq: sent message, got {res}")
+        self.metrics["sent"] += 1
         return res
 
     async def consume(self, *args):
@@ -134,8 +315,7 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
         Consume a message from a queue.
 
         Returns a Message() object with the *identity*, *event*, and *data* arguments passed as
-        the first, second, and any further frames in the ZeroMQ message.
-        (*identity*, *event*, and *data* are decoded as JSON blobs)
+        the first, second, and any further frames in the ZeroMQ message. (See decode_message())
         """
         if not self.sock:           self._setup_socket()
 
@@ -144,10 +324,39 @@ class ZeroMQ(MessageQueue, class_type="plugin", plugin_type=PLUGIN_TYPE):
         res = await self.sock.recv_multipart(copy=False)
         self.logger.debug(f"zmq: received message {res}")
 
-        if len(res) < 2:
-            raise Exception("message consumed had less than 2 frames")
-        identity, event = res[0], res[1]
-        data = [json.loads(str(x)) for x in res[2:]] if len(res) > 2 else []
+        self.metrics["received"] += 1
+        return self.decode_message(res)
+
+    async def _drain(self, max_n):
+        """Return a list of up to *max_n* Messages already received by the socket, without waiting."""
+        messages = []
+        while len(messages) < max_n:
+            try:
+                res = await self.sock.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            messages.append(self.decode_message(res))
+        return messages
+
+    async def consume_batch(self, max_n=100, max_wait=None):
+        """
+        Consume up to *max_n* messages from a queue. Returns a list of Message() objects.
+
+        The messages already received by the socket are read with zmq.NOBLOCK, which completes
+        without a trip through the event loop. If there are none, waits up to *max_wait* seconds
+        (forever if None; not at all if 0) for one, then reads any that arrived with it.
+        """
+        if not self.sock:           self._setup_socket()
 
-        mqmsg = Message(identity=json.loads(str(identity)), meta=json.loads(str(event)), data=data)
-        return mqmsg
+        messages = await self._drain(max_n)
+        if not messages and max_wait != 0:
+            try:
+                res = await asyncio.wait_for(self.sock.recv_multipart(copy=False), max_wait)
+            except asyncio.TimeoutError:
+                return messages
+            messages.append(self.decode_message(res))
+            messages += await self._drain(max_n - 1)
+
+        self.metrics["received"] += len(messages)
+        self.logger.debug(f"zmq: received {len(messages)} messages")
+        return messages
@@ -7,13 +7,27 @@ The plugin for the Trigger 'github_webhook'. Defines plugin class and some base
 
 This plugin registers a GitHub Webhook trigger '/github_webhook' using the FastAPI
 web server plugin.
+
+The request body is read once. The signature is computed over the raw bytes, which
+are then passed on as a JSONPayload(), so the JSON is only parsed if a hook filter or
+job reads it, and is published to a message queue without being serialized again.
+
+By default each delivery is processed before the request returns (204). With the
+configuration 'ingest: queue', the handler only verifies the signature and queues the
+delivery (see Trigger.start_ingest()), returning 202; the hooks are run by the ingest
+workers. If the queue is full the handler returns 503.
+
+Deliveries are deduplicated on their 'X-Github-Delivery' header (see DedupCache), so
+a redelivered webhook is acknowledged (200) without triggering the jobs again. The
+configuration keys 'dedup_size' and 'dedup_ttl' (seconds) size the cache, 'dedup: false'
+disables it, and 'dedup_db' names a DB component (ex. sqlite3) to share it between
+processes.
 """
 
 import hashlib
 import hmac
-from http import HTTPStatus
 
-from starlette.responses import JSONResponse, Response
+from starlette.responses import JSONResponse
 
 from palvella.lib.plugin import PluginDependency
 from palvella.lib.instance.trigger import Trigger
@@ -28,7 +42,7 @@ class GitHubWebhook(Trigger, class_type="plugin", plugin_type=PLUGIN_TYPE):
     name = None
     secret = None
 
-    fastapi_dependency = PluginDependency(parentclass="Frontend", plugin_type="fastapi")
+    fastapi_dependency = PluginDependency(parentclassname="Frontend", plugin_type="fastapi")
     depends_on = [ fastapi_dependency ]
 
     def __pre_plugins__(self):
@@ -43,6 +57,8 @@ class GitHubWebhook(Trigger, class_type="plugin", plugin_type=PLUGIN_TYPE):
             if x in self.config_data:
                 setattr(self, x, self.config_data[x])
 
+        self.start_delivery(f"{PLUGIN_TYPE}:{self.name}")
+
         fastapi = self.get_component(self.fastapi_dependency)
 
         # TODO: For each configured webhook, create a new instance with its
@@ -51,6 +67,13 @@ class GitHubWebhook(Trigger, class_type="plugin", plugin_type=PLUGIN_TYPE):
             self.logger.info(f"{self}: {obj.app}.add_api_route(\"/github_webhook\")")
             obj.app.add_api_route("/github_webhook", self.github_webhook, methods=["POST"])
 
+    async def __stop_plugins__(self):
+        """Remove the route for the '/github_webhook' endpoint that this object added, and drain the ingest queue."""
+        for obj in self.get_component(self.fastapi_dependency):
+            obj.app.router.routes[:] = [x for x in obj.app.router.routes
+                                        if getattr(x, 'endpoint', None) != self.github_webhook]
+        await self.stop_ingest()
+
     async def get_digest(self, data, hashfunc):
         """Return message digest if a secret key was provided."""
         if self.secret:
@@ -62,8 +85,6 @@ class GitHubWebhook(Trigger, class_type="plugin", plugin_type=PLUGIN_TYPE):
     async def github_webhook(self, request: Request):
         """FastAPI route to handle /github_webhook endpoint."""  # noqa
 
-        data = await FastAPIPlugin.fastapi_data(request)
-
         sig = FastAPIPlugin.get_header(request, "X-Hub-Signature-256")
         hook_id = FastAPIPlugin.get_header(request, "X-Github-Hook-Id")
         delivery = FastAPIPlugin.get_header(request, "X-Github-Delivery")
@@ -72,25 +93,17 @@ class GitHubWebhook(Trigger, class_type="plugin", plugin_type=PLUGIN_TYPE):
 
         self.logger.info(f"github_webhook(self={self}, request=(client={request.client}, method={request.method}, url.scheme={request.url.scheme}, url.port={request.url.port}, url.path='{request.url.path}'))")
 
-        digest = await self.get_digest(await data.body, hashfunc=hashlib.sha256)
+        body = await request.body()
+        digest = await self.get_digest(body, hashfunc=hashlib.sha256)
         if digest is not None:
             if not hmac.compare_digest(sig, digest):
                 self.logger.error("github_webhook: invalid signature")
                 return JSONResponse({"error": "Invalid signature"}, status_code=400)
 
-        jsondata = await data.json
-        await self.trigger(
-            meta = {
-              "mq":      { "event_type": "trigger" },
-              "webhook": { "event_type": event_type,
-                           "hook_id": hook_id,
-                           "delivery": delivery }
-            },
-            data = [jsondata]
-        )
-
-        # For 204 status code, you *MUST NOT* use a JSONResponse or HTTPResponse,
-        # but only Response, with no body. Otherwise FastAPI will inject some junk
-        # in the body that causes the h11 library to throw exceptions, because for
-        # 204 there should be no body at all.
-        return Response(status_code=HTTPStatus.NO_CONTENT.value)
+        meta = {
+          "mq":      { "event_type": "trigger" },
+          "webhook": { "event_type": event_type,
+                       "hook_id": hook_id,
+                       "delivery": delivery }
+        }
+        return await FastAPIPlugin.receive_delivery(self, body, content_type, delivery, meta)
@@ -0,0 +1,154 @@
+"""
+The plugin for the Trigger 'webhook'. Defines plugin class and some base functions.
+
+A generic webhook trigger. Each configured webhook is an endpoint under one route,
+'/webhook/{path}', registered once with the FastAPI web server plugin; the endpoint
+is looked up in a dict keyed by path, so adding endpoints doesn't add routes for
+Starlette to match against each request.
+
+Configuration of each webhook:
+    name:               The name of the webhook.
+    path:               The path of the endpoint under '/webhook/' (default: 'name').
+    secret:             The secret to verify the signature of requests with. (Optional)
+    signature_scheme:   The hashlib algorithm of the signature (default: 'sha256').
+    signature_header:   The header with the signature (default: 'X-Hub-Signature-256').
+                        Its value is the hex digest, with or without a '<scheme>=' prefix.
+    event_header:       The header with the event type (default: 'X-Github-Event').
+    delivery_header:    The header with a unique delivery ID (default: 'X-Github-Delivery').
+                        Deliveries are deduplicated on it, as with the 'github_webhook'
+                        trigger ('dedup', 'dedup_size', 'dedup_ttl', 'dedup_db').
+    ingest:             'inline' (default) or 'queue', as with the 'github_webhook' trigger.
+    mq:                 The name of a Message Queue to publish the triggers to. (Optional)
+"""
+
+import hashlib
+import hmac
+from http import HTTPStatus
+
+from starlette.responses import JSONResponse
+
+from palvella.lib.plugin import PluginDependency
+from palvella.lib.instance.trigger import Trigger
+from palvella.plugins.lib.frontend.fastapi import Request, FastAPIPlugin
+
+PLUGIN_TYPE = "webhook"
+ROUTE_PREFIX = "/webhook"
+
+
+class Webhook(Trigger, class_type="plugin", plugin_type=PLUGIN_TYPE):
+    """
+    Class of the generic webhook trigger. Inherits the Trigger class.
+
+    Attributes:
+        endpoints:      A dict of {path: Webhook()} of all the configured webhooks.
+    """
+
+    name = None
+    path = None
+    secret = None
+    signature_scheme = "sha256"
+    signature_header = "X-Hub-Signature-256"
+    event_header = "X-Github-Event"
+    delivery_header = "X-Github-Delivery"
+
+    endpoints = {}
+    _routes = {}  # id(app): the app the route was added to
+
+    fastapi_dependency = PluginDependency(parentclassname="Frontend", plugin_type="fastapi")
+    depends_on = [ fastapi_dependency ]
+
+    def __pre_plugins__(self):
+        """
+        Add this webhook to the endpoints, and the '/webhook/{path}' route to the FastAPI plugin's web server.
+
+        The route is only added the first time, for all the webhooks.
+        """
+        for x in ['name', 'path', 'secret', 'signature_scheme', 'signature_header',
+                  'event_header', 'delivery_header']:
+            if x in self.config_data:
+                setattr(self, x, self.config_data[x])
+        if self.path is None:
+            self.path = self.name
+        if not self.path:
+            self.logger.debug(f"{self}: no 'path' or 'name' configured; not adding an endpoint")
+            self.path = None
+            return
+        self.path = self.path.strip("/")
+        if self.path in self.endpoints:
+            raise ValueError(f"webhook: path '{self.path}' is already used by another webhook")
+
+        if self.signature_scheme not in hashlib.algorithms_available:
+            raise ValueError(f"webhook '{self.path}': unknown 'signature_scheme' '{self.signature_scheme}'")
+
+        # The key is hashed once here; each request copies the HMAC object and hashes its body.
+        self._hmac = None
+        if self.secret:
+            self._hmac = hmac.new(self.secret.encode(), digestmod=self.signature_scheme)
+
+        self.start_delivery(f"{PLUGIN_TYPE}:{self.path}", dedup=bool(self.delivery_header))
+
+        self.endpoints[self.path] = self
+
+        for obj in self.get_component(self.fastapi_dependency):
+            if id(obj.app) in self._routes:
+                continue
+            self.logger.info(f"{self}: {obj.app}.add_api_route(\"{ROUTE_PREFIX}/{{path:path}}\")")
+            obj.app.add_api_route(ROUTE_PREFIX + "/{path:path}", Webhook.route, methods=["POST"])
+            self._routes[id(obj.app)] = obj.app
+
+    async def __stop_plugins__(self):
+        """Remove this webhook from the endpoints (and the route, if it was the last one), and drain the ingest queue."""
+        if self.path is None:
+            return
+        if self.endpoints.get(self.path) is self:
+            del self.endpoints[self.path]
+        if not self.endpoints:
+            for app in self._routes.values():
+                app.router.routes[:] = [x for x in app.router.routes
+                                        if getattr(x, 'endpoint', None) != Webhook.route]
+            self._routes.clear()
+        await self.stop_ingest()
+
+    @staticmethod
+    async def route(request: Request, path: str):
+        """FastAPI route to handle the /webhook/{path} endpoints."""  # noqa
+        endpoint = Webhook.endpoints.get(path.strip("/"))
+        if endpoint is None:
+            return JSONResponse({"error": "Not found"}, status_code=HTTPStatus.NOT_FOUND.value)
+        return await endpoint.webhook(request)
+
+    def verify(self, body, sig):
+        """Return True if *sig* (from the signature header) is the HMAC of *body*, or no secret is set."""
+        if self._hmac is None:
+            return True
+        if not sig:
+            return False
+        prefix = self.signature_scheme + "="
+        if sig.startswith(prefix):
+            sig = sig[len(prefix):]
+        hmacobj = self._hmac.copy()
+        hmacobj.update(body)
+        return hmac.compare_digest(sig, hmacobj.hexdigest())
+
+    async def webhook(self, request):
+        """Handle a request to this webhook's endpoint."""
+        sig = FastAPIPlugin.get_header(request, self.signature_header)
+        delivery = FastAPIPlugin.get_header(request, self.delivery_header) if self.delivery_header else None
+        event_type = FastAPIPlugin.get_header(request, self.event_header) if self.event_header else None
+        content_type = FastAPIPlugin.get_header(request, "content-type")
+
+        self.logger.info(f"webhook(self={self}, request=(client={request.client}, method={request.method}, url.path='{request.url.path}'))")
+
+        body = await request.body()
+        if not self.verify(body, sig):
+            self.logger.error(f"webhook '{self.path}': invalid signature")
+            return JSONResponse({"error": "Invalid signature"}, status_code=400)
+
+        meta = {
+          "mq":      { "event_type": "trigger" },
+          "webhook": { "path": self.path,
+                       "event_type": event_type,
+                       "delivery": delivery }
+        }
+        return await FastAPIPlugin.receive_delivery(self, body, content_type, delivery, meta)
+
@@ -0,0 +1,94 @@
+"""Tests of loading configuration files (loadYamlDir() and ParseCache), and of timing it."""
+
+import datetime
+import json
+import os
+import tracemalloc
+import types
+
+import pytest
+
+from palvella.lib import timing
+from palvella.lib.instance import config as config_module
+from palvella.lib.instance.component import Component
+from palvella.lib.instance.config import Config, ParseCache, loadYamlDir
+from palvella.plugins.lib.engine.local import LocalEngine  # noqa: F401
+from palvella.plugins.lib.mq.memory import MemoryQueue  # noqa: F401
+
+
+def entries(path):
+    return sorted(x for x in os.listdir(path) if x.endswith(".json"))
+
+
+def test_cache_hit_returns_the_same_data(tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    data = {"jobs": {"basic": [{"name": "j", "n": 1, "x": 1.5, "on": True, "none": None}]}}
+    cache.put("k", data)
+    assert cache.get("k") == (True, data)
+    assert cache.get("other") == (False, None)
+
+
+@pytest.mark.parametrize("data", [{1: "integer key"}, {"when": datetime.date(2024, 1, 2)},
+                                  {"t": (1, 2)}, {"x": float("nan")}])
+def test_data_that_does_not_round_trip_is_not_cached(tmp_path, data):
+    cache = ParseCache(str(tmp_path / "cache"))
+    cache.put("k", data)
+    assert cache.get("k") == (False, None)
+    assert not os.path.exists(tmp_path / "cache") or os.listdir(tmp_path / "cache") == []
+
+
+def test_load_dir_keeps_yaml_types(tmp_path):
+    jobs = tmp_path / "jobs"
+    jobs.mkdir()
+    (jobs / "a.yaml").write_text("ports:\n  80: http\nwhen: 2024-01-02\n")
+    (jobs / "b.yaml").write_text("name: b\n")
+    cache = ParseCache(str(tmp_path / "cache"))
+    for _ in range(2):
+        files = dict(loadYamlDir(str(jobs), cache=cache))
+        assert files[str(jobs / "a.yaml")] == {"ports": {80: "http"}, "when": datetime.date(2024, 1, 2)}
+        assert files[str(jobs / "b.yaml")] == {"name": "b"}
+    assert len(entries(tmp_path / "cache")) == 1
+
+
+def test_prune_keeps_the_most_recently_used(tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"), max_entries=2)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, {"n": i})
+        os.utime(cache._file(key), ns=(i * 10**9, i * 10**9))
+    cache.get("a")  # Now the most recently used
+    cache.prune()
+    assert entries(tmp_path / "cache") == ["a.json", "c.json"]
+
+
+def test_load_dir_prunes_the_cache(tmp_path):
+    jobs = tmp_path / "jobs"
+    jobs.mkdir()
+    for i in range(3):
+        (jobs / f"{i}.yaml").write_text(f"n: {i}\n")
+    cache = ParseCache(str(tmp_path / "cache"), max_entries=2)
+    loadYamlDir(str(jobs), cache=cache)
+    assert len(entries(tmp_path / "cache")) == 2
+
+
+def test_startup_timing_report(tmp_path, monkeypatch):
+    """Each phase of a Config() is timed once, and the report has them all."""
+    tracing = tracemalloc.is_tracing()
+    timings = timing.StartupTimings(enabled=True, path=str(tmp_path / "timing.json"))
+    monkeypatch.setattr(config_module, "timings", timings)
+    try:
+        Config(parent=types.SimpleNamespace(subclasses=Component.subclasses),
+               config_data={"mq": {"memory": [{"name": "q"}]}, "engine": {"local": [{"name": "l"}]}})
+        timings.report()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    with open(tmp_path / "timing.json") as f:
+        report = json.load(f)
+    phases = sorted((x["phase"], x["name"]) for x in report["phases"])
+    assert phases == [("config.load", None), ("config.parse", None), ("config.validate", None),
+                      ("config.validate.section", "engine"), ("config.validate.section", "mq")]
+    assert all(x["seconds"] >= 0 and x["start"] >= 0 for x in report["phases"])
+    # Sorted by wall time, the slowest first
+    assert [x["seconds"] for x in report["phases"]] == sorted((x["seconds"] for x in report["phases"]), reverse=True)
+    assert report["total_seconds"] >= max(x["seconds"] for x in report["phases"])
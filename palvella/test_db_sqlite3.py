@@ -0,0 +1,59 @@
+"""Tests of claiming keys in the 'sqlite3' database plugin."""
+
+import asyncio
+import sqlite3
+import time
+
+from palvella.plugins.lib.db.sqlite3 import SQLite3DB
+
+
+def keys(path):
+    """Return the (namespace, key) of each claimed key in the database at *path*."""
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT namespace, key FROM claimed_keys ORDER BY namespace, key").fetchall()
+
+
+def test_claim_and_release_key(tmp_path, stub_instance):
+    async def main():
+        db = SQLite3DB(parent=stub_instance(), config_data={"name": "db", "db_path": str(tmp_path / "db.sqlite3")})
+        assert await db.claim_key("ns", "a", 60) is True
+        assert await db.claim_key("ns", "a", 60) is False
+        assert await db.claim_key("other", "a", 60) is True
+        await db.release_key("ns", "a")
+        assert await db.claim_key("ns", "a", 60) is True
+        await db.stop()
+
+    asyncio.run(main())
+
+
+def test_expired_keys_are_pruned(tmp_path, stub_instance):
+    db_path = str(tmp_path / "db.sqlite3")
+
+    async def main():
+        db = SQLite3DB(parent=stub_instance(), config_data={"name": "db", "db_path": db_path, "prune_interval": 0})
+        assert await db.claim_key("ns", "a", 0) is True
+        assert await db.claim_key("ns", "b", 0) is True
+        time.sleep(0.01)
+        # Claiming any key deletes every expired one
+        assert await db.claim_key("ns", "c", 60) is True
+        assert keys(db_path) == [("ns", "c")]
+        # An expired key can be claimed again
+        assert await db.claim_key("ns", "a", 60) is True
+        await db.stop()
+
+    asyncio.run(main())
+
+
+def test_expired_key_is_claimed_between_prunes(tmp_path, stub_instance):
+    db_path = str(tmp_path / "db.sqlite3")
+
+    async def main():
+        db = SQLite3DB(parent=stub_instance(), config_data={"name": "db", "db_path": db_path, "prune_interval": 3600})
+        assert await db.claim_key("ns", "a", 0) is True
+        assert await db.claim_key("ns", "b", 0) is True
+        time.sleep(0.01)
+        assert await db.claim_key("ns", "a", 60) is True
+        assert keys(db_path) == [("ns", "a"), ("ns", "b")]
+        await db.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+"""Tests of the admission control and the worker processes of the 'fastapi' frontend plugin."""
+
+import asyncio
+
+import pytest
+
+from palvella.lib.logging import makeLogger
+from palvella.plugins.lib.frontend.fastapi import AdmissionControl, FastAPIPlugin, Limiter, Rejected
+
+
+class FakeProcess:
+    def __init__(self, index, alive=True):
+        self.index = index
+        self.pid = 1000 + index
+        self.alive = alive
+        self.exitcode = None if alive else 1
+
+    def is_alive(self):
+        return self.alive
+
+
+def plugin(**config_data):
+    """Return a FastAPIPlugin that hasn't been initialized (so it starts no server)."""
+    obj = FastAPIPlugin.__new__(FastAPIPlugin)
+    obj.logger = makeLogger(__name__)
+    obj.config_data = config_data
+    return obj
+
+
+def test_memory_queue_is_rejected_in_worker_config(tmp_path):
+    worker_config = tmp_path / "worker.yaml"
+    worker_config.write_text("mq:\n  memory:\n    - name: q\n")
+    with pytest.raises(ValueError, match="memory"):
+        plugin(worker_config=str(worker_config)).start_workers(2)
+
+
+def test_worker_config_is_required():
+    with pytest.raises(ValueError, match="worker_config"):
+        plugin().start_workers(2)
+
+
+def test_exited_workers_are_started_again(monkeypatch):
+    started = []
+
+    def start_worker(self, worker_config, index):
+        started.append(index)
+        return FakeProcess(index)
+
+    monkeypatch.setattr(FastAPIPlugin, "start_worker", start_worker)
+
+    async def main():
+        obj = plugin()
+        obj.workers = [FakeProcess(0), FakeProcess(1, alive=False), FakeProcess(2)]
+        task = asyncio.ensure_future(obj.supervise_workers("worker.yaml", 0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return obj.workers
+
+    workers = asyncio.run(main())
+    assert started == [1]
+    assert [x.is_alive() for x in workers] == [True, True, True]
+
+
+def test_token_bucket_refills():
+    limiter = Limiter(rate=2, burst=2)
+    limiter.take_token()
+    limiter.take_token()
+    with pytest.raises(Rejected) as e:
+        limiter.take_token()
+    assert e.value.status == 429 and e.value.retry_after == 1
+    limiter._last -= 0.5  # Half a second later, at 2 per second
+    limiter.take_token()
+    with pytest.raises(Rejected):
+        limiter.take_token()
+    assert limiter.rejected["rate"] == 2
+
+
+def test_rate_below_one_still_admits():
+    limiter = Limiter(rate=0.5)
+    assert limiter.burst == 1
+    limiter.take_token()
+    with pytest.raises(Rejected) as e:
+        limiter.take_token()
+    assert e.value.retry_after == 2
+    limiter._last -= 2
+    limiter.take_token()
+
+
+def test_backlog_is_limited_and_times_out():
+    async def main():
+        limiter = Limiter(max_concurrency=1, max_backlog=1, backlog_timeout=0.05)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected, match="backlog is full"):
+            await limiter.acquire()
+        with pytest.raises(Rejected, match="timed out"):
+            await waiting
+
+        # Once the request in flight is released, the next one is admitted from the backlog
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        limiter.release()
+        return limiter.stats()
+
+    stats = asyncio.run(main())
+    assert stats["admitted"] == 2 and stats["in_flight"] == 0 and stats["waiting"] == 0
+    assert stats["rejected"] == {"rate": 0, "backlog": 1, "timeout": 1}
+
+
+async def request(app, path):
+    """Send an HTTP GET of *path* to ASGI *app*. Returns the status and the headers of the response."""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": "GET", "path": path, "headers": []}, receive, send)
+    start = sent[0]
+    return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}
+
+
+def test_admission_control_rejects_with_429_and_503():
+    async def main():
+        release = asyncio.Event()
+
+        async def app(scope, receive, send):
+            await release.wait()
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        admission = AdmissionControl(app, {"max_concurrency": 1, "max_backlog": 0,
+                                           "paths": {"/limited": {"rate": 1}}})
+        first = asyncio.ensure_future(request(admission, "/other"))
+        await asyncio.sleep(0)
+        status, headers = await request(admission, "/other")
+        assert status == 503 and headers["retry-after"] == "1"
+        status, headers = await request(admission, "/limited")
+        assert status == 503  # Within its rate limit, but the global limit rejected it
+        status, headers = await request(admission, "/limited/x")
+        assert status == 429 and headers["retry-after"] == "1"
+
+        release.set()
+        assert (await first)[0] == 204
+        return admission.stats()
+
+    stats = asyncio.run(main())
+    assert stats["global"]["in_flight"] == 0 and stats["global"]["rejected"]["backlog"] == 2
+    assert stats["paths"]["/limited"]["in_flight"] == 0
+    assert stats["paths"]["/limited"]["rejected"]["rate"] == 1
@@ -0,0 +1,177 @@
+"""Tests of matching Messages to hooks (Hooks and the discrimination index of HookDispatch)."""
+
+import asyncio
+import random
+
+from palvella.lib.instance.hook import Hook, HookDispatcher, compareDict
+from palvella.lib.instance.message import Message
+from palvella.lib.plugin import PluginDependency
+
+
+class Webhook:
+    plugin_namespace = "palvella.plugins.lib.trigger"
+    plugin_type = "webhook"
+
+
+class Poll:
+    plugin_namespace = "palvella.plugins.lib.trigger"
+    plugin_type = "poll"
+
+
+def linear_match(hooks, instances, msg):
+    """Match *msg* by comparing it to every hook and instance (or None if no instance sent it), as match_hook_from_msg() used to."""
+    identity = (msg.identity.plugin_namespace, msg.identity.plugin_type)
+    senders = [x for x in instances if (x.plugin_namespace, x.plugin_type) == identity]
+    for hook in hooks:
+        for instance in senders or [None]:
+            if (hook.component.plugin_namespace, hook.component.plugin_type) != identity:
+                continue
+            if isinstance(hook.data, dict) and not all(compareDict(hook.data, x) for x in msg.data):
+                continue
+            yield hook, instance
+
+
+def random_data(rng, depth=0):
+    """Return a dict of hook or message data, with nested dicts, lists and empty dict leaves."""
+    data = {}
+    for key in rng.sample(["repo", "ref", "action", "owner", "n"], rng.randint(1, 3)):
+        kind = rng.random()
+        if kind < 0.25 and depth < 2:
+            data[key] = random_data(rng, depth + 1)
+        elif kind < 0.3:
+            data[key] = {}
+        elif kind < 0.35:
+            data[key] = ["a", rng.choice(["b", "c"])]  # Not indexable
+        else:
+            data[key] = rng.choice(["a", "b", "c", 1, 2, None])
+    return data
+
+
+def message(cls, data):
+    return Message(identity={"name": "t", "plugin_namespace": cls.plugin_namespace,
+                             "plugin_type": cls.plugin_type},
+                   meta={}, data=data)
+
+
+def random_messages(rng, n):
+    """Return *n* Messages with 0 to 3 data items, from either trigger class."""
+    return [message(rng.choice([Webhook, Poll]), [random_data(rng) for _ in range(rng.randint(0, 3))])
+            for _ in range(n)]
+
+
+def register(hooks, rng, owner, n):
+    for _ in range(n):
+        cls = rng.choice([Webhook, Poll])
+        data = random_data(rng) if rng.random() < 0.9 else None
+        hooks.register_hook(PluginDependency(plugin_type=cls.plugin_type), hook_type=None,
+                            callback=None, data=data, owner=owner)
+
+
+def check(hooks, instances, messages):
+    for msg in messages:
+        assert list(hooks.match_hook_from_msg(msg)) == list(linear_match(hooks.list(), instances, msg)), msg
+
+
+def test_index_matches_like_a_linear_scan(stub_instance):
+    rng = random.Random(1)
+    instance = stub_instance([Webhook, Poll])
+    instances = [Webhook(), Poll(), Webhook()]
+    for x in instances:
+        instance.hooks.add_instance(x)
+    register(instance.hooks, rng, "a", 300)
+
+    messages = random_messages(rng, 500)
+    # Messages made from the hooks' own data, so that plenty of them match
+    messages += [message(Webhook, [hook.data]) for hook in instance.hooks.list()
+                 if isinstance(hook.data, dict)][:100]
+    messages += [message(Webhook, [{**x.data, "extra": 1}, x.data]) for x in instance.hooks.list()
+                 if isinstance(x.data, dict)][:100]
+    assert sum(1 for msg in messages if list(instance.hooks.match_hook_from_msg(msg))) > 100
+    check(instance.hooks, instances, messages)
+
+
+def test_index_follows_registered_and_unregistered_hooks(stub_instance):
+    rng = random.Random(2)
+    instance = stub_instance([Webhook, Poll])
+    instances = [Webhook(), Poll()]
+    for x in instances:
+        instance.hooks.add_instance(x)
+    messages = random_messages(rng, 200)
+
+    register(instance.hooks, rng, "a", 100)
+    check(instance.hooks, instances, messages)  # Builds the indexes
+    register(instance.hooks, rng, "b", 100)
+    check(instance.hooks, instances, messages)
+    instance.hooks.unregister_hooks("a")
+    assert all(x.owner == "b" for x in instance.hooks.list())
+    check(instance.hooks, instances, messages)
+
+    # Instances that come and go
+    instance.hooks.remove_instance(instances[0])
+    check(instance.hooks, instances[1:], messages)
+    instance.hooks.add_instance(instances[0])
+    check(instance.hooks, instances[1:] + instances[:1], messages)
+
+
+class Callbacks:
+    """Hook callbacks that wait to be released, counting how many run at once."""
+
+    def __init__(self):
+        self.running = 0
+        self.most = 0
+        self.release = asyncio.Event()
+
+    async def callback(self, hook, component_instance, message):
+        self.running += 1
+        self.most = max(self.most, self.running)
+        try:
+            await self.release.wait()
+            if hook.data == "fail":
+                raise RuntimeError("the callback failed")
+            return hook.data
+        finally:
+            self.running -= 1
+
+    def matches(self, data):
+        return [(Hook(callback=self.callback, data=x), None) for x in data]
+
+
+def test_dispatcher_waits_for_a_slot_before_starting_a_callback():
+    async def main():
+        dispatcher = HookDispatcher(limit=2)
+        callbacks = Callbacks()
+        dispatch = asyncio.ensure_future(dispatcher.dispatch(callbacks.matches(range(5)), None))
+        await asyncio.sleep(0.01)
+        # Only the callbacks with a slot have a task; the rest wait in dispatch()
+        assert not dispatch.done() and len(dispatcher.pending) == 2 and callbacks.running == 2
+
+        callbacks.release.set()
+        results = await asyncio.wait_for((await dispatch).wait(), 1)
+        await asyncio.sleep(0)  # For the tasks' done callbacks
+        assert results == [0, 1, 2, 3, 4]
+        assert callbacks.most == 2 and not dispatcher.pending
+
+    asyncio.run(main())
+
+
+def test_trigger_limit_is_held_with_the_global_one():
+    async def main():
+        dispatcher = HookDispatcher(limit=10)
+        callbacks = Callbacks()
+        trigger_limit = asyncio.Semaphore(1)
+        first = asyncio.ensure_future(dispatcher.dispatch(callbacks.matches(["fail", 1]), None,
+                                                          semaphore=trigger_limit))
+        other = await dispatcher.dispatch(callbacks.matches([2, 3]), None)  # Not limited by the trigger
+        await asyncio.sleep(0.01)
+        assert callbacks.running == 3 and not first.done()
+
+        callbacks.release.set()
+        results = await asyncio.wait_for((await first).wait(), 1)
+        assert isinstance(results[0], RuntimeError) and results[1] == 1
+        assert await other.wait() == [2, 3]
+        await asyncio.sleep(0)
+        # A failed callback gives back its slots too
+        assert callbacks.most == 3 and not trigger_limit.locked()
+        assert dispatcher.semaphore()._value == 10
+
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+"""Tests of message payloads (project_payload() and PayloadStore)."""
+
+import os
+
+from palvella.lib.instance.message import JSONPayload, PayloadStore, project_payload
+
+
+DATA = {"ref": "main", "repository": {"url": "u", "name": "n", "owner": {"name": "o"}}, "commits": [1, 2]}
+
+
+def test_project_payload_keeps_only_the_paths():
+    assert project_payload(DATA, [("ref",), ("repository", "owner", "name")]) == \
+        {"ref": "main", "repository": {"owner": {"name": "o"}}}
+
+
+def test_project_payload_keeps_a_parent_path_whole():
+    assert project_payload(DATA, [("repository", "url"), ("repository",)]) == {"repository": DATA["repository"]}
+
+
+def test_project_payload_skips_missing_paths():
+    assert project_payload(DATA, [("missing",), ("ref", "x"), ("commits", "0")]) == {}
+
+
+def test_project_payload_of_a_json_payload():
+    payload = JSONPayload(b'{"ref": "main", "n": 1}')
+    assert project_payload(payload, [("n",)]) == {"n": 1}
+    assert project_payload([1, 2], [("n",)]) == [1, 2]
+
+
+def test_payload_store_stores_each_payload_once(tmp_path):
+    store = PayloadStore(str(tmp_path / "payloads"))
+    raw = b'{"ref":  "main"}'
+    digest = store.put(JSONPayload(raw))
+    assert store.put(JSONPayload(raw)) == digest
+    assert os.listdir(store.path) == [digest]
+    # The raw bytes are kept as they were received
+    assert store.get(digest).encode() == raw and store.get(digest)["ref"] == "main"
+
+    other = store.put({"ref": "main"})
+    assert other != digest and store.get(other).data == {"ref": "main"}
@@ -0,0 +1,76 @@
+"""Tests of the 'memory' message queue plugin."""
+
+import asyncio
+
+from palvella.plugins.lib.mq.memory import MemoryQueue
+
+
+def open_queue(**config):
+    return MemoryQueue(config_data={"name": "m", **config})
+
+
+def test_messages_are_kept_for_the_next_instance():
+    async def main():
+        old = open_queue()
+        await old.publish("a")
+        await old.publish("b")
+        old.__stop_plugins__()
+
+        new = open_queue()
+        assert await new.consume_batch(max_wait=0) == ["a", "b"]
+        new.__stop_plugins__()
+        assert "m" not in MemoryQueue.queues
+
+    asyncio.run(main())
+
+
+def test_queue_is_resized_in_place():
+    async def main():
+        old = open_queue(maxsize=10)
+        for x in range(3):
+            await old.publish(x)
+        old.__stop_plugins__()
+
+        new = open_queue(maxsize=2)
+        assert new.q is old.q and new.q.maxsize == 2
+        # Over-full until it drains below the new size; nothing is dropped
+        put = asyncio.ensure_future(new.publish(3))
+        await asyncio.sleep(0)
+        assert not put.done()
+        assert await new.consume_batch(max_n=2, max_wait=0) == [0, 1]
+        await put
+        assert await new.consume_batch(max_wait=0) == [2, 3]
+        new.__stop_plugins__()
+        assert "m" not in MemoryQueue.queues
+
+    asyncio.run(main())
+
+
+def test_waiting_put_is_woken_by_a_larger_size():
+    async def main():
+        old = open_queue(maxsize=1)
+        await old.publish("a")
+        put = asyncio.ensure_future(old.publish("b"))
+        await asyncio.sleep(0)
+        old.__stop_plugins__()
+        assert "m" in MemoryQueue.queues
+
+        new = open_queue(maxsize=2)
+        await asyncio.wait_for(put, 1)
+        assert await new.consume_batch(max_wait=0) == ["a", "b"]
+        new.__stop_plugins__()
+        assert "m" not in MemoryQueue.queues
+
+    asyncio.run(main())
+
+
+def test_queue_is_shared_until_its_last_user_stops():
+    async def main():
+        publisher, consumer = open_queue(), open_queue()
+        await publisher.publish("a")
+        publisher.__stop_plugins__()
+        assert await consumer.consume() == "a"
+        consumer.__stop_plugins__()
+        assert "m" not in MemoryQueue.queues and "m" not in MemoryQueue._users
+
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+"""Tests of routing calls to message queues by name (MessageQueue.run_func() and MessageQueueRoutes)."""
+
+import asyncio
+
+import pytest
+
+from palvella.lib.instance.message import Message
+from palvella.lib.instance.mq import MessageQueue
+from palvella.lib.plugin import PluginDependency
+from palvella.plugins.lib.mq.memory import MemoryQueue
+from palvella.plugins.lib.trigger.receive_all import ReceiveAllTriggers
+
+
+class Sender:
+    """A component configured with the message queue(s) *mq*."""
+
+    def __init__(self, parent, mq):
+        self.parent = parent
+        self.config_data = {"mq": mq}
+
+
+def test_fan_out_publishes_concurrently(stub_instance):
+    async def main():
+        instance = stub_instance()
+        full = instance.add(MemoryQueue(config_data={"name": "full", "maxsize": 1}))
+        other = instance.add(MemoryQueue(config_data={"name": "other"}))
+        await full.publish("first")
+
+        # 'full' blocks until it has room; 'other' still gets the message meanwhile
+        publish = asyncio.ensure_future(MessageQueue.publish(Sender(instance, ["full", "other"]), "second"))
+        assert await asyncio.wait_for(other.consume(), 1) == "second"
+        assert not publish.done()
+
+        assert await full.consume() == "first"
+        assert await asyncio.wait_for(publish, 1) == [True, True]
+        assert await full.consume() == "second"
+        full.__stop_plugins__()
+        other.__stop_plugins__()
+
+    asyncio.run(main())
+
+
+def test_fan_out_consume_is_rejected(stub_instance):
+    async def main():
+        instance = stub_instance()
+        a = instance.add(MemoryQueue(config_data={"name": "a"}))
+        b = instance.add(MemoryQueue(config_data={"name": "b"}))
+        sender = Sender(instance, ["a", "b"])
+        with pytest.raises(ValueError):
+            await MessageQueue.consume_batch(sender, max_wait=0)
+        with pytest.raises(ValueError):
+            await MessageQueue.consume(sender)
+
+        # A list of one name is not a fan-out
+        await a.publish("x")
+        assert await MessageQueue.consume_batch(Sender(instance, ["a"]), max_wait=0) == [["x"]]
+        a.__stop_plugins__()
+        b.__stop_plugins__()
+
+    asyncio.run(main())
+
+
+def test_routes_follow_added_and_removed_queues(stub_instance):
+    async def main():
+        instance = stub_instance()
+        sender = Sender(instance, "q")
+        assert await MessageQueue.publish(sender, "lost") == []
+
+        queue = instance.add(MemoryQueue(config_data={"name": "q"}))
+        assert await MessageQueue.publish(sender, "kept") == [True]
+        assert await queue.consume() == "kept"
+
+        instance.mq_routes.remove_instance(queue)
+        assert await MessageQueue.publish(sender, "lost") == []
+        queue.__stop_plugins__()
+
+    asyncio.run(main())
+
+
+def test_consumers_wait_for_their_queue(stub_instance):
+    """A trigger started before its message queue consumes from it once it's added."""
+    async def main():
+        instance = stub_instance([ReceiveAllTriggers])
+        trigger = instance.add(ReceiveAllTriggers(parent=instance, config_data={"name": "r", "mq": "late"}))
+        received = asyncio.Queue()
+
+        async def job(hook, component_instance, message):
+            await received.put(message.data[0]["n"])
+
+        instance.hooks.register_hook(PluginDependency(component_namespace="triggers", plugin_type="receive_all"),
+                                     hook_type=None, callback=job, data=None)
+        await asyncio.sleep(0.01)
+
+        queue = instance.add(MemoryQueue(parent=instance, config_data={"name": "late"}))
+        await trigger.publish(Message(trigger, meta={}, data=[{"n": 1}]))
+        assert await asyncio.wait_for(received.get(), 1) == 1
+        await trigger.stop()
+        await queue.stop()
+        assert "late" not in MemoryQueue.queues
+
+    asyncio.run(main())
@@ -0,0 +1,188 @@
+"""Tests of the 'sqlite3' message queue plugin, and of consuming triggers from it."""
+
+import asyncio
+import sqlite3
+
+from palvella.lib.instance.message import Message
+from palvella.lib.plugin import PluginDependency
+from palvella.plugins.lib.mq.sqlite3 import SQLite3Queue
+from palvella.plugins.lib.trigger.receive_all import ReceiveAllTriggers
+
+
+def rows(path):
+    """Return the (state, deliveries) of each message in the database at *path*."""
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT state, deliveries FROM messages ORDER BY id").fetchall()
+
+
+async def wait_for(predicate, timeout=5):
+    """Wait until *predicate*() is true, or fail after *timeout* seconds."""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out waiting"
+        await asyncio.sleep(0.02)
+
+
+def test_failed_hook_is_delivered_again(tmp_path, stub_instance):
+    """A message whose hook callback raises is not acknowledged, but returned and delivered again."""
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def main():
+        instance = stub_instance([ReceiveAllTriggers])
+        queue = instance.add(SQLite3Queue(parent=instance, config_data={"name": "q", "db_path": db_path}))
+        trigger = instance.add(ReceiveAllTriggers(parent=instance,
+                                                  config_data={"name": "r", "mq": "q", "nack_delay": 0}))
+        calls = []
+
+        async def job(hook, component_instance, message):
+            calls.append(message.data[0]["n"])
+            if len(calls) == 1:
+                raise RuntimeError("the job failed")
+
+        instance.hooks.register_hook(PluginDependency(component_namespace="triggers", plugin_type="receive_all"),
+                                     hook_type=None, callback=job, data={"n": 1})
+        await trigger.publish(Message(trigger, meta={"mq": {}}, data=[{"n": 1}]))
+
+        await wait_for(lambda: len(calls) == 2 and rows(db_path) == [(2, 2)])
+        await trigger.stop()
+        await queue.stop()
+        return calls
+
+    assert asyncio.run(main()) == [1, 1]
+
+
+def message(n):
+    return Message(identity={"name": "t", "plugin_namespace": "p", "plugin_type": "t"},
+                   meta={"m": {"n": n}}, data=[{"n": n}])
+
+
+def open_queue(db_path, **config):
+    return SQLite3Queue(config_data={"name": "q", "db_path": db_path, **config})
+
+
+def test_publish_many_and_consume_batch(tmp_path):
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def main():
+        queue = open_queue(db_path)
+        assert await queue.publish_many([message(n) for n in range(5)]) == [True] * 5
+        await queue.publish(message(5))
+        first = await queue.consume_batch(max_n=4, max_wait=0)
+        rest = await queue.consume_batch(max_n=4, max_wait=0)
+        empty = await queue.consume_batch(max_n=4, max_wait=0.05)
+        await queue.__stop_plugins__()
+        return first, rest, empty
+
+    first, rest, empty = asyncio.run(main())
+    assert [x.data[0]["n"] for x in first + rest] == [0, 1, 2, 3, 4, 5]
+    assert first[0].meta.m == {"n": 0} and first[0].identity.name == "t"
+    assert empty == []
+    assert rows(db_path) == [(1, 1)] * 6  # All leased, once
+
+
+def test_expired_lease_is_delivered_again(tmp_path):
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def main():
+        queue = open_queue(db_path, lease=0.1, maintenance_interval=0.05)
+        await queue.publish(message(1))
+        first = await queue.consume_batch(max_wait=0)
+        # Not acknowledged; the maintenance task requeues it once the lease expires
+        again = await queue.consume_batch(max_wait=2)
+        await queue.ack(again)
+        await queue.__stop_plugins__()
+        return first, again
+
+    first, again = asyncio.run(main())
+    assert len(first) == len(again) == 1
+    assert first[0].receipt[:2] == again[0].receipt[:2] and first[0].receipt != again[0].receipt
+    assert rows(db_path) in ([(2, 2)], [])  # Acknowledged (or compacted already)
+
+
+def test_expired_lease_cannot_ack_or_nack(tmp_path):
+    """Once a message whose lease expired is leased again, only the new lease acknowledges it."""
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def main():
+        queue = open_queue(db_path, lease=0.5, maintenance_interval=0.05)
+        await queue.publish(message(1))
+        stale = await queue.consume_batch(max_wait=0)
+        current = await queue.consume_batch(max_wait=2)
+        assert await queue.ack(stale) == 0
+        assert await queue.nack(stale) == 0
+        assert rows(db_path) == [(1, 2)]  # Still leased by the second consumer
+        assert await queue.ack(current) == 1
+        await queue.__stop_plugins__()
+
+    asyncio.run(main())
+    assert rows(db_path) in ([(2, 2)], [])
+
+
+def test_nack(tmp_path):
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def main():
+        queue = open_queue(db_path, maintenance_interval=0.05)
+        await queue.publish_many([message(1), message(2)])
+        one, two = await queue.consume_batch(max_wait=0)
+
+        # Without a delay, the message is ready again right away
+        assert await queue.nack([one]) == 1
+        assert [x.receipt[1] for x in await queue.consume_batch(max_wait=0)] == [one.receipt[1]]
+
+        # With a delay, it stays leased until the delay is over
+        assert await queue.nack([two], delay=0.2) == 1
+        assert await queue.consume_batch(max_wait=0) == []
+        assert [x.receipt[1] for x in await queue.consume_batch(max_wait=2)] == [two.receipt[1]]
+        await queue.__stop_plugins__()
+
+    asyncio.run(main())
+    assert rows(db_path) == [(1, 2), (1, 2)]
+
+
+def test_ack_ignores_other_queues(tmp_path):
+    async def main():
+        a = open_queue(str(tmp_path / "a.sqlite3"))
+        b = open_queue(str(tmp_path / "b.sqlite3"))
+        await a.publish(message(1))
+        consumed = await a.consume_batch(max_wait=0)
+        assert await b.ack(consumed) == 0
+        assert await a.ack(consumed) == 1
+        await a.__stop_plugins__()
+        await b.__stop_plugins__()
+
+    asyncio.run(main())
+
+
+def test_acknowledged_messages_are_compacted(tmp_path):
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def main():
+        queue = open_queue(db_path, maintenance_interval=0.05)
+        await queue.publish_many([message(n) for n in range(3)])
+        consumed = await queue.consume_batch(max_n=2, max_wait=0)
+        await queue.ack(consumed)
+        await wait_for(lambda: len(rows(db_path)) == 1)
+        await queue.__stop_plugins__()
+
+    asyncio.run(main())
+    assert rows(db_path) == [(0, 0)]  # Only the message that was never consumed is left
+
+
+def test_messages_survive_reopening(tmp_path):
+    db_path = str(tmp_path / "mq.sqlite3")
+
+    async def publish():
+        queue = open_queue(db_path)
+        await queue.publish_many([message(1), message(2)])
+        await queue.__stop_plugins__()
+
+    async def consume():
+        queue = open_queue(db_path)
+        consumed = await queue.consume_batch(max_wait=0)
+        await queue.ack(consumed)
+        await queue.__stop_plugins__()
+        return consumed
+
+    asyncio.run(publish())
+    assert [x.data[0]["n"] for x in asyncio.run(consume())] == [1, 2]
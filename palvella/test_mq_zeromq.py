@@ -0,0 +1,63 @@
+"""Tests of the 'zeromq' message queue plugin: batches, and waiting for room to send."""
+
+import asyncio
+
+import pytest
+
+from palvella.lib.instance.message import Message
+from palvella.lib.instance.mq import OperationError
+from palvella.plugins.lib.mq.zeromq import ZeroMQ
+
+
+def message(n):
+    return Message(identity={"name": "t", "plugin_namespace": "p", "plugin_type": "t"},
+                   meta={"m": {"n": n}}, data=[{"n": n}])
+
+
+def open_socket(url, socket_type, **config):
+    return ZeroMQ(config_data={"name": socket_type, "url": url, "socket_type": socket_type, **config})
+
+
+def test_batch_round_trip(tmp_path):
+    url = f"ipc://{tmp_path}/mq"
+
+    async def main():
+        pull = open_socket(url, "pull")
+        push = open_socket(url, "push")
+        assert await pull.consume_batch(max_wait=0) == []
+
+        await push.publish_many([message(n) for n in range(5)])
+        # Waits for the first message, then takes the others already received without waiting
+        messages = await pull.consume_batch(max_n=3, max_wait=5)
+        while len(messages) < 3:
+            messages += await pull.consume_batch(max_n=3 - len(messages), max_wait=5)
+        rest = []
+        while len(rest) < 2:
+            rest += await pull.consume_batch(max_wait=5)
+
+        assert [x.data[0]["n"] for x in messages + rest] == [0, 1, 2, 3, 4]
+        assert messages[0].meta.m == {"n": 0} and messages[0].identity.name == "t"
+        assert push.stats()["sent"] == 5 and pull.stats()["received"] == 5
+        assert push.stats()["blocked"] == 0
+        await push.__stop_plugins__()
+        await pull.__stop_plugins__()
+
+    asyncio.run(main())
+
+
+def test_send_at_the_high_water_mark_times_out(tmp_path):
+    """With no peer to take them, a socket holds 'sndhwm' messages, and the next send waits 'send_timeout'."""
+    url = f"ipc://{tmp_path}/mq"
+
+    async def main():
+        push = open_socket(url, "push", sndhwm=1, linger=0, send_timeout=0.05)
+        await push.publish(message(0))
+        with pytest.raises(OperationError, match="timed out"):
+            await push.publish_many([message(n) for n in range(1, 3)])
+        stats = push.stats()
+        await push.__stop_plugins__()
+        return stats
+
+    stats = asyncio.run(main())
+    assert stats["sent"] == 1 and stats["blocked"] == 1 and stats["send_timeouts"] == 1
+    assert stats["blocked_seconds"] >= 0.04
@@ -0,0 +1,226 @@
+"""Tests of plugin discovery (WalkPlugins and PluginManifest) and matching (PluginRegistry)."""
+
+import importlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from palvella.lib.instance.component import Component
+from palvella.lib.plugin import (PluginDependency, PluginManifest, PluginRegistry, WalkPlugins,
+                                 get_class)
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    """A package 'mfpkg' with a plugin module whose class inherits a class of another module."""
+    pkg = tmp_path / "mfpkg"
+    pkg.mkdir()
+    (pkg / "__init__.py").write_text("")
+    (pkg / "base.py").write_text(
+        "class Base:\n"
+        "    class_type = 'plugin_base'\n"
+        "    plugin_type = None\n"
+        "    plugin_namespace = 'mfpkg'\n"
+        "    component_namespace = 'things'\n"
+        "    depends_on = []\n")
+    (pkg / "plug.py").write_text(
+        "from mfpkg.base import Base\n"
+        "class Plug(Base):\n"
+        "    class_type = 'plugin'\n"
+        "    plugin_type = 'plug'\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield pkg
+    for name in [x for x in sys.modules if x == "mfpkg" or x.startswith("mfpkg.")]:
+        del sys.modules[name]
+
+
+def make_manifest(path):
+    module = importlib.import_module("mfpkg")
+    plug = importlib.import_module("mfpkg.plug").Plug
+    manifest = PluginManifest(str(path))
+    manifest.add_namespace(module, ["mfpkg.plug"])
+    manifest.record_classes([plug], {plug: []}, [plug])
+    return manifest
+
+
+def test_manifest_is_current(package, tmp_path):
+    manifest = make_manifest(tmp_path / "manifest.json")
+    assert manifest.is_current()
+    manifest.save()
+    assert PluginManifest.load(manifest.path).is_current()
+
+
+@pytest.mark.parametrize("name", ["plug.py", "base.py"])
+def test_changed_module_invalidates_manifest(package, tmp_path, name):
+    manifest = make_manifest(tmp_path / "manifest.json")
+    manifest.save()
+    with open(package / name, "a") as f:
+        f.write("# changed\n")
+    assert not PluginManifest.load(manifest.path).is_current()
+
+
+def test_core_modules_are_recorded(package, tmp_path):
+    manifest = make_manifest(tmp_path / "manifest.json")
+    assert str(package / "base.py") in manifest.files
+
+
+def test_walk_is_shared_by_instances():
+    """A second WalkPlugins() of the same class gets the first one's walk, and its own attributes."""
+    first = WalkPlugins(Component, lazy=True)
+    second = WalkPlugins(Component, lazy=True)
+    assert second.baseclass is Component and second.lazy is True
+    assert second.manifest is first.manifest
+    assert second.classes is first.classes and Component in second.classes
+
+
+# Creates a lazily loaded Instance, and writes the plugin modules it imported, its components,
+# and the hooks matching a message from a trigger only named in a job's 'triggers' to a file.
+LAZY_INSTANCE = """
+import asyncio, json, sys
+from palvella.lib import Instance
+from palvella.lib.instance.message import Message
+
+async def main():
+    instance = Instance(config_data=json.loads(sys.argv[1]), plugin_loading="lazy")
+    await instance.initialize()
+    msg = Message(identity={"name": "g", "plugin_namespace": "palvella.plugins.lib.trigger",
+                            "plugin_type": "github_webhook"}, meta={}, data=[{"ref": "main"}])
+    with open(sys.argv[2], "w") as f:
+        json.dump({
+            "modules": [x for x in sys.modules if x.startswith("palvella.plugins.lib.")],
+            "fastapi": "fastapi" in sys.modules or "uvicorn" in sys.modules,
+            "instances": sorted(type(x).__name__ for x in instance.components.instances),
+            "hooks": len(list(instance.hooks.match_hook_from_msg(msg))),
+        }, f)
+    for x in reversed(instance.components.instances):
+        await x.stop()
+
+asyncio.run(main())
+"""
+
+
+def test_lazy_loading_does_not_load_plugins_named_in_hooks(tmp_path):
+    """A plugin only named in a job's 'triggers' is matched by its name, but not loaded."""
+    config = {
+        "mq": {"memory": [{"name": "q"}]},
+        "triggers": {"receive_all": [{"name": "r", "mq": "q"}]},
+        "jobs": {"basic": [{"name": "j", "triggers": {"github_webhook": [{"ref": "main"}]}}]},
+    }
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PLUGIN_MANIFEST="", PYTHONPATH=root, DEBUG="0")
+    subprocess.run([sys.executable, "-c", LAZY_INSTANCE, json.dumps(config), "result.json"],
+                   cwd=tmp_path, env=env, capture_output=True, timeout=60, check=True)
+    result = json.loads((tmp_path / "result.json").read_text())
+    # Nor are the other message queues (the trigger's 'mq' is the name of the queue it uses)
+    assert sorted(x for x in result["modules"] if x.count(".") == 4) == [
+        "palvella.plugins.lib.job.basic", "palvella.plugins.lib.mq.memory",
+        "palvella.plugins.lib.trigger.receive_all"]
+    assert result["fastapi"] is False
+    assert result["instances"] == ["BasicJob", "MemoryQueue", "ReceiveAllTriggers"]
+    assert result["hooks"] == 1
+
+
+def linear_match(objects, deps):
+    """Match *deps* against *objects* by scanning them all, as match_class_dependencies() used to."""
+    results = []
+    for dep in deps:
+        for obj in objects:
+            cls = get_class(obj)
+            if dep.classname is not None and cls.__name__ != dep.classname:
+                continue
+            if dep.parentclassname is not None and \
+                    dep.parentclassname not in [x.__name__ for x in cls.__bases__]:
+                continue
+            if dep.plugin_type is not None and getattr(obj, 'plugin_type', None) != dep.plugin_type:
+                continue
+            if dep.component_namespace is not None and \
+                    getattr(obj, 'component_namespace', None) != dep.component_namespace:
+                continue
+            results.append(obj)
+    return results
+
+
+class Base:
+    plugin_type = None
+    component_namespace = None
+
+
+class MQ(Base):
+    component_namespace = "mq"
+
+
+class Trigger(Base):
+    component_namespace = "triggers"
+
+
+class ZeroMQ(MQ):
+    plugin_type = "zeromq"
+
+
+class Memory(MQ):
+    plugin_type = "memory"
+
+
+class Webhook(Trigger):
+    plugin_type = "webhook"
+
+
+class Mixin:
+    pass
+
+
+class GitHubWebhook(Webhook, Mixin):
+    plugin_type = "github_webhook"
+
+
+class OddOne(Trigger):
+    plugin_type = "zeromq"  # The same plugin_type as a class of another namespace
+
+
+CLASSES = [Base, MQ, Trigger, ZeroMQ, Memory, Webhook, GitHubWebhook, OddOne]
+
+
+def all_deps():
+    """Yield a PluginDependency() of every combination of the attributes of the classes (and some that match nothing)."""
+    values = {
+        "classname": [None, "ZeroMQ", "Webhook", "Missing"],
+        "parentclassname": [None, "MQ", "Trigger", "Webhook", "Mixin", "Missing"],
+        "plugin_type": [None, "zeromq", "webhook", "github_webhook", "missing"],
+        "component_namespace": [None, "mq", "triggers", "missing"],
+    }
+    for combination in itertools.product(*values.values()):
+        yield PluginDependency(**{k: v for k, v in zip(values, combination) if v is not None})
+
+
+def test_registry_matches_like_a_linear_scan():
+    objects = CLASSES + [ZeroMQ(), Memory(), GitHubWebhook(), GitHubWebhook()]
+    registry = PluginRegistry(objects)
+    deps = list(all_deps())
+    for dep in deps:
+        assert registry.match([dep]) == linear_match(objects, [dep]), dep
+    # Several dependencies at once
+    assert registry.match(deps[:50]) == linear_match(objects, deps[:50])
+
+
+def test_registry_matches_like_a_linear_scan_after_changes():
+    objects = list(CLASSES)
+    registry = PluginRegistry(objects)
+    for obj in [ZeroMQ, GitHubWebhook, Base]:
+        registry.remove(obj)
+        objects.remove(obj)
+    for obj in [GitHubWebhook, ZeroMQ(), ZeroMQ]:
+        registry.add(obj)
+        objects.append(obj)
+    registry.remove(Memory)  # ... and removing what isn't there any more does nothing
+    registry.remove(Memory)
+    objects.remove(Memory)
+    for dep in all_deps():
+        assert registry.match([dep]) == linear_match(objects, [dep]), dep
+
+    registry.invalidate(CLASSES)
+    for dep in all_deps():
+        assert registry.match([dep]) == linear_match(CLASSES, [dep]), dep
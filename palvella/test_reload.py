@@ -0,0 +1,140 @@
+"""Tests of reloading the configuration of an Instance (Instance.reload() and ComponentObjects.reload())."""
+
+import asyncio
+import threading
+import types
+
+from palvella.lib.instance import instance as instance_module
+from palvella.lib.instance.component import ComponentObject, ComponentObjects, load_module_defaults
+from palvella.lib.instance.config import ConfigData
+from palvella.lib import Instance
+from palvella.plugins.lib.db.sqlite3 import SQLite3DB
+from palvella.plugins.lib.engine.local import LocalEngine
+from palvella.plugins.lib.mq.memory import MemoryQueue
+
+
+def config(*engines, db="s"):
+    """Return a stand-in for a Config() with the component objects of a configuration."""
+    objects = [ComponentObject(classref=MemoryQueue, config_data=ConfigData({"name": "q"})),
+               ComponentObject(classref=SQLite3DB, config_data=ConfigData({"name": db, "db_path": ":memory:"}))]
+    objects += [ComponentObject(classref=LocalEngine, config_data=ConfigData({"name": x})) for x in engines]
+    return types.SimpleNamespace(objects=objects)
+
+
+def names(objects):
+    """Return the sorted (class name, 'name') of ComponentObject()s *objects*."""
+    return sorted((x.classref.__name__, x.config_data.get('name')) for x in objects)
+
+
+def named(components):
+    """Return a dict of (class name, 'name') -> component instance of ComponentObjects *components*."""
+    return {(type(x).__name__, x.config_data.get('name')): x for x in components.instances}
+
+
+def test_reload_diff(stub_instance):
+    async def main():
+        instance = stub_instance([MemoryQueue, SQLite3DB, LocalEngine])
+        components = ComponentObjects(root=instance, parent=instance, config=config("a", "b"))
+        await components.initialize()
+        before = named(components)
+        assert set(before) == {("MemoryQueue", "q"), ("SQLite3DB", "s"),
+                               ("LocalEngine", "a"), ("LocalEngine", "b")}
+
+        added, removed = await components.reload(config("a", "c", db="t"))
+        after = named(components)
+
+        assert names(added) == [("LocalEngine", "c"), ("SQLite3DB", "t")]
+        assert names(removed) == [("LocalEngine", "b"), ("SQLite3DB", "s")]
+        assert set(after) == {("MemoryQueue", "q"), ("SQLite3DB", "t"),
+                              ("LocalEngine", "a"), ("LocalEngine", "c")}
+        # Unchanged components keep their instances; removed ones are stopped
+        for key in [("MemoryQueue", "q"), ("LocalEngine", "a")]:
+            assert after[key] is before[key]
+        assert before[("SQLite3DB", "s")].conn is None
+
+        # Reloading the same configuration changes nothing
+        added, removed = await components.reload(config("a", "c", db="t"))
+        assert added == [] and removed == []
+        assert named(components) == after
+
+        for x in list(components.instances):
+            await x.stop()
+            components.remove_instance(x)
+
+    asyncio.run(main())
+
+
+def test_reload_parses_config_off_the_loop(monkeypatch):
+    """Instance.reload() builds the Config() in a thread, and then applies it on the event loop."""
+    threads = []
+
+    class RecordingConfig:
+        def __init__(self, parent=None, config_path=None, config_data=None):
+            threads.append(threading.current_thread())
+            self.config_data = config_data
+
+    class Components:
+        async def reload(self, config):
+            threads.append(threading.current_thread())
+            self.config = config
+
+    async def main():
+        instance = types.SimpleNamespace(_reload_lock=asyncio.Lock(), components=Components(),
+                                         config=None, config_path=None, config_data={"old": 1})
+        await Instance.reload(instance, config_data={"new": 1})
+        return instance
+
+    monkeypatch.setattr(instance_module, "Config", RecordingConfig)
+    instance = asyncio.run(main())
+    assert threads[0] is not threading.main_thread()
+    assert threads[1] is threading.main_thread()
+    assert instance.config is instance.components.config
+    assert instance.config.config_data == {"new": 1} and instance.config_data == {"new": 1}
+
+
+def test_reload_reads_plugin_defaults_again(monkeypatch):
+    class Components:
+        async def reload(self, config):
+            self.config = config
+
+    async def main():
+        instance = types.SimpleNamespace(_reload_lock=asyncio.Lock(), components=Components(),
+                                         config=None, config_path=None, config_data={})
+        await Instance.reload(instance, config_data={})
+
+    load_module_defaults(MemoryQueue.__module__, MemoryQueue.component_namespace)
+    assert load_module_defaults.cache_info().currsize > 0
+    monkeypatch.setattr(instance_module, "Config", lambda **kwargs: None)
+    asyncio.run(main())
+    assert load_module_defaults.cache_info().currsize == 0
+
+
+def test_reload_keeps_memory_queue_messages(stub_instance):
+    async def main():
+        instance = stub_instance([MemoryQueue])
+        objects = lambda maxsize: types.SimpleNamespace(objects=[
+            ComponentObject(classref=MemoryQueue, config_data=ConfigData({"name": "q", "maxsize": maxsize}))])
+        components = ComponentObjects(root=instance, parent=instance, config=objects(10))
+        await components.initialize()
+
+        # A consumer that isn't reloaded keeps waiting on the queue of the instance it started with
+        old = components.instances[0]
+        consumer = asyncio.ensure_future(old.consume_batch())
+        await asyncio.sleep(0)
+        added, removed = await components.reload(objects(20))
+        assert len(added) == len(removed) == 1
+        new = components.instances[0]
+        assert new.q is old.q and new.q.maxsize == 20
+        await new.publish("after")
+        assert await asyncio.wait_for(consumer, 1) == ["after"]
+
+        await new.publish("kept")
+        await components.reload(objects(10))
+        assert await components.instances[0].consume_batch(max_wait=0) == ["kept"]
+
+        for x in list(components.instances):
+            await x.stop()
+            components.remove_instance(x)
+        assert "q" not in MemoryQueue.queues
+
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+"""Tests of triggers receiving deliveries (Trigger.deliver() and the ingest queue), and projecting them (Trigger.project())."""
+
+import asyncio
+
+from palvella.lib.instance.message import JSONPayload, PayloadStore
+from palvella.lib.plugin import PluginDependency
+from palvella.plugins.lib.frontend.fastapi import FastAPIPlugin
+from palvella.plugins.lib.job.basic import BasicJob
+from palvella.plugins.lib.trigger.receive_all import ReceiveAllTriggers
+
+
+def start_trigger(instance, **config):
+    """Return a trigger of StubInstance *instance* with configuration *config*, set up to receive deliveries."""
+    trigger = instance.add(ReceiveAllTriggers(parent=instance, config_data={"name": "t", **config}))
+    trigger.start_delivery("t")
+    return trigger
+
+
+def register(instance, callback):
+    instance.hooks.register_hook(PluginDependency(component_namespace="triggers", plugin_type="receive_all"),
+                                 hook_type=None, callback=callback, data=None)
+
+
+def receive(trigger, delivery, n):
+    return FastAPIPlugin.receive_delivery(trigger, b'{"n": %d}' % n, "application/json", delivery, {})
+
+
+def test_queued_deliveries_are_triggered_by_the_workers(stub_instance):
+    async def main():
+        instance = stub_instance([ReceiveAllTriggers])
+        trigger = start_trigger(instance, ingest="queue", ingest_workers=2)
+        received, release = [], asyncio.Event()
+
+        async def job(hook, component_instance, message):
+            await release.wait()
+            received.append(message.data[0]["n"])
+
+        register(instance, job)
+        for n in range(3):
+            assert await trigger.deliver(JSONPayload(b'{"n": %d}' % n), {}) is True
+        await asyncio.sleep(0.01)
+        # The workers took the first two, and wait for their hooks; the third is still queued
+        assert received == [] and trigger.ingest_queue.qsize() == 1
+
+        release.set()
+        await asyncio.wait_for(trigger.ingest_queue.join(), 1)
+        assert sorted(received) == [0, 1, 2]
+        await trigger.stop_ingest()
+        await trigger.stop()
+
+    asyncio.run(main())
+
+
+def test_full_ingest_queue_is_a_503_and_forgets_the_delivery(stub_instance):
+    async def main():
+        instance = stub_instance([ReceiveAllTriggers])
+        trigger = start_trigger(instance, ingest="queue", ingest_queue_size=1, ingest_workers=1)
+        received, release = [], asyncio.Event()
+
+        async def job(hook, component_instance, message):
+            await release.wait()
+            received.append(message.data[0]["n"])
+
+        register(instance, job)
+        assert (await receive(trigger, "d0", 0)).status_code == 202
+        await asyncio.sleep(0.01)  # The worker takes it, and waits for the hook
+        assert (await receive(trigger, "d1", 1)).status_code == 202
+        response = await receive(trigger, "d2", 2)
+        assert response.status_code == 503 and response.headers["retry-after"] == "1"
+
+        release.set()
+        await asyncio.wait_for(trigger.ingest_queue.join(), 1)
+        # The rejected delivery isn't taken for a duplicate when it's sent again; the others are
+        assert (await receive(trigger, "d2", 2)).status_code == 202
+        assert (await receive(trigger, "d1", 1)).status_code == 200
+        await asyncio.wait_for(trigger.ingest_queue.join(), 1)
+        assert received == [0, 1, 2]
+        await trigger.stop_ingest()
+        await trigger.stop()
+
+    asyncio.run(main())
+
+
+PAYLOAD = b'{"ref": "main", "repository": {"url": "u", "name": "n"}, "commits": [1, 2, 3]}'
+
+
+def test_job_with_fields_gets_the_projected_payload(stub_instance, tmp_path, monkeypatch):
+    received = []
+
+    async def receive_alert(self, hook, component_instance, message):
+        received.append(message)
+
+    monkeypatch.setattr(BasicJob, "receive_alert", receive_alert)
+
+    async def main():
+        instance = stub_instance([ReceiveAllTriggers])
+        trigger = start_trigger(instance, payload_store=str(tmp_path / "payloads"))
+        job = BasicJob(parent=instance, config_data={
+            "name": "j", "fields": ["repository.url"], "triggers": {"receive_all": [{"ref": "main"}]}})
+        await trigger.deliver(JSONPayload(PAYLOAD), {"m": {}})
+        await asyncio.sleep(0.01)
+        await job.stop()
+        await trigger.stop()
+
+    asyncio.run(main())
+    message, = received
+    # The fields the job reads, and the ones its filter compares
+    assert list(message.data) == [{"ref": "main", "repository": {"url": "u"}}]
+    assert message.meta.payload["fields"] == ["ref", "repository.url"]
+    assert message.meta.m == {}
+    digest, = message.meta.payload["sha256"]
+    assert PayloadStore(str(tmp_path / "payloads")).get(digest).encode() == PAYLOAD
+
+
+def test_job_without_fields_gets_the_whole_payload(stub_instance, monkeypatch):
+    received = []
+
+    async def receive_alert(self, hook, component_instance, message):
+        received.append(message)
+
+    monkeypatch.setattr(BasicJob, "receive_alert", receive_alert)
+
+    async def main():
+        instance = stub_instance([ReceiveAllTriggers])
+        trigger = start_trigger(instance)
+        jobs = [BasicJob(parent=instance, config_data={"name": "a", "fields": ["ref"],
+                                                       "triggers": {"receive_all": [{}]}}),
+                BasicJob(parent=instance, config_data={"name": "b", "triggers": {"receive_all": [{}]}})]
+        await trigger.deliver(JSONPayload(PAYLOAD), {})
+        await asyncio.sleep(0.01)
+        for x in jobs + [trigger]:
+            await x.stop()
+
+    asyncio.run(main())
+    # One hook reads all of it, so neither gets a projection
+    assert len(received) == 2
+    for message in received:
+        assert message.data[0].encode() == PAYLOAD and "payload" not in message.meta.__dict__
@@ -0,0 +1,136 @@
+"""Tests of the responses to webhook deliveries (FastAPIPlugin.receive_delivery() and the 'webhook' trigger)."""
+
+import asyncio
+import hashlib
+import hmac
+import types
+
+import pytest
+from starlette.datastructures import Headers
+
+from palvella.lib.instance.trigger import DedupCache
+from palvella.lib.logging import makeLogger
+from palvella.lib.plugin import PluginDependency
+from palvella.plugins.lib.frontend.fastapi import FastAPIPlugin
+from palvella.plugins.lib.trigger.webhook import Webhook
+
+
+class StubTrigger:
+    """A trigger that records its deliveries, deduplicating them like Trigger.is_duplicate()."""
+
+    def __init__(self):
+        self.logger = makeLogger(__name__)
+        self.dedup = DedupCache()
+        self.delivered = []
+
+    async def is_duplicate(self, delivery):
+        return not await self.dedup.claim(delivery)
+
+    async def deliver(self, payload, meta, delivery=None):
+        self.delivered.append(payload.data)
+        return False
+
+
+def receive(trigger, content_type, delivery="d1"):
+    response = asyncio.run(FastAPIPlugin.receive_delivery(trigger, b'{"n": 1}', content_type, delivery, {}))
+    return response.status_code
+
+
+@pytest.mark.parametrize("content_type", ["application/json", "application/json; charset=utf-8",
+                                          "Application/JSON;charset=UTF-8"])
+def test_json_media_type_with_parameters(content_type):
+    trigger = StubTrigger()
+    assert receive(trigger, content_type) == 204
+    assert trigger.delivered == [{"n": 1}]
+
+
+@pytest.mark.parametrize("content_type", [None, "text/plain", "application/jsonx; charset=utf-8"])
+def test_other_media_types_are_rejected(content_type):
+    trigger = StubTrigger()
+    assert receive(trigger, content_type) == 400
+    assert trigger.delivered == []
+
+
+def test_duplicate_delivery():
+    trigger = StubTrigger()
+    assert receive(trigger, "application/json") == 204
+    assert receive(trigger, "application/json") == 200
+    assert len(trigger.delivered) == 1
+
+
+BODY = b'{"ref": "main"}'
+SIGNATURE = hmac.new(b"s3cret", BODY, hashlib.sha256).hexdigest()
+
+
+class FakeRequest:
+    """A stand-in for a Starlette Request of a webhook delivery."""
+
+    def __init__(self, body=BODY, **headers):
+        self.headers = Headers({"content-type": "application/json", **headers})
+        self.client = ("127.0.0.1", 1234)
+        self.method = "POST"
+        self.url = types.SimpleNamespace(path="/webhook/team")
+        self._body = body
+
+    async def body(self):
+        return self._body
+
+
+def deliver(stub_instance, requests, **config):
+    """Send each of *requests* to a 'webhook' trigger configured with *config*. Returns the response codes and the data of the hook callbacks."""
+    received = []
+
+    async def job(hook, component_instance, message):
+        received.append(dict(message.data[0]))
+
+    async def main(instance):
+        webhook = instance.add(Webhook(parent=instance, config_data={"name": "team", **config}))
+        instance.hooks.register_hook(PluginDependency(component_namespace="triggers", plugin_type="webhook"),
+                                     hook_type=None, callback=job, data=None)
+        try:
+            codes = [(await webhook.webhook(x)).status_code for x in requests]
+            await asyncio.sleep(0.01)
+        finally:
+            await webhook.stop()
+        return codes
+
+    return asyncio.run(main(stub_instance([Webhook]))), received
+
+
+@pytest.mark.parametrize("signature", [SIGNATURE, "sha256=" + SIGNATURE])
+def test_webhook_signature(signature, stub_instance):
+    codes, received = deliver(stub_instance, [FakeRequest(**{"X-Hub-Signature-256": signature})], secret="s3cret")
+    assert codes == [204] and received == [{"ref": "main"}]
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Hub-Signature-256": "sha256=" + "0" * 64},
+                                     {"X-Hub-Signature-256": "sha1=" + SIGNATURE},
+                                     {"X-Other": SIGNATURE}])
+def test_webhook_with_a_bad_or_missing_signature_is_rejected(headers, stub_instance):
+    codes, received = deliver(stub_instance, [FakeRequest(**headers)], secret="s3cret")
+    assert codes == [400] and received == []
+
+
+def test_webhook_signature_scheme_and_header(stub_instance):
+    signature = hmac.new(b"s3cret", BODY, hashlib.sha512).hexdigest()
+    requests = [FakeRequest(**{"X-Signature": signature}), FakeRequest(**{"X-Hub-Signature-256": SIGNATURE})]
+    codes, received = deliver(stub_instance, requests, secret="s3cret", signature_scheme="sha512",
+                              signature_header="X-Signature")
+    assert codes == [204, 400] and len(received) == 1
+
+
+def test_webhook_with_an_unknown_signature_scheme_is_rejected(stub_instance):
+    with pytest.raises(ValueError, match="signature_scheme"):
+        deliver(stub_instance, [], secret="s3cret", signature_scheme="nope")
+    assert "team" not in Webhook.endpoints
+
+
+def test_webhook_deliveries_are_deduplicated_on_the_delivery_header(stub_instance):
+    requests = [FakeRequest(**{"X-Github-Delivery": x}) for x in ["a", "a", "b"]]
+    requests += [FakeRequest(), FakeRequest()]  # No delivery ID: not deduplicated
+    codes, received = deliver(stub_instance, requests)
+    assert codes == [204, 200, 204, 204, 204] and len(received) == 4
+
+    requests = [FakeRequest(**{"X-Delivery": "a"}), FakeRequest(**{"X-Delivery": "a"})]
+    codes, received = deliver(stub_instance, requests, delivery_header="X-Delivery")
+    assert codes == [204, 200] and len(received) == 1